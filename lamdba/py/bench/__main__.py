@@ -0,0 +1,8 @@
+import logging
+import sys
+
+from bench.runner import main
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING);
+    sys.exit(main());
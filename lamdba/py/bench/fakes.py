@@ -0,0 +1,430 @@
+import io
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+"""
+In-process stand-ins for the services used by the Fun Translate skill, so that it can be
+benchmarked without AWS or the Fun Translations API. Each fake sleeps for a configurable
+latency (with jitter) before answering, and counts the calls made to it.
+
+The fakes only implement the calls and condition expressions that lambda_function.py
+and its tools actually make, and fail conditional writes with the same error code as
+DynamoDB so that the rate limiter and single-flight leases behave as they do in AWS.
+The translation API is a real HTTP server on localhost, so that the connection pool,
+timeouts and hedged requests are exercised too.
+"""
+
+KEY_NAME = 'OriginalPhraseandLanguage';
+UPDATE_CLAUSE = re.compile(r'(SET|ADD|REMOVE)\s+(.*?)(?=\s+(?:SET|ADD|REMOVE)\s|$)');
+UPDATE_SEPARATOR = re.compile(r',(?![^(]*\))');
+IF_NOT_EXISTS = re.compile(r'if_not_exists\(\s*(\S+?)\s*,\s*(\S+?)\s*\)$');
+
+""" Latency of a fake, in milliseconds, with up to +/- jitter (a fraction) added to each
+    call. A seeded random number generator is used so that runs can be repeated.
+"""
+class Latency(object):
+
+    def __init__(self, milliseconds, jitter=0.2, seed=None):
+        # type: (float, float, int) -> None
+        self.milliseconds = milliseconds;
+        self.jitter = jitter;
+        self._random = random.Random(seed);
+        self._lock = threading.Lock();
+
+    def sleep(self):
+        # type: () -> None
+        if self.milliseconds <= 0:
+            return;
+        with self._lock:
+            factor = 1 + self.jitter * self._random.uniform(-1, 1);
+        time.sleep(self.milliseconds * factor / 1000.0);
+
+""" Exception raised by the fakes in the same shape as the botocore ClientError, as the
+    skill checks e.response['Error']['Code'].
+"""
+class FakeClientError(Exception):
+
+    def __init__(self, code, message=''):
+        # type: (String, String) -> None
+        Exception.__init__(self, '{}: {}'.format(code, message));
+        self.response = {'Error': {'Code': code, 'Message': message}};
+
+def conditionFailed():
+    return FakeClientError('ConditionalCheckFailedException', 'The conditional request failed');
+
+""" Fake Polly client. The audio stream is a few kilobytes of bytes per character of the
+    SSML, which is roughly the size of a real mp3 at 22050Hz.
+"""
+class FakePolly(object):
+
+    def __init__(self, latency, bytes_per_character=400):
+        # type: (Latency, int) -> None
+        self.latency = latency;
+        self.bytes_per_character = bytes_per_character;
+        self.calls = Counter();
+
+    def synthesize_speech(self, OutputFormat, Text, VoiceId, TextType='text', SampleRate=None, **kwargs):
+        self.latency.sleep();
+        self.calls['synthesize_speech'] += 1;
+        return {'AudioStream': io.BytesIO(b'\0' * (len(Text) * self.bytes_per_character)),
+                'ContentType': 'audio/mpeg', 'RequestCharacters': len(Text)};
+
+""" Fake S3 client, keeping the objects in memory.
+"""
+class FakeS3(object):
+
+    def __init__(self, latency):
+        # type: (Latency) -> None
+        self.latency = latency;
+        self.objects = {};
+        self.modified = {};
+        self.calls = Counter();
+        self._lock = threading.Lock();
+
+    def _read(self, body):
+        return body.read() if hasattr(body, 'read') else body;
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.latency.sleep();
+        self.calls['head_object'] += 1;
+        with self._lock:
+            if Key not in self.objects:
+                raise FakeClientError('404', 'Not Found');
+            return {'ContentLength': len(self.objects[Key])};
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.latency.sleep();
+        self.calls['put_object'] += 1;
+        data = self._read(Body);
+        with self._lock:
+            self.objects[Key] = data;
+            self.modified[Key] = time.time();
+        return {'ETag': uuid.uuid4().hex};
+
+    def list_objects_v2(self, Bucket, ContinuationToken=None, MaxKeys=1000, **kwargs):
+        self.latency.sleep();
+        self.calls['list_objects_v2'] += 1;
+        with self._lock:
+            keys = sorted(self.objects);
+            start = int(ContinuationToken or 0);
+            page = keys[start:start + MaxKeys];
+            response = {
+                'Contents': [{'Key': key, 'Size': len(self.objects[key]), 'LastModified': self.modified.get(key, 0)}
+                             for key in page],
+                'IsTruncated': start + MaxKeys < len(keys)
+            };
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = str(start + MaxKeys);
+        return response;
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self.latency.sleep();
+        self.calls['delete_objects'] += 1;
+        with self._lock:
+            for entry in Delete['Objects']:
+                self.objects.pop(entry['Key'], None);
+                self.modified.pop(entry['Key'], None);
+        return {'Deleted': Delete['Objects']};
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.latency.sleep();
+        self.calls['delete_object'] += 1;
+        with self._lock:
+            self.objects.pop(Key, None);
+        return {};
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        self.latency.sleep();
+        self.calls['download_file'] += 1;
+        with self._lock:
+            if Key not in self.objects:
+                raise FakeClientError('404', 'Not Found');
+            data = self.objects[Key];
+        with open(Filename, 'wb') as output:
+            output.write(data);
+
+""" Fake DynamoDB table, keeping the items in memory. Only the condition expressions used
+    by the skill are understood: attribute_not_exists on the key, the lease expiry, the
+    rate limiter's updated time and the lease owner.
+"""
+class FakeTable(object):
+
+    def __init__(self, latency, name='fun-translate'):
+        # type: (Latency, String) -> None
+        self.latency = latency;
+        self.name = name;
+        self.items = {};
+        self.calls = Counter();
+        self._lock = threading.Lock();
+
+    def _clause(self, current, clause, names, values):
+        # type: (dict, String, dict, dict) -> bool
+        clause = clause.strip();
+        for function in ('attribute_exists', 'attribute_not_exists'):
+            if clause.startswith(function + '('):
+                name = clause[len(function) + 1:-1].strip();
+                name = names.get(name, name);
+                exists = current is not None and (name == KEY_NAME or name in current);
+                return exists if function == 'attribute_exists' else not exists;
+        if clause == 'expires < :now':
+            return current is not None and current.get('expires', 0) < values[':now'];
+        if clause == '#updated = :previous':
+            return current is not None and current.get('updated') == values[':previous'];
+        if clause == '#owner = :owner':
+            return current is not None and current.get('owner') == values[':owner'];
+        raise ValueError('Unsupported condition expression: ' + clause);
+
+    def _check(self, current, condition, values, names=None):
+        # type: (dict, String, dict, dict) -> None
+        if not condition:
+            return;
+        values = values or {};
+        names = names or {};
+        for alternative in condition.split(' OR '):
+            if all(self._clause(current, clause, names, values) for clause in alternative.split(' AND ')):
+                return;
+        raise conditionFailed();
+
+    def get_item(self, Key, **kwargs):
+        self.latency.sleep();
+        self.calls['get_item'] += 1;
+        with self._lock:
+            item = self.items.get(Key[KEY_NAME]);
+        return {'Item': dict(item)} if item is not None else {};
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None, **kwargs):
+        self.latency.sleep();
+        self.calls['put_item'] += 1;
+        with self._lock:
+            self._check(self.items.get(Item[KEY_NAME]), ConditionExpression, ExpressionAttributeValues, ExpressionAttributeNames);
+            self.items[Item[KEY_NAME]] = dict(Item);
+        return {};
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, **kwargs):
+        self.latency.sleep();
+        self.calls['update_item'] += 1;
+        names = ExpressionAttributeNames or {};
+        values = ExpressionAttributeValues or {};
+        with self._lock:
+            current = self.items.get(Key[KEY_NAME]);
+            self._check(current, ConditionExpression, values, names);
+            item = dict(current or {}, **Key);
+            # Updates are made up of SET, ADD and REMOVE clauses of plain assignments,
+            # e.g. "ADD a :a SET b = :b, #c = if_not_exists(d, :c) REMOVE d"
+            for action, assignments in UPDATE_CLAUSE.findall(UpdateExpression):
+                for assignment in UPDATE_SEPARATOR.split(assignments):
+                    if action == 'SET':
+                        name, _, value = assignment.partition('=');
+                        value = value.strip();
+                        default = IF_NOT_EXISTS.match(value);
+                        if default:
+                            path = names.get(default.group(1), default.group(1));
+                            value = item[path] if path in item else values[default.group(2)];
+                        else:
+                            value = values[value];
+                        item[names.get(name.strip(), name.strip())] = value;
+                    elif action == 'ADD':
+                        name, value = assignment.split();
+                        name = names.get(name, name);
+                        item[name] = item.get(name, 0) + values[value];
+                    else:
+                        item.pop(names.get(assignment.strip(), assignment.strip()), None);
+            self.items[Key[KEY_NAME]] = item;
+        return {};
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None, **kwargs):
+        self.latency.sleep();
+        self.calls['delete_item'] += 1;
+        with self._lock:
+            self._check(self.items.get(Key[KEY_NAME]), ConditionExpression, ExpressionAttributeValues, ExpressionAttributeNames);
+            self.items.pop(Key[KEY_NAME], None);
+        return {};
+
+    def scan(self, **kwargs):
+        self.latency.sleep();
+        self.calls['scan'] += 1;
+        with self._lock:
+            return {'Items': [dict(item) for item in self.items.values()]};
+
+    def batch_writer(self, **kwargs):
+        return FakeBatchWriter(self);
+
+""" Batch writer returned by FakeTable.batch_writer, writing the items when it is closed.
+"""
+class FakeBatchWriter(object):
+
+    def __init__(self, fake_table):
+        # type: (FakeTable) -> None
+        self.table = fake_table;
+        self.items = [];
+
+    def __enter__(self):
+        return self;
+
+    def __exit__(self, *exc_info):
+        self.table.latency.sleep();
+        self.table.calls['batch_write_item'] += 1;
+        with self.table._lock:
+            for key, item in self.items:
+                if item is None:
+                    self.table.items.pop(key, None);
+                else:
+                    self.table.items[key] = dict(item);
+        return False;
+
+    def put_item(self, Item):
+        self.items.append((Item[KEY_NAME], Item));
+
+    def delete_item(self, Key):
+        self.items.append((Key[KEY_NAME], None));
+
+""" Fake DynamoDB resource, giving back the one fake table and answering batch reads.
+"""
+class FakeDynamoDB(object):
+
+    def __init__(self, fake_table):
+        # type: (FakeTable) -> None
+        self.table = fake_table;
+
+    def Table(self, name):
+        return self.table;
+
+    def batch_get_item(self, RequestItems):
+        self.table.latency.sleep();
+        self.table.calls['batch_get_item'] += 1;
+        responses = {};
+        with self.table._lock:
+            for name, request in RequestItems.items():
+                responses[name] = [dict(self.table.items[key[KEY_NAME]]) for key in request['Keys']
+                                   if key[KEY_NAME] in self.table.items];
+        return {'Responses': responses, 'UnprocessedKeys': {}};
+
+""" Fake Lambda client, used for the skill's asynchronous self-invocations. The events are
+    queued so that the benchmark can run them afterwards.
+"""
+class FakeLambda(object):
+
+    def __init__(self):
+        self.events = [];
+        self.calls = Counter();
+        self._lock = threading.Lock();
+
+    def invoke(self, FunctionName, InvocationType, Payload, **kwargs):
+        self.calls['invoke'] += 1;
+        with self._lock:
+            self.events.append(json.loads(Payload));
+        return {'StatusCode': 202};
+
+    def drain(self):
+        # type: () -> list
+        with self._lock:
+            events, self.events = self.events, [];
+        return events;
+
+""" Lambda context passed to lambda_handler, counting down from the function's timeout.
+"""
+class FakeContext(object):
+
+    def __init__(self, timeout_ms, function_name='fun-translate-bench'):
+        # type: (int, String) -> None
+        self.started = time.time();
+        self.timeout_ms = timeout_ms;
+        self.function_name = function_name;
+        self.invoked_function_arn = 'arn:aws:lambda:eu-west-1:000000000000:function:' + function_name;
+        self.aws_request_id = str(uuid.uuid4());
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int(self.timeout_ms - (time.time() - self.started) * 1000));
+
+""" Local HTTP server standing in for the Fun Translations API. The translation is made by
+    reversing each word, so it is different from the phrase but deterministic. A fraction
+    of the requests can be answered with 429 (limit exceeded) or 401 (unauthorized), and
+    after limit successful calls every request is answered with 429, like the real API's
+    hourly limit. Answers are delayed by the latency.
+"""
+class FakeTranslationServer(object):
+
+    def __init__(self, latency, limit_rate=0.0, unauthorized_rate=0.0, limit=None, seed=None):
+        # type: (Latency, float, float, int, int) -> None
+        self.latency = latency;
+        self.limit_rate = limit_rate;
+        self.unauthorized_rate = unauthorized_rate;
+        self.limit = limit;
+        self.statuses = Counter();
+        self._random = random.Random(seed);
+        self._lock = threading.Lock();
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handlerClass());
+        self._server.daemon_threads = True;
+        self._thread = None;
+
+    @property
+    def url(self):
+        # type: () -> String
+        # URL in the format of TRANSLATION_API_URL, with the language left to be added
+        return 'http://127.0.0.1:{}/translate/{{}}.json'.format(self._server.server_address[1]);
+
+    def _status(self):
+        # type: () -> int
+        with self._lock:
+            draw = self._random.random();
+            if draw < self.unauthorized_rate:
+                status = 401;
+            elif draw < self.unauthorized_rate + self.limit_rate:
+                status = 429;
+            elif self.limit is not None and self.statuses[200] >= self.limit:
+                status = 429;
+            else:
+                status = 200;
+            self.statuses[status] += 1;
+        return status;
+
+    def _handlerClass(self):
+        server = self;
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                server.latency.sleep();
+                request = urlparse(self.path);
+                text = parse_qs(request.query).get('text', [''])[0];
+                language = request.path.rsplit('/', 1)[-1].replace('.json', '');
+                status = server._status();
+                if status == 200:
+                    translated = ' '.join(word[::-1] for word in text.split());
+                    body = {'success': {'total': 1},
+                            'contents': {'translated': translated, 'text': text, 'translation': language}};
+                elif status == 429:
+                    body = {'error': {'code': 429, 'message': 'Too Many Requests: Rate limit of 5 requests per hour exceeded.'}};
+                else:
+                    body = {'error': {'code': 401, 'message': 'Unauthorized'}};
+                data = json.dumps(body).encode('utf-8');
+                self.send_response(status);
+                self.send_header('Content-Type', 'application/json');
+                self.send_header('Content-Length', str(len(data)));
+                self.end_headers();
+                self.wfile.write(data);
+
+            def log_message(self, format, *args):
+                pass;
+
+        return Handler;
+
+    def start(self):
+        # type: () -> FakeTranslationServer
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True);
+        self._thread.start();
+        return self;
+
+    def stop(self):
+        # type: () -> None
+        self._server.shutdown();
+        self._server.server_close();
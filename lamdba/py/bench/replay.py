@@ -0,0 +1,348 @@
+import argparse
+import contextlib
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from bench import fakes, runner
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+"""
+Replay load generator for the Fun Translate skill. Alexa request envelopes are read from
+a JSON lines file, one envelope per line, and sent to lambda_handler against the fakes in
+fakes.py, to work out the Lambda memory and concurrency settings offline.
+
+The file can be recorded (e.g. the request envelopes logged by the skill in CloudWatch) or
+synthesised with --synthesise, which writes sessions that go Launch, SetLanguage, one to
+three Translates each followed now and then by a Repeat or a ReplayPrevious, and then end.
+Requests are grouped into sessions by their session id and the requests of a session are
+sent one after the other, with the session attributes returned by each response passed on
+to the next request as Alexa would (unless --recorded-attributes is given).
+
+Sessions arrive at --rate sessions a second (as a Poisson process, or all at once with 0)
+and at most --concurrency are in progress at the same time. Every request is handled by a
+simulated Lambda container: an idle container is reused when there is one, otherwise
+lambda_function is imported afresh as a new module, which is timed as a cold start.
+Containers that have been idle for --container-idle-s are reclaimed, and with
+--max-containers requests that would need more containers are throttled, like a function
+with reserved concurrency. As the libraries the skill uses are only imported once per
+process, cold starts after the first only time the module itself.
+
+The report gives the throughput, the latency of each handler, the cold starts, the cache
+hit ratio over every container, the calls made to the fakes and the memory high-water mark
+of the process (and the peak traced by tracemalloc with --trace-memory).
+
+Usage (from the lamdba/py directory):
+    python -m bench.replay --synthesise 200
+    python -m bench.replay --concurrency 10 --rate 5 [--input bench/replay.jsonl]
+"""
+
+logger = logging.getLogger(__name__);
+
+DEFAULT_REPLAY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'replay.jsonl');
+
+""" Function used to write a synthetic replay file of the given number of sessions.
+"""
+def synthesise(path, sessions, model_path=runner.DEFAULT_MODEL, popular_ratio=0.7, seed=1):
+    # type: (String, int, String, float, int) -> int
+    mix = runner.RequestMix(model_path, popular_ratio, seed, None);
+    choices = random.Random(seed);
+    count = 0;
+    with open(path, 'w') as replay_file:
+        for number in range(sessions):
+            session_id = 'amzn1.echo-api.session.replay-{}'.format(number);
+            requests = [({'type': 'LaunchRequest'}, True),
+                        (runner.intentRequest('SetLanguageIntent', {'language': choices.choice(mix.languages)}), False)];
+            for translation in range(choices.randint(1, 3)):
+                requests.append((runner.intentRequest('TranslateIntent', {'sentence': mix.phrase()}), False));
+                if choices.random() < 0.5:
+                    requests.append((runner.intentRequest('AMAZON.RepeatIntent'), False));
+                if translation > 0 and choices.random() < 0.3:
+                    requests.append((runner.intentRequest('ReplayPreviousIntent'), False));
+            requests.append(({'type': 'SessionEndedRequest', 'reason': 'USER_INITIATED'}, False));
+            for request, new in requests:
+                event = runner.envelope(request, {}, new);
+                event['session']['sessionId'] = session_id;
+                event['session']['user']['userId'] = event['context']['System']['user']['userId'] = 'amzn1.ask.account.replay-{}'.format(number);
+                replay_file.write(json.dumps(event, separators=(',', ':')) + '\n');
+                count += 1;
+    return count;
+
+""" Function used to read a replay file. Returns an ordered dictionary of session id to the
+    list of envelopes of the session, in the order they were recorded.
+"""
+def loadReplay(path):
+    # type: (String) -> dict
+    sessions = OrderedDict();
+    with open(path) as replay_file:
+        for line in replay_file:
+            line = line.strip();
+            if line:
+                event = json.loads(line);
+                sessions.setdefault(event['session']['sessionId'], []).append(event);
+    return sessions;
+
+def requestName(event):
+    # type: (dict) -> String
+    request = event['request'];
+    return request['intent']['name'] if request['type'] == 'IntentRequest' else request['type'];
+
+""" A simulated Lambda container, holding its own copy of lambda_function.
+"""
+class Container(object):
+
+    def __init__(self, skill):
+        self.skill = skill;
+        self.requests = 0;
+        self.idle_since = time.time();
+
+    def retire(self):
+        # type: () -> None
+        # The thread pools of the module are shut down so that their threads are freed
+        for value in list(vars(self.skill).values()):
+            if isinstance(value, ThreadPoolExecutor):
+                value.shutdown(wait=False);
+
+""" Pool of simulated Lambda containers. A request takes an idle container if there is one,
+    otherwise a new one is started by importing lambda_function afresh, unless there are
+    already max_containers, in which case the request is throttled.
+"""
+class ContainerPool(object):
+
+    def __init__(self, loader, timings, idle_timeout, max_containers=None):
+        # type: (function, Timings, float, int) -> None
+        self.loader = loader;
+        self.timings = timings;
+        self.idle_timeout = idle_timeout;
+        self.max_containers = max_containers;
+        self.containers = [];
+        self.peak = 0;
+        self.throttled = 0;
+        self.reclaimed = 0;
+        self._idle = [];
+        self._busy = 0;
+        self._lock = threading.Lock();
+
+    def acquire(self):
+        # type: () -> Container
+        # Returns a container, or None if the request is throttled
+        with self._lock:
+            now = time.time();
+            expired = [container for container in self._idle if now - container.idle_since > self.idle_timeout];
+            self._idle = [container for container in self._idle if container not in expired];
+            self.reclaimed += len(expired);
+            if self._idle:
+                self._busy += 1;
+                self.peak = max(self.peak, self._busy);
+                return self._idle.pop();
+            if self.max_containers and self._busy >= self.max_containers:
+                self.throttled += 1;
+                return None;
+            self._busy += 1;
+            self.peak = max(self.peak, self._busy);
+        for container in expired:
+            container.retire();
+
+        start = time.perf_counter();
+        container = Container(self.loader());
+        self.timings.record('cold_starts', 'init', time.perf_counter() - start);
+        with self._lock:
+            self.containers.append(container);
+        return container;
+
+    def release(self, container):
+        # type: (Container) -> None
+        container.requests += 1;
+        container.idle_since = time.time();
+        with self._lock:
+            self._busy -= 1;
+            self._idle.append(container);
+
+    def cacheStats(self):
+        # type: () -> dict
+        # Cache counters added up over every container that was started
+        totals = OrderedDict((name, 0) for name in ('hits', 'negative_hits', 'misses', 'evictions', 'expirations'));
+        for container in self.containers:
+            stats = container.skill.translationCache.stats();
+            for name in totals:
+                totals[name] += stats[name];
+        lookups = totals['hits'] + totals['negative_hits'] + totals['misses'];
+        totals['hit_ratio'] = round(float(totals['hits'] + totals['negative_hits']) / lookups, 4) if lookups else 0.0;
+        return totals;
+
+    def close(self):
+        # type: () -> None
+        for container in self.containers:
+            container.retire();
+
+""" Function used to send one request to a container, followed by any asynchronous
+    invocations it made. Returns the response, or None if the request was throttled or failed.
+"""
+def invoke(pool, services, timings, event, timeout_ms):
+    # type: (ContainerPool, dict, Timings, dict, int) -> dict
+    name = requestName(event);
+    container = pool.acquire();
+    if container is None:
+        return None;
+    response = None;
+    try:
+        start = time.perf_counter();
+        try:
+            response = container.skill.lambda_handler(event, fakes.FakeContext(timeout_ms));
+        except Exception as e:
+            logger.debug("%s failed: %s", name, e);
+        timings.record('handlers', name, time.perf_counter() - start, response is None);
+
+        for deferred in services['lambdaClient'].drain():
+            start = time.perf_counter();
+            result = container.skill.lambda_handler(deferred, fakes.FakeContext(60000));
+            timings.record('handlers', 'DeferredTranslation', time.perf_counter() - start, bool(result.get('error')));
+    finally:
+        pool.release(container);
+    return response;
+
+""" Function used to play one session, passing the session attributes from each response on
+    to the next request.
+"""
+def playSession(pool, services, timings, events, timeout_ms, recorded_attributes=False):
+    # type: (ContainerPool, dict, Timings, list, int, bool) -> None
+    attributes = None;
+    for event in events:
+        event = json.loads(json.dumps(event));
+        if attributes is not None and not recorded_attributes:
+            event['session']['attributes'] = attributes;
+        event['request']['requestId'] = 'amzn1.echo-api.request.' + str(uuid.uuid4());
+        response = invoke(pool, services, timings, event, timeout_ms);
+        if response is not None:
+            attributes = response.get('sessionAttributes') or {};
+
+def maxRssMegabytes():
+    # type: () -> float
+    if resource is None:
+        return None;
+    # ru_maxrss is in kilobytes on Linux (and in bytes on macOS)
+    maximum = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss;
+    return round(maximum / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0), 1);
+
+""" Function used to run the replay and build the report.
+"""
+def run(args):
+    # type: (Namespace) -> dict
+    sessions = loadReplay(args.input);
+    if args.loops > 1:
+        sessions = OrderedDict(('{}#{}'.format(session_id, loop), events)
+                               for loop in range(args.loops) for session_id, events in sessions.items());
+    rss_before = maxRssMegabytes();
+    if args.trace_memory:
+        tracemalloc.start();
+
+    services, server = runner.startServices(args);
+    timings = runner.Timings();
+    arrivals = random.Random(args.seed);
+    delays = [];
+
+    def loader():
+        skill = runner.loadSkill(services, server, args, fresh=True);
+        runner.instrument(skill, timings);
+        return skill;
+
+    def session(scheduled, events):
+        delays.append((time.perf_counter() - scheduled) * 1000.0);
+        playSession(pool, services, timings, events, args.timeout_ms, args.recorded_attributes);
+
+    pool = ContainerPool(loader, timings, args.container_idle_s, args.max_containers);
+    # Anything the skill prints (e.g. its EMF metrics) is dropped, so the report is the
+    # only thing written to stdout
+    try:
+        started = time.perf_counter();
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), \
+             ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            scheduled = started;
+            for events in sessions.values():
+                if args.rate > 0:
+                    scheduled += arrivals.expovariate(args.rate);
+                    time.sleep(max(0.0, scheduled - time.perf_counter()));
+                executor.submit(session, time.perf_counter() if args.rate <= 0 else scheduled, events);
+        elapsed = time.perf_counter() - started;
+    finally:
+        server.stop();
+        pool.close();
+
+    requests = sum(len(events) for events in sessions.values());
+    memory = OrderedDict([('max_rss_mb', maxRssMegabytes()), ('rss_before_mb', rss_before)]);
+    if args.trace_memory:
+        memory['traced_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / (1024.0 * 1024.0), 1);
+        tracemalloc.stop();
+
+    return OrderedDict([
+        ('commit', runner.gitCommit()),
+        ('created', int(time.time())),
+        ('config', OrderedDict((name, value) for name, value in sorted(vars(args).items())
+                               if name not in ('output', 'synthesise'))),
+        ('sessions', len(sessions)),
+        ('requests', requests),
+        ('elapsed_s', round(elapsed, 3)),
+        ('throughput_rps', round(requests / elapsed, 3) if elapsed > 0 else None),
+        ('session_start_delay', runner.summarise(delays)),
+        ('handlers', timings.summary('handlers')),
+        ('functions', timings.summary('functions')),
+        ('containers', OrderedDict([
+            ('started', len(pool.containers)),
+            ('peak_concurrent', pool.peak),
+            ('reclaimed', pool.reclaimed),
+            ('throttled_requests', pool.throttled),
+            ('cold_start', timings.summary('cold_starts').get('init'))
+        ])),
+        ('calls', runner.serviceCalls(services, server)),
+        ('cache', pool.cacheStats()),
+        ('memory', memory)
+    ]);
+
+def parseArguments(argv=None):
+    parser = argparse.ArgumentParser(description='Replay Alexa requests against the Fun Translate skill with local fakes');
+    parser.add_argument('--input', default=DEFAULT_REPLAY, help='JSON lines file of request envelopes to replay');
+    parser.add_argument('--synthesise', type=int, metavar='SESSIONS', help='write this many synthetic sessions to --input and stop');
+    parser.add_argument('--popular-ratio', type=float, default=0.7, help='share of synthetic translations that are of popular phrases');
+    parser.add_argument('--model', default=runner.DEFAULT_MODEL, help='interaction model to take the languages from');
+    parser.add_argument('--loops', type=int, default=1, help='number of times to replay the file');
+    parser.add_argument('--concurrency', type=int, default=4, help='number of sessions in progress at the same time');
+    parser.add_argument('--rate', type=float, default=0.0, help='sessions started a second (0 to start them all at once)');
+    parser.add_argument('--container-idle-s', type=float, default=600, help='idle time after which a container is reclaimed');
+    parser.add_argument('--max-containers', type=int, help='containers allowed at once, further requests are throttled');
+    parser.add_argument('--recorded-attributes', action='store_true', help='send the session attributes in the file as they are');
+    parser.add_argument('--trace-memory', action='store_true', help='also report the peak traced by tracemalloc (slower)');
+    runner.addServiceArguments(parser);
+    parser.add_argument('--output', help='file to write the JSON report to, instead of stdout');
+    return parser.parse_args(argv);
+
+def main(argv=None):
+    args = parseArguments(argv);
+    if args.synthesise:
+        count = synthesise(args.input, args.synthesise, args.model, args.popular_ratio, args.seed);
+        print(json.dumps({'sessions': args.synthesise, 'requests': count, 'output': args.input}));
+        return 0;
+
+    output = json.dumps(run(args), indent=2);
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n');
+    else:
+        print(output);
+    return 0;
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING);
+    sys.exit(main());
@@ -0,0 +1,414 @@
+import argparse
+import functools
+import importlib.util
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from bench import fakes
+
+"""
+Offline benchmark of the Fun Translate skill. lambda_function is loaded against the fakes
+in fakes.py (Polly, S3, DynamoDB, Lambda and a local Fun Translations server) and
+lambda_handler is driven with synthetic Alexa request envelopes for every intent in the
+interaction model, plus the LaunchRequest and SessionEndedRequest.
+
+Translations are a mix of popular phrases, which are repeated and so mostly served from
+the cache or the table, and new phrases, which go through the whole pipeline. The
+latency of each fake and the share of 429 and 401 answers from the translation server
+can be set on the command line, as can the skill's own environment variables.
+
+The p50, p95 and p99 latencies are reported for each handler (by intent name or request
+type) and for each instrumented utility function, along with the number of calls made
+to every fake, as JSON. A previous report can be given with --baseline to compare
+against, in which case any p95 that got slower by more than --tolerance is listed and
+the exit code is 1, so that regressions between commits can be caught.
+
+Usage (from the lamdba/py directory):
+    python -m bench --iterations 200 --output bench.json [--baseline previous.json]
+"""
+
+logger = logging.getLogger(__name__);
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))));
+DEFAULT_MODEL = os.path.join(ROOT, 'model', 'en-GB.json');
+
+# Utility functions of lambda_function that are timed individually
+TIMED_FUNCTIONS = [
+    'translateToTarget', 'translatePhrase', 'callTranslationApi', 'synthesizeSpeech',
+    'audioExists', 'putFileIntoS3Bucket', 'uploadDetailsToDynamoDB', 'storeTranslation',
+    'queryDynamoDB'
+];
+TIMED_METHODS = [
+    ('translationStore', 'get'), ('translationStore', 'put'), ('translationStore', 'flush'),
+    ('rateLimiter', 'acquire'), ('translationFlights', 'join'), ('translationFlights', 'release')
+];
+
+POPULAR_PHRASES = [
+    'hello', 'good morning', 'how are you', 'thank you very much', 'where is the library',
+    'I love you', 'what is your name', 'good night', 'see you later', 'happy birthday'
+];
+WORDS = [
+    'dragon', 'castle', 'horse', 'river', 'winter', 'summer', 'sword', 'king', 'queen',
+    'friend', 'journey', 'mountain', 'forest', 'storm', 'fire', 'blood', 'gold', 'night'
+];
+
+""" Recorder of the latencies of every call, by group (handler or function) and name.
+"""
+class Timings(object):
+
+    def __init__(self):
+        self.samples = defaultdict(lambda: defaultdict(list));
+        self.errors = defaultdict(lambda: defaultdict(int));
+        self._lock = threading.Lock();
+
+    def record(self, group, name, seconds, failed=False):
+        # type: (String, String, float, bool) -> None
+        with self._lock:
+            self.samples[group][name].append(seconds * 1000.0);
+            if failed:
+                self.errors[group][name] += 1;
+
+    def wrap(self, group, name, function):
+        # type: (String, String, function) -> function
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = time.perf_counter();
+            failed = True;
+            try:
+                result = function(*args, **kwargs);
+                failed = False;
+                return result;
+            finally:
+                self.record(group, name, time.perf_counter() - start, failed);
+        return timed;
+
+    def summary(self, group):
+        # type: (String) -> dict
+        with self._lock:
+            names = sorted(self.samples[group].items());
+            return OrderedDict((name, summarise(values, self.errors[group][name])) for name, values in names);
+
+""" Function used to work out a percentile of a sorted list using the nearest rank.
+"""
+def percentile(ordered, fraction):
+    # type: (list, float) -> float
+    if not ordered:
+        return None;
+    rank = max(1, int(-(-fraction * len(ordered) // 1)));
+    return ordered[min(rank, len(ordered)) - 1];
+
+def summarise(values, errors=0):
+    # type: (list, int) -> dict
+    ordered = sorted(values);
+    return OrderedDict([
+        ('count', len(ordered)),
+        ('errors', errors),
+        ('mean_ms', round(sum(ordered) / len(ordered), 3) if ordered else None),
+        ('p50_ms', round(percentile(ordered, 0.50), 3) if ordered else None),
+        ('p95_ms', round(percentile(ordered, 0.95), 3) if ordered else None),
+        ('p99_ms', round(percentile(ordered, 0.99), 3) if ordered else None),
+        ('max_ms', round(ordered[-1], 3) if ordered else None)
+    ]);
+
+""" Function used to build an Alexa request envelope for a request, with the given
+    session attributes.
+"""
+def envelope(request, attributes=None, new=False):
+    # type: (dict, dict, bool) -> dict
+    request = dict(request, requestId='amzn1.echo-api.request.' + str(uuid.uuid4()),
+                   timestamp=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), locale='en-GB');
+    return {
+        'version': '1.0',
+        'session': {
+            'new': new,
+            'sessionId': 'amzn1.echo-api.session.bench',
+            'application': {'applicationId': 'amzn1.ask.skill.bench'},
+            'attributes': attributes or {},
+            'user': {'userId': 'amzn1.ask.account.bench'}
+        },
+        'context': {
+            'System': {
+                'application': {'applicationId': 'amzn1.ask.skill.bench'},
+                'user': {'userId': 'amzn1.ask.account.bench'},
+                'device': {'deviceId': 'amzn1.ask.device.bench', 'supportedInterfaces': {}},
+                'apiEndpoint': 'https://api.eu.amazonalexa.com'
+            }
+        },
+        'request': request
+    };
+
+def intentRequest(name, slots=None):
+    # type: (String, dict) -> dict
+    return {
+        'type': 'IntentRequest',
+        'intent': {
+            'name': name,
+            'confirmationStatus': 'NONE',
+            'slots': dict((slot, {'name': slot, 'value': value, 'confirmationStatus': 'NONE'})
+                          for slot, value in (slots or {}).items())
+        }
+    };
+
+""" Generator of the synthetic requests, one round of which covers every intent in the
+    interaction model.
+"""
+class RequestMix(object):
+
+    def __init__(self, model_path, popular_ratio, seed, key_function):
+        # type: (String, float, int, function) -> None
+        with open(model_path) as model_file:
+            model = json.load(model_file)['interactionModel']['languageModel'];
+        self.intents = [intent['name'] for intent in model['intents']];
+        self.languages = [];
+        for slot_type in model.get('types', []):
+            if slot_type['name'] == 'language':
+                self.languages = [value['name']['value'] for value in slot_type['values']];
+        self.popular_ratio = popular_ratio;
+        self.key_function = key_function;
+        self._random = random.Random(seed);
+        self._count = 0;
+
+    def phrase(self):
+        # type: () -> String
+        if self._random.random() < self.popular_ratio:
+            return self._random.choice(POPULAR_PHRASES);
+        self._count += 1;
+        return '{} {} {}'.format(self._random.choice(WORDS), self._random.choice(WORDS), self._count);
+
+    def round(self):
+        # type: () -> list
+        # Returns a list of (handler name, envelope) covering every request type once
+        # The session attributes are the ones the skill would have set by then, so the
+        # phrase is translated into the language set and repeated afterwards
+        language = self._random.choice(self.languages);
+        attributes = {'state': 'Language Set', 'language': language, 'last file key': None};
+        requests = [('LaunchRequest', envelope({'type': 'LaunchRequest'}, new=True))];
+        for name in self.intents:
+            if name == 'TranslateIntent':
+                sentence = self.phrase();
+                slots = {'sentence': sentence};
+                attributes['last file key'] = self.key_function(sentence, language.lower().replace(' ', ''));
+            elif name == 'SetLanguageIntent':
+                slots = {'language': language};
+            else:
+                slots = None;
+            requests.append((name, envelope(intentRequest(name, slots), dict(attributes) if name != 'TranslateIntent' else dict(attributes, **{'last file key': None}))));
+        requests.append(('SessionEndedRequest', envelope({'type': 'SessionEndedRequest', 'reason': 'USER_INITIATED'}, dict(attributes))));
+        return requests;
+
+""" Function used to start the fakes, with the latencies and error rates given on the
+    command line. Returns the fake services, by the name of the client they replace in
+    lambda_function, and the translation server, which has to be stopped afterwards.
+"""
+def startServices(args):
+    # type: (Namespace) -> tuple
+    table = fakes.FakeTable(fakes.Latency(args.dynamodb_ms, args.jitter, args.seed));
+    services = OrderedDict([
+        ('polly', fakes.FakePolly(fakes.Latency(args.polly_ms, args.jitter, args.seed))),
+        ('s3', fakes.FakeS3(fakes.Latency(args.s3_ms, args.jitter, args.seed))),
+        ('dynamoDB', fakes.FakeDynamoDB(table)),
+        ('table', table),
+        ('lambdaClient', fakes.FakeLambda())
+    ]);
+    server = fakes.FakeTranslationServer(fakes.Latency(args.api_ms, args.jitter, args.seed),
+                                         args.api_429_rate, args.api_401_rate, args.api_limit, args.seed).start();
+    return services, server;
+
+""" Function used to report the calls made to every fake.
+"""
+def serviceCalls(services, server):
+    # type: (dict, FakeTranslationServer) -> dict
+    return OrderedDict([
+        ('polly', dict(services['polly'].calls)),
+        ('s3', dict(services['s3'].calls)),
+        ('dynamodb', dict(services['table'].calls)),
+        ('lambda', dict(services['lambdaClient'].calls)),
+        ('translation_api', dict((str(status), count) for status, count in server.statuses.items()))
+    ]);
+
+""" Function used to load lambda_function with its clients replaced by the fakes. The
+    environment has to be set up before the module is imported, and the fakes are put
+    inside the lazy singletons so that everything holding a reference to them uses them.
+    With fresh, the module is run again as a new module object, as it would be in a new
+    Lambda container, rather than taken from sys.modules.
+"""
+def loadSkill(services, server, args, fresh=False):
+    # type: (dict, FakeTranslationServer, Namespace, bool) -> module
+    os.environ.setdefault('ftbucket', 'fun-translate-bench');
+    os.environ.setdefault('ftDB', services['table'].name);
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-1');
+    os.environ.setdefault('AWS_LAMBDA_FUNCTION_NAME', 'fun-translate-bench');
+    os.environ.setdefault('ftRateLimit', 'true' if args.rate_limit else 'false');
+    os.environ.setdefault('ftLogLevel', 'WARNING');
+    os.environ['ftTranslationApiUrl'] = server.url;
+    for setting in args.env or []:
+        name, _, value = setting.partition('=');
+        os.environ[name] = value;
+
+    directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)));
+    if directory not in sys.path:
+        sys.path.insert(0, directory);
+    if fresh:
+        spec = importlib.util.spec_from_file_location('lambda_function', os.path.join(directory, 'lambda_function.py'));
+        lambda_function = importlib.util.module_from_spec(spec);
+        spec.loader.exec_module(lambda_function);
+    else:
+        import lambda_function;
+    for name, fake in services.items():
+        getattr(lambda_function, name)._instance = fake;
+    return lambda_function;
+
+""" Function used to time the utility functions and store methods of the skill. Handlers
+    look the functions up in the module when they are called, so replacing them in the
+    module is enough.
+"""
+def instrument(skill, timings):
+    # type: (module, Timings) -> None
+    for name in TIMED_FUNCTIONS:
+        if hasattr(skill, name):
+            setattr(skill, name, timings.wrap('functions', name, getattr(skill, name)));
+    for owner, method in TIMED_METHODS:
+        instance = getattr(skill, owner, None);
+        if instance is not None and hasattr(instance, method):
+            setattr(instance, method, timings.wrap('functions', '{}.{}'.format(owner, method), getattr(instance, method)));
+
+""" Function used to send one request to lambda_handler, followed by any asynchronous
+    invocations it made.
+"""
+def invoke(skill, services, timings, name, event, timeout_ms):
+    # type: (module, dict, Timings, String, dict, int) -> None
+    start = time.perf_counter();
+    failed = False;
+    try:
+        skill.lambda_handler(event, fakes.FakeContext(timeout_ms));
+    except Exception as e:
+        logger.debug("%s failed: %s", name, e);
+        failed = True;
+    timings.record('handlers', name, time.perf_counter() - start, failed);
+
+    for deferred in services['lambdaClient'].drain():
+        start = time.perf_counter();
+        result = skill.lambda_handler(deferred, fakes.FakeContext(60000));
+        timings.record('handlers', 'DeferredTranslation', time.perf_counter() - start, bool(result.get('error')));
+
+""" Function used to compare a report with a baseline report, returning the list of
+    handlers and functions whose p95 latency got worse by more than the tolerance.
+"""
+def compare(report, baseline, tolerance):
+    # type: (dict, dict, float) -> list
+    regressions = [];
+    for group in ('handlers', 'functions'):
+        for name, current in report[group].items():
+            previous = baseline.get(group, {}).get(name);
+            if not previous or not previous.get('p95_ms') or current['p95_ms'] is None:
+                continue;
+            change = (current['p95_ms'] - previous['p95_ms']) / previous['p95_ms'];
+            if change > tolerance:
+                regressions.append(OrderedDict([('group', group), ('name', name),
+                                                ('baseline_p95_ms', previous['p95_ms']),
+                                                ('p95_ms', current['p95_ms']),
+                                                ('change', round(change, 3))]));
+    return regressions;
+
+def gitCommit():
+    # type: () -> String
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL).decode('ascii').strip();
+    except Exception:
+        return None;
+
+""" Function used to run the benchmark and build the report.
+"""
+def run(args):
+    # type: (Namespace) -> dict
+    services, server = startServices(args);
+    try:
+        skill = loadSkill(services, server, args);
+        timings = Timings();
+        instrument(skill, timings);
+        mix = RequestMix(args.model, args.popular_ratio, args.seed, skill.canonicalKey);
+        requests = [request for _ in range(args.iterations) for request in mix.round()];
+
+        started = time.perf_counter();
+        if args.concurrency > 1:
+            with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                list(pool.map(lambda request: invoke(skill, services, timings, request[0], request[1], args.timeout_ms), requests));
+        else:
+            for name, event in requests:
+                invoke(skill, services, timings, name, event, args.timeout_ms);
+        elapsed = time.perf_counter() - started;
+    finally:
+        server.stop();
+
+    return OrderedDict([
+        ('commit', gitCommit()),
+        ('created', int(time.time())),
+        ('config', OrderedDict((name, value) for name, value in sorted(vars(args).items())
+                               if name not in ('output', 'baseline'))),
+        ('requests', len(requests)),
+        ('elapsed_s', round(elapsed, 3)),
+        ('throughput_rps', round(len(requests) / elapsed, 3) if elapsed > 0 else None),
+        ('handlers', timings.summary('handlers')),
+        ('functions', timings.summary('functions')),
+        ('calls', serviceCalls(services, server)),
+        ('cache', skill.translationCache.stats()),
+        ('circuits', OrderedDict((name, breaker.stats()) for name, breaker in skill.circuitBreakers.items()))
+    ]);
+
+""" Function used to add the options for the fakes and the skill's environment, which are
+    shared with the replay load generator.
+"""
+def addServiceArguments(parser):
+    # type: (ArgumentParser) -> None
+    parser.add_argument('--timeout-ms', type=int, default=8000, help='remaining time given to each invocation');
+    parser.add_argument('--api-ms', type=float, default=300, help='latency of the translation API');
+    parser.add_argument('--api-429-rate', type=float, default=0.0, help='share of API requests answered with 429');
+    parser.add_argument('--api-401-rate', type=float, default=0.0, help='share of API requests answered with 401');
+    parser.add_argument('--api-limit', type=int, default=None, help='successful API calls before every request gets 429');
+    parser.add_argument('--polly-ms', type=float, default=150, help='latency of Polly');
+    parser.add_argument('--s3-ms', type=float, default=40, help='latency of S3');
+    parser.add_argument('--dynamodb-ms', type=float, default=8, help='latency of DynamoDB');
+    parser.add_argument('--jitter', type=float, default=0.2, help='fraction of random variation in every latency');
+    parser.add_argument('--seed', type=int, default=1, help='seed for the request mix and latencies');
+    parser.add_argument('--rate-limit', action='store_true', help="keep the skill's own rate limiter on");
+    parser.add_argument('--env', action='append', metavar='NAME=VALUE', help='environment variable for the skill, can be repeated');
+
+def parseArguments(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Fun Translate skill against local fakes');
+    parser.add_argument('--iterations', type=int, default=100, help='number of rounds of every intent to send');
+    parser.add_argument('--concurrency', type=int, default=1, help='number of requests sent at the same time');
+    parser.add_argument('--popular-ratio', type=float, default=0.7, help='share of translations that are of popular phrases');
+    parser.add_argument('--model', default=DEFAULT_MODEL, help='interaction model to take the intents from');
+    addServiceArguments(parser);
+    parser.add_argument('--output', help='file to write the JSON report to, instead of stdout');
+    parser.add_argument('--baseline', help='previous JSON report to compare the p95 latencies with');
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed p95 slow down compared with the baseline');
+    return parser.parse_args(argv);
+
+def main(argv=None):
+    args = parseArguments(argv);
+    report = run(args);
+
+    status = 0;
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            report['regressions'] = compare(report, json.load(baseline_file), args.tolerance);
+        status = 1 if report['regressions'] else 0;
+
+    output = json.dumps(report, indent=2);
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n');
+    else:
+        print(output);
+    return status;
@@ -0,0 +1,103 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import snapshot
+from lambda_function import TranslationStore, bucketName, s3, translationStore
+
+"""
+Export job that writes the most requested translations in the DynamoDB table into a
+hot-phrase snapshot file (see snapshot.py), which containers then check before DynamoDB.
+
+Entries are ranked by their access_count attribute where the table has one, plus any
+counts given in a JSON lines file with --counts ({"key": ..., "count": ...} per line,
+e.g. exported from the CloudWatch logs). Internal items such as the rate limiter's bucket,
+items without an audio url and translations made by a fallback engine are never included.
+
+The job can be run from the command line, writing the snapshot to a local file to be
+bundled with the deployment package and/or uploading it to the S3 bucket, or on a
+schedule as a Lambda function through lambda_handler, which always uploads it.
+The generation of each snapshot is the time it was exported, so newer snapshots always
+have a higher generation.
+
+Usage (with the same ftbucket and ftDB environment variables as the Lambda function):
+    python export_snapshot.py --top 1000 --output hot_phrases.snap [--upload] [--counts counts.jsonl]
+"""
+
+logger = logging.getLogger(__name__);
+
+KEY_NAME = TranslationStore.KEY_NAME;
+DEFAULT_S3_KEY = 'snapshots/hot_phrases.snap';
+
+""" Function used to read the optional file of access counts.
+"""
+def loadCounts(path):
+    # type: (String) -> dict
+    counts = {};
+    with open(path) as counts_file:
+        for line in counts_file:
+            line = line.strip();
+            if line:
+                record = json.loads(line);
+                counts[record['key']] = counts.get(record['key'], 0) + int(record.get('count', 1));
+    return counts;
+
+""" Function used to pick the top entries of the table. Returns a list of
+    (key, translation, url) tuples, most requested first.
+"""
+def selectHotPhrases(top, counts=None):
+    # type: (int, dict) -> list
+    counts = counts or {};
+    ranked = [];
+    for item in translationStore.scan():
+        key = item[KEY_NAME];
+        value = item.get('value') or {};
+        if not value.get('url') or value.get('fallback'):
+            continue;
+        score = int(item.get('access_count', 0)) + counts.get(key, 0);
+        ranked.append((score, key, value.get('translation', ''), value['url']));
+    ranked.sort(key=lambda entry: (-entry[0], entry[1]));
+    return [(key, translation, url) for score, key, translation, url in ranked[:top]];
+
+""" Function used to export the snapshot to a local file and optionally upload it to S3.
+"""
+def export(top, output, upload=False, s3_key=DEFAULT_S3_KEY, counts=None):
+    # type: (int, String, bool, String, dict) -> dict
+    entries = selectHotPhrases(top, counts);
+    generation = int(time.time());
+    size = snapshot.writeSnapshot(output, entries, generation);
+    if upload:
+        with open(output, 'rb') as snapshot_file:
+            s3.put_object(Bucket=bucketName, Key=s3_key, Body=snapshot_file);
+    return {'entries': len(entries), 'bytes': size, 'generation': generation,
+            'output': output, 's3_key': s3_key if upload else None};
+
+""" Handler used when the export is run on a schedule as a Lambda function. The number
+    of entries and S3 key can be set with the ftSnapshotTop and ftSnapshotS3Key
+    environment variables.
+"""
+def lambda_handler(event, context):
+    result = export(int(os.environ.get('ftSnapshotTop', '1000')), '/tmp/hot_phrases.snap', True,
+                    os.environ.get('ftSnapshotS3Key', DEFAULT_S3_KEY));
+    logger.info(json.dumps(result));
+    return result;
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export the most requested Fun Translate phrases to a snapshot file');
+    parser.add_argument('--top', type=int, default=1000, help='number of phrases to include');
+    parser.add_argument('--output', default='hot_phrases.snap', help='path of the snapshot file to write');
+    parser.add_argument('--upload', action='store_true', help='also upload the snapshot to the S3 bucket');
+    parser.add_argument('--s3-key', default=DEFAULT_S3_KEY, help='object key to upload the snapshot to');
+    parser.add_argument('--counts', help='JSON lines file of extra access counts');
+    args = parser.parse_args(argv);
+
+    counts = loadCounts(args.counts) if args.counts else None;
+    print(json.dumps(export(args.top, args.output, args.upload, args.s3_key, counts)));
+    return 0;
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO);
+    sys.exit(main());
@@ -1,20 +1,95 @@
+import contextvars
 import json
 import logging
-import boto3
-from botocore.vendored import requests
-from boto3.dynamodb.conditions import Key
+import importlib
 import io
 import sys
 import os
 import hashlib
+import random
+import re
+import threading
+import time
+import unicodedata
+import uuid
 
-from contextlib import closing
-from ask_sdk_core.skill_builder import SkillBuilder
-from ask_sdk_core.handler_input import HandlerInput
-from ask_sdk_core.dispatch_components import (
-    AbstractRequestHandler, AbstractExceptionHandler,
-    AbstractResponseInterceptor, AbstractRequestInterceptor)
-from ask_sdk_core.utils import is_intent_name, is_request_type, get_slot_value
+from collections import Counter, OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import closing, contextmanager
+from decimal import Decimal
+from urllib.parse import quote
+from xml.sax.saxutils import escape
+
+""" Record of where the time goes when a new container is started, i.e. how long each
+    of the heavier modules takes to import and how long each AWS client takes to create.
+    Timings are always recorded as this is cheap, but they are only logged when the
+    optional ftColdStartReport environment variable is set to "true". The report is
+    logged as a single JSON line once the first response of the container has been
+    built, and any clients created after that are logged individually.
+"""
+class ColdStartReport(object):
+    
+    def __init__(self, enabled):
+        # type: (bool) -> None
+        self.enabled = enabled;
+        self.started = time.time();
+        self.module_ready = None;
+        self.timings = OrderedDict([('imports', OrderedDict()), ('clients', OrderedDict())]);
+        self.reported = False;
+        self._lock = threading.Lock();
+    
+    @contextmanager
+    def measure(self, category, name):
+        # type: (String, String) -> None
+        start = time.time();
+        try:
+            yield;
+        finally:
+            self.record(category, name, time.time() - start);
+    
+    def record(self, category, name, seconds):
+        # type: (String, String, float) -> None
+        with self._lock:
+            self.timings.setdefault(category, OrderedDict())[name] = round(seconds * 1000, 3);
+            reported = self.reported;
+        if self.enabled and reported:
+            logging.getLogger(__name__).info(json.dumps({'cold_start': {category: {name: round(seconds * 1000, 3)}}}));
+    
+    def summary(self):
+        # type: () -> dict
+        with self._lock:
+            timings = dict((category, dict(values)) for category, values in self.timings.items());
+        return {
+            'module_init_ms': round(((self.module_ready or time.time()) - self.started) * 1000, 3),
+            'import_ms': timings.get('imports', {}),
+            'client_init_ms': timings.get('clients', {})
+        };
+    
+    def report(self):
+        # type: () -> None
+        # Logs the report the first time it is called when reporting is enabled
+        with self._lock:
+            if not self.enabled or self.reported:
+                return;
+            self.reported = True;
+        logging.getLogger(__name__).info(json.dumps({'cold_start': self.summary()}));
+
+coldStartReport = ColdStartReport(os.environ.get('ftColdStartReport', 'false').lower() == 'true');
+
+with coldStartReport.measure('imports', 'ask_sdk_core'):
+    from ask_sdk_core.skill_builder import SkillBuilder
+    from ask_sdk_core.handler_input import HandlerInput
+    from ask_sdk_core.dispatch_components import (
+        AbstractRequestHandler, AbstractExceptionHandler,
+        AbstractResponseInterceptor, AbstractRequestInterceptor)
+    from ask_sdk_core.utils import is_intent_name, is_request_type, get_slot_value
+
+with coldStartReport.measure('imports', 'piglatin'):
+    import piglatin
+with coldStartReport.measure('imports', 'shakespeare'):
+    import shakespeare
+with coldStartReport.measure('imports', 'snapshot'):
+    import snapshot
 
 """
 REVISION MADE: 3/9/2019 by Divya Vaidya
@@ -24,6 +99,44 @@ FunTranslateIntentHandler, NoTargetLanguageIntentHandler and RepeatIntentHandler
 to stop the skill from being exited prematurely.
 """
 
+""" Lazily constructed, thread-safe singleton. The object is only created, by calling
+    the factory function, the first time it is used, so requests that never touch AWS
+    (e.g. LaunchRequest, HelpIntent and SessionEndedRequest) do not pay for creating the
+    boto3 clients on a cold container. Attribute access is passed through to the created
+    object, so a LazySingleton can be used in exactly the same way as the object itself.
+    Its own methods are given unusual names so that they do not hide those of the object.
+    A single lock is shared by all singletons as creating boto3 clients from the default
+    session is not thread-safe, and it is re-entrant as some factories use other singletons.
+"""
+class LazySingleton(object):
+    
+    _lock = threading.RLock();
+    
+    def __init__(self, name, factory, category='clients'):
+        # type: (String, function, String) -> None
+        self._name = name;
+        self._factory = factory;
+        self._category = category;
+        self._instance = None;
+    
+    def lazyInstance(self):
+        # type: () -> object
+        instance = self._instance;
+        if instance is None:
+            with LazySingleton._lock:
+                if self._instance is None:
+                    with coldStartReport.measure(self._category, self._name):
+                        self._instance = self._factory();
+                instance = self._instance;
+        return instance;
+    
+    def lazyCreated(self):
+        # type: () -> bool
+        return self._instance is not None;
+    
+    def __getattr__(self, attribute):
+        return getattr(self.lazyInstance(), attribute);
+
 # Initialising clients and resources required for AWS products used within the application 
 # as well as the required environment variables
 # External products/APIs used:
@@ -33,17 +146,260 @@ to stop the skill from being exited prematurely.
 # DynamoDB: Used to store all previously translated phrases (alongside the language they have been translated to)
 # DynamoDB (Cont'd): so that the phrases do not have to be translated over and over again
 # The DynamoDB resource was used instead of the client so the .Table method could be used
-polly = boto3.client('polly');
-s3 = boto3.client('s3');
-dynamoDB = boto3.resource('dynamodb');
+# The boto3 module, the clients and the HTTP connection pool are all only loaded when first used.
+# The connection pool keeps the connection to the Fun Translations API open between
+# invocations of a warm container, so the TLS handshake is not repeated for every call.
+boto3 = LazySingleton('boto3', lambda: importlib.import_module('boto3'), 'imports');
+urllib3 = LazySingleton('urllib3', lambda: importlib.import_module('urllib3'), 'imports');
+httpPool = LazySingleton('http', lambda: urllib3.PoolManager(num_pools=2, maxsize=4, retries=False));
+polly = LazySingleton('polly', lambda: boto3.client('polly'));
+lambdaClient = LazySingleton('lambda', lambda: boto3.client('lambda'));
+s3 = LazySingleton('s3', lambda: boto3.client('s3'));
+dynamoDB = LazySingleton('dynamodb', lambda: boto3.resource('dynamodb'));
 bucketName = os.environ['ftbucket'];
-table = dynamoDB.Table(os.environ['ftDB']);
+table = LazySingleton('table', lambda: dynamoDB.Table(os.environ['ftDB']));
 
 # Skill Builder object
 sb = SkillBuilder();
 
 logger = logging.getLogger(__name__);
-logger.setLevel(logging.INFO);
+logger.setLevel(os.environ.get('ftLogLevel', 'INFO').upper());
+
+""" Per-request timings of each stage of the skill (e.g. looking the phrase up in the
+    cache, calling the translation API or uploading the audio), emitted as one line of
+    CloudWatch embedded metric format (EMF) JSON per request so that CloudWatch turns
+    them into metrics without any calls to the CloudWatch API.
+    
+    A record is started for a request by begin and stages are timed with the stage
+    context manager from anywhere in the code, as the record is kept in a context
+    variable. Requests that are not sampled have no record, so timing a stage costs
+    next to nothing for them. Records are tagged with dimensions such as the intent,
+    language and whether the phrase was found in the cache.
+"""
+class StageMetrics(object):
+    
+    DIMENSIONS = ('Intent', 'Language', 'Cache');
+    
+    def __init__(self, enabled, sample_rate, namespace):
+        # type: (bool, float, String) -> None
+        self.enabled = enabled;
+        self.sample_rate = sample_rate;
+        self.namespace = namespace;
+        self._current = contextvars.ContextVar('ftStageMetrics', default=None);
+        self._lock = threading.Lock();
+    
+    def begin(self, intent):
+        # type: (String) -> dict
+        # Starts the record of the current request, if it is sampled
+        if not self.enabled or random.random() >= self.sample_rate:
+            self._current.set(None);
+            return None;
+        record = {'start': time.time(), 'stages': OrderedDict(), 'tags': {'Intent': intent}};
+        self._current.set(record);
+        return record;
+    
+    @contextmanager
+    def stage(self, name):
+        # type: (String) -> None
+        record = self._current.get();
+        if record is None:
+            yield;
+            return;
+        start = time.time();
+        try:
+            yield;
+        finally:
+            self.record(name, time.time() - start, record);
+    
+    def record(self, name, seconds, record=None):
+        # type: (String, float, dict) -> None
+        # Stages that run more than once in a request are added together
+        record = record or self._current.get();
+        if record is not None:
+            with self._lock:
+                record['stages'][name] = record['stages'].get(name, 0.0) + round(seconds * 1000, 3);
+    
+    def tag(self, **tags):
+        # type: (**String) -> None
+        record = self._current.get();
+        if record is not None:
+            record['tags'].update(tags);
+    
+    def emit(self):
+        # type: () -> None
+        # Writes the record of the current request to stdout as EMF JSON and ends it
+        record = self._current.get();
+        if record is None:
+            return;
+        self._current.set(None);
+        self.record('handler_dispatch', time.time() - record['start'], record);
+        with self._lock:
+            stages = dict(record['stages']);
+        dimensions = [name for name in StageMetrics.DIMENSIONS if record['tags'].get(name) is not None];
+        line = {
+            '_aws': {
+                'Timestamp': int(record['start'] * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [dimensions],
+                    'Metrics': [{'Name': name, 'Unit': 'Milliseconds'} for name in stages]
+                }]
+            }
+        };
+        line.update((name, str(value)) for name, value in record['tags'].items() if value is not None);
+        line.update(stages);
+        sys.stdout.write(json.dumps(line) + '\n');
+        sys.stdout.flush();
+
+# Stage metrics are off by default and can be turned on by setting the optional ftMetrics
+# environment variable to "true". ftMetricsSampleRate is the fraction of requests that are
+# measured, between 0 and 1, and ftMetricsNamespace the CloudWatch namespace they go into.
+stageMetrics = StageMetrics(os.environ.get('ftMetrics', 'false').lower() == 'true',
+                            float(os.environ.get('ftMetricsSampleRate', '1')),
+                            os.environ.get('ftMetricsNamespace', 'FunTranslate'));
+
+""" Circuit breaker for one of the services the skill depends on, shared by every
+    invocation in the container. After failure_threshold failures in a row the circuit
+    opens and calls to the service are refused straight away, so that invocations fail
+    fast (or take another path) instead of each one waiting for the service to time out.
+    Once reset_seconds have passed a single call is let through as a probe (half-open),
+    and the circuit closes again if it succeeds or opens for another reset_seconds if not.
+    
+    Callers ask allow before making a call and report the outcome with success or
+    failure. Errors that show the service is up, such as a missing object or a failed
+    condition, count as successes. Every change of state is logged and, when stage
+    metrics are on, written as an EMF line with the Dependency dimension, along with the
+    number of calls refused since the last change, so that open circuits can be alarmed on.
+"""
+class CircuitBreaker(object):
+    
+    CLOSED = 'closed';
+    HALF_OPEN = 'half_open';
+    OPEN = 'open';
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2};
+    
+    def __init__(self, name, failure_threshold, reset_seconds, enabled=True):
+        # type: (String, int, float, bool) -> None
+        self.name = name;
+        self.failure_threshold = failure_threshold;
+        self.reset_seconds = reset_seconds;
+        self.enabled = enabled;
+        self.state = CircuitBreaker.CLOSED;
+        self.failures = 0;
+        self.opened_at = 0.0;
+        self.trips = 0;
+        self.rejected = 0;
+        self._rejected_since_change = 0;
+        self._probe_started = None;
+        self._lock = threading.Lock();
+    
+    def _transition(self, state):
+        # type: (String) -> None
+        # Called with the lock held
+        self.state = state;
+        self._probe_started = None;
+        rejected, self._rejected_since_change = self._rejected_since_change, 0;
+        logger.warning("Circuit for %s is now %s (%d calls refused)", self.name, state, rejected);
+        if stageMetrics.enabled:
+            line = {
+                '_aws': {
+                    'Timestamp': int(time.time() * 1000),
+                    'CloudWatchMetrics': [{
+                        'Namespace': stageMetrics.namespace,
+                        'Dimensions': [['Dependency']],
+                        'Metrics': [{'Name': 'CircuitState', 'Unit': 'None'},
+                                    {'Name': 'CircuitRejected', 'Unit': 'Count'}]
+                    }]
+                },
+                'Dependency': self.name,
+                'CircuitState': CircuitBreaker.STATE_VALUES[state],
+                'CircuitRejected': rejected
+            };
+            sys.stdout.write(json.dumps(line) + '\n');
+            sys.stdout.flush();
+    
+    def allow(self):
+        # type: () -> bool
+        # Returns True if the call can be made, taking the probe if the circuit is half-open
+        if not self.enabled:
+            return True;
+        with self._lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True;
+            now = time.time();
+            if self.state == CircuitBreaker.OPEN and now - self.opened_at >= self.reset_seconds:
+                self._transition(CircuitBreaker.HALF_OPEN);
+            # A probe that never reported back (e.g. because its invocation timed out) is
+            # replaced after reset_seconds
+            if self.state == CircuitBreaker.HALF_OPEN and (self._probe_started is None or now - self._probe_started >= self.reset_seconds):
+                self._probe_started = now;
+                return True;
+            self.rejected += 1;
+            self._rejected_since_change += 1;
+            return False;
+    
+    def isOpen(self):
+        # type: () -> bool
+        # Returns True if a call would be refused right now, without taking the probe
+        if not self.enabled:
+            return False;
+        with self._lock:
+            now = time.time();
+            if self.state == CircuitBreaker.OPEN:
+                return now - self.opened_at < self.reset_seconds;
+            if self.state == CircuitBreaker.HALF_OPEN:
+                return self._probe_started is not None and now - self._probe_started < self.reset_seconds;
+            return False;
+    
+    def success(self):
+        # type: () -> None
+        if not self.enabled:
+            return;
+        with self._lock:
+            self.failures = 0;
+            if self.state != CircuitBreaker.CLOSED:
+                self._transition(CircuitBreaker.CLOSED);
+    
+    def failure(self):
+        # type: () -> None
+        if not self.enabled:
+            return;
+        with self._lock:
+            self.failures += 1;
+            if self.state == CircuitBreaker.HALF_OPEN or (self.state == CircuitBreaker.CLOSED and self.failures >= self.failure_threshold):
+                self.opened_at = time.time();
+                self.trips += 1;
+                self._transition(CircuitBreaker.OPEN);
+    
+    def stats(self):
+        # type: () -> dict
+        with self._lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'trips': self.trips,
+                'rejected': self.rejected
+            };
+
+# Circuit breakers are on by default and can be turned off by setting the optional
+# ftCircuitBreakers environment variable to "false". A circuit opens after
+# ftBreakerFailures failures in a row and lets a probe through ftBreakerResetSeconds later.
+circuitBreakersEnabled = os.environ.get('ftCircuitBreakers', 'true').lower() == 'true';
+circuitBreakers = OrderedDict();
+
+""" Function used to create the circuit breaker for a service, which is kept in
+    circuitBreakers so that the state of every circuit can be reported.
+"""
+def circuitBreaker(name):
+    # type: (String) -> CircuitBreaker
+    breaker = CircuitBreaker(name, int(os.environ.get('ftBreakerFailures', '5')),
+                             float(os.environ.get('ftBreakerResetSeconds', '30')), circuitBreakersEnabled);
+    circuitBreakers[name] = breaker;
+    return breaker;
+
+pollyBreaker = circuitBreaker('polly');
+s3Breaker = circuitBreaker('s3');
+dynamodbBreaker = circuitBreaker('dynamodb');
 
 
 # Initialising dictionary containing the Polly voices to be used for text-to-speech synthesis for each relevant language
@@ -53,6 +409,1425 @@ voices = {
             'shakespeare': 'Brian'
          };
 
+# Dictionary of the languages that are translated locally, mapped to the function used
+# to translate them. These languages are never sent to the Fun Translations API, so
+# they are not affected by its call limit.
+localEngines = {
+                    'piglatin': piglatin.translate
+               };
+
+# Dictionary of the local engines used when a language could not be translated by the
+# API, e.g. when its call limit has been exceeded, so that a translation can still be given.
+fallbackEngines = {
+                    'shakespeare': shakespeare.translate
+                  };
+
+# The Shakespeare engine is only used as a fallback by default. Setting the optional
+# ftShakespeareMode environment variable to "primary" translates it locally every time.
+if os.environ.get('ftShakespeareMode', 'fallback').lower() == 'primary':
+    localEngines['shakespeare'] = shakespeare.translate;
+
+
+# The translation can be given back either as an audio file synthesised by Polly and
+# stored in S3 ("audio", the default), or spoken by Alexa directly using the SSML voice
+# tag ("ssml"), set through the optional ftResponseMode environment variable. Only
+# Polly voices that Alexa supports in the voice tag can be used in SSML mode, languages
+# with any other voice (e.g. Zeina for Dothraki) always fall back to the audio file.
+responseMode = os.environ.get('ftResponseMode', 'audio').lower();
+ALEXA_SSML_VOICES = frozenset([
+                        'Aditi', 'Amy', 'Bianca', 'Brian', 'Camila', 'Carla', 'Celine', 'Chantal',
+                        'Conchita', 'Emma', 'Enrique', 'Giorgio', 'Hans', 'Ivy', 'Joanna', 'Joey',
+                        'Justin', 'Kendra', 'Kimberly', 'Lea', 'Lucia', 'Lupe', 'Marlene',
+                        'Mathieu', 'Matthew', 'Mia', 'Miguel', 'Mizuki', 'Nicole', 'Penelope',
+                        'Raveena', 'Ricardo', 'Russell', 'Salli', 'Takumi', 'Vicki', 'Vitoria'
+                    ]);
+
+# Delimiter placed between the canonical sentence and the language in a key. As all
+# punctuation and symbols are removed from the sentence, it can never appear within it.
+KEY_DELIMITER = '|';
+
+# Apostrophes are removed from words ("don't" -> "dont") rather than splitting them
+APOSTROPHES = u"'\u2019\u2018`";
+
+""" Function used to reduce a sentence to the canonical form used in keys, so that
+    different ways of saying or transcribing the same phrase share one translation.
+    The sentence is Unicode normalised (NFKC) and case folded, apostrophes are removed,
+    all other punctuation and symbols are treated as spaces, and runs of whitespace are
+    collapsed into a single space. "Hello, World!" and "hello   world" both become
+    "hello world", while "a part" and "apart" are still kept apart.
+"""
+def canonicalSentence(sentence):
+    # type: (String) -> String
+    text = unicodedata.normalize('NFKC', sentence).casefold();
+    characters = [];
+    for character in text:
+        if character in APOSTROPHES:
+            continue;
+        category = unicodedata.category(character)[0];
+        # Punctuation, symbols, separators and control characters all become spaces
+        characters.append(' ' if category in 'PSZC' else character);
+    return ' '.join(''.join(characters).split());
+
+""" Function used to build the key of a translation from the sentence and the language.
+"""
+def canonicalKey(sentence, language):
+    # type: (String, String) -> String
+    return canonicalSentence(sentence) + KEY_DELIMITER + language.lower().replace(" ", "");
+
+# Long utterances are split into segments that are translated and cached separately, so
+# that sentences and clauses that come up again can be reused and the segments can be
+# translated at the same time. Segmentation is on by default and can be turned off by
+# setting the optional ftSegmentation environment variable to "false". ftMaxSegments
+# is at most 5, as Alexa plays no more than 5 audio files in one response, and commas
+# only split clauses of at least ftMinClauseWords words.
+segmentationEnabled = os.environ.get('ftSegmentation', 'true').lower() == 'true';
+maxSegments = max(1, min(5, int(os.environ.get('ftMaxSegments', '5'))));
+minClauseWords = int(os.environ.get('ftMinClauseWords', '3'));
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?;:])\s+');
+CLAUSE_BOUNDARY = re.compile(r'(?<=,)\s+');
+
+""" Function used to split an utterance into the segments that are translated separately,
+    i.e. its sentences, and the clauses within them that are separated by a comma and
+    are long enough to stand on their own. Segments without any words are dropped, and
+    if there are more than maxSegments the last ones are joined back together.
+"""
+def splitSegments(sentence):
+    # type: (String) -> list
+    segments = [];
+    for part in SENTENCE_BOUNDARY.split(sentence.strip()):
+        clauses = [part];
+        candidates = CLAUSE_BOUNDARY.split(part);
+        if len(candidates) > 1 and all(len(canonicalSentence(clause).split()) >= minClauseWords for clause in candidates):
+            clauses = candidates;
+        segments.extend(clause.strip() for clause in clauses if canonicalSentence(clause));
+    if len(segments) > maxSegments:
+        segments[maxSegments - 1:] = [' '.join(segments[maxSegments - 1:])];
+    return segments or [sentence];
+
+# Audio profiles set how the audio files are encoded by Polly: the output format, the
+# sample rate and what is done with the slow repeat of the translation, which is either
+# part of the same audio file ("inline", as it always used to be), left out ("none"), or
+# made as a separate audio file the first time the user asks for a repeat ("lazy"). Audio
+# files without the slow repeat are about half the size, so they are synthesised,
+# uploaded and fetched by Alexa faster. Alexa only plays MP3 files at these sample rates.
+AudioProfile = namedtuple('AudioProfile', ['name', 'format', 'sample_rate', 'slow_repeat']);
+AUDIO_FORMATS = {'mp3': 'mp3'};
+ALEXA_SAMPLE_RATES = ('16000', '22050', '24000');
+SLOW_REPEAT_MODES = ('inline', 'none', 'lazy');
+audioProfiles = OrderedDict([
+                    ('standard', AudioProfile('standard', 'mp3', '22050', 'inline')),
+                    ('compact', AudioProfile('compact', 'mp3', '16000', 'lazy')),
+                    ('lean', AudioProfile('lean', 'mp3', '16000', 'none'))
+                ]);
+
+""" Function used to add the audio profiles defined in the optional ftAudioProfiles
+    environment variable, a JSON object of profile names to their format, sample_rate and
+    slow_repeat, e.g. {"small": {"sample_rate": "16000", "slow_repeat": "lazy"}}. Settings
+    that are left out are taken from the standard profile, and profiles with settings
+    that Alexa cannot play are logged and ignored.
+"""
+def loadAudioProfiles(definitions):
+    # type: (String) -> None
+    try:
+        profiles = json.loads(definitions or '{}');
+    except ValueError as e:
+        logger.error(e);
+        return;
+    for name, settings in profiles.items():
+        standard = audioProfiles['standard'];
+        profile = AudioProfile(name, str(settings.get('format', standard.format)),
+                               str(settings.get('sample_rate', standard.sample_rate)),
+                               str(settings.get('slow_repeat', standard.slow_repeat)));
+        if (profile.format not in AUDIO_FORMATS or profile.sample_rate not in ALEXA_SAMPLE_RATES or
+                profile.slow_repeat not in SLOW_REPEAT_MODES):
+            logger.error("Ignoring audio profile %s with settings Alexa cannot play: %s", name, settings);
+            continue;
+        audioProfiles[name] = profile;
+
+loadAudioProfiles(os.environ.get('ftAudioProfiles'));
+
+# The audio profile used for every language is set through the optional ftAudioProfile
+# environment variable ("standard" by default), and can be changed for single languages
+# with ftLanguageAudioProfiles, a JSON object of languages to profile names.
+defaultAudioProfile = audioProfiles.get(os.environ.get('ftAudioProfile', 'standard'), audioProfiles['standard']);
+try:
+    languageAudioProfiles = json.loads(os.environ.get('ftLanguageAudioProfiles') or '{}');
+except ValueError as e:
+    logger.error(e);
+    languageAudioProfiles = {};
+
+""" Function used to get the audio profile for a language.
+"""
+def audioProfile(language):
+    # type: (String) -> AudioProfile
+    return audioProfiles.get(languageAudioProfiles.get(language), defaultAudioProfile);
+
+""" Function used to build the S3 object key of the audio file for a translation key and
+    its md5 hash. Spaces and the delimiter are swapped for characters that do not need
+    escaping in a URL, the hash keeps the object key unique. The file is named after the
+    audio profile it was made with.
+"""
+def audioObjectKey(key, hash_val, profile=None):
+    # type: (String, String, AudioProfile) -> String
+    profile = profile or defaultAudioProfile;
+    return "{}/{}/{}.{}".format(hash_val, key.replace(' ', '-').replace(KEY_DELIMITER, '.'),
+                                profile.name, AUDIO_FORMATS[profile.format]);
+
+# Version of the SSML template used by synthesizeSpeech. It is part of the key of shared
+# audio files, so it must be increased whenever the template changes so that audio made
+# with the old template is not reused.
+SSML_TEMPLATE_VERSION = 1;
+
+# Audio files are stored under a hash of their content (translated text, voice, audio
+# profile and SSML template version) unless the optional ftContentAddressedAudio
+# environment variable is set to "false", in which case they are stored under the phrase.
+contentAddressedAudio = os.environ.get('ftContentAddressedAudio', 'true').lower() == 'true';
+
+# Before synthesising a translation whose shared audio file this container does not know
+# about, S3 can be asked whether the file already exists (made for another phrase with the
+# same translation, or by another container). That saves the Polly call when it does, but
+# adds a round trip to S3 to every new translation when it does not, which is the usual
+# case, so it is only done if the optional ftAudioExistsCheck environment variable is set
+# to "true". Otherwise the file is synthesised and uploaded again, with the same content.
+audioExistsCheck = os.environ.get('ftAudioExistsCheck', 'false').lower() == 'true';
+
+""" Function used to build the S3 object key of the shared audio file for a translated
+    text, Polly voice and audio profile. Any phrases whose translation is the same share
+    this file. The settings of the profile are part of the hash, so that audio made before
+    a profile was changed is not reused.
+"""
+def sharedAudioKey(translated_text, voice, profile=None):
+    # type: (String, String, AudioProfile) -> String
+    profile = profile or defaultAudioProfile;
+    content = json.dumps([SSML_TEMPLATE_VERSION, voice, translated_text, profile.format,
+                          profile.sample_rate, profile.slow_repeat == 'inline']);
+    digest = hashlib.sha256(content.encode('utf-8')).hexdigest();
+    return "audio/v{}/{}/{}/{}.{}".format(SSML_TEMPLATE_VERSION, profile.name, voice, digest,
+                                          AUDIO_FORMATS[profile.format]);
+
+# The slow repeat of audio profiles that make it lazily is stored next to the audio file of
+# the translation, under the same object key with this suffix added before the extension,
+# so that it can be found again from the translation alone.
+SLOW_AUDIO_SUFFIX = '-slow';
+
+""" Function used to build the S3 object key of the slow repeat of an audio file.
+"""
+def slowAudioKey(object_key):
+    # type: (String) -> String
+    root, dot, extension = object_key.rpartition('.');
+    return root + SLOW_AUDIO_SUFFIX + dot + extension;
+
+""" Function used to build the SSML audio tag that plays an object from the S3 bucket.
+"""
+def audioUrl(object_key):
+    # type: (String) -> String
+    return ' <audio src= "https://{}.s3.amazonaws.com/{}?region=eu-west-1"/> '.format(bucketName, quote(object_key, safe='/'));
+
+
+""" In-process cache placed in front of the DynamoDB table. As module level objects
+    survive for as long as the Lambda container is kept warm, previously translated
+    phrases can be served straight from memory without making any DynamoDB calls.
+    The cache is bounded to a maximum number of entries and the least recently used
+    entry is evicted once that bound is reached. Every entry also has a time-to-live
+    so that changes made to the table are eventually picked up. Phrases that were
+    not found in the table are also cached (for a much shorter time) so that repeated
+    lookups for the same untranslated phrase do not all hit DynamoDB.
+"""
+class TranslationCache(object):
+
+    # Sentinel returned by get when the cache holds no information about a key.
+    # None cannot be used for this as it is the value stored for cached misses.
+    MISSING = object()
+
+    def __init__(self, max_entries, ttl, negative_ttl):
+        # type: (int, float, float) -> None
+        self.max_entries = max_entries;
+        self.ttl = ttl;
+        self.negative_ttl = negative_ttl;
+        # The OrderedDict is kept in least to most recently used order, and each
+        # value is a tuple of (expiry time, item)
+        self._entries = OrderedDict();
+        self._lock = threading.Lock();
+        self.hits = 0;
+        self.misses = 0;
+        self.negative_hits = 0;
+        self.evictions = 0;
+        self.expirations = 0;
+
+    def get(self, key):
+        # type: (String) -> TranslationItem
+        # Returns the cached item, None if the key is cached as not being in the
+        # table, or TranslationCache.MISSING if nothing is known about the key
+        with self._lock:
+            entry = self._entries.get(key, None);
+            if entry is None:
+                self.misses += 1;
+                return TranslationCache.MISSING;
+            expiry, item = entry;
+            if expiry <= time.time():
+                del self._entries[key];
+                self.expirations += 1;
+                self.misses += 1;
+                return TranslationCache.MISSING;
+            self._entries.move_to_end(key);
+            if item is None:
+                self.negative_hits += 1;
+            else:
+                self.hits += 1;
+            return item;
+
+    def put(self, key, item):
+        # type: (String, TranslationItem) -> None
+        # Passing None as the item caches the key as a miss using the negative TTL
+        if self.max_entries <= 0:
+            return;
+        ttl = self.ttl if item is not None else self.negative_ttl;
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, item);
+            self._entries.move_to_end(key);
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False);
+                self.evictions += 1;
+
+    def invalidate(self, key):
+        # type: (String) -> None
+        with self._lock:
+            self._entries.pop(key, None);
+
+    def clear(self):
+        # type: () -> None
+        with self._lock:
+            self._entries.clear();
+
+    def stats(self):
+        # type: () -> dict
+        # Counters are exposed so that the size and TTLs of the cache can be tuned
+        # from the values logged into CloudWatch
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses;
+            return {
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_ratio': (float(self.hits + self.negative_hits) / lookups) if lookups else 0.0
+            };
+
+# The cache is configured through optional environment variables, and can be
+# disabled entirely by setting ftCacheMaxEntries to 0
+translationCache = TranslationCache(
+                        int(os.environ.get('ftCacheMaxEntries', '512')),
+                        float(os.environ.get('ftCacheTTL', '3600')),
+                        float(os.environ.get('ftCacheNegativeTTL', '30'))
+                   );
+
+
+# Typed representation of an entry in the DynamoDB table, so that callers do not
+# need to know how the translation and url are nested within the stored item.
+# fallback is True if the translation was made by a fallback engine rather than the API.
+TranslationItem = namedtuple('TranslationItem', ['key', 'translation', 'url', 'fallback'], defaults=(False,));
+
+
+""" Component responsible for all reads and writes of translations in the DynamoDB
+    table. A lookup returns the whole entry from a single get_item call rather than
+    checking that the key exists and then fetching it, and goes through the in-process
+    translation cache and then the hot-phrase snapshot (if there is one) first. Keys and
+    items can also be read and written in batches
+    for workloads that deal with many phrases at once.
+    
+    When write-behind is enabled, put only updates the cache and queues the item, and
+    get serves queued items until they have been written. The queued items are written
+    by flush, which is called by the response interceptor once the handler has built the
+    response, so that everything a request stores (e.g. the segments of an utterance and
+    the utterance itself) is written in a single batch. Response interceptors run before
+    the response is returned to Alexa, so the write is still part of the time the user
+    waits for; it is deliberately not put off until later, as the container may be frozen
+    or recycled once the response is returned, which would lose the write, and other
+    containers would not find the translation in the meantime.
+    
+    Every item found is also counted in memory, and the counts are added to the
+    access_count and last_access attributes of the items by flushAccesses, which a
+    request interceptor starts on the upload pool at the start of an invocation once
+    ftAccessFlushSeconds have passed or ftAccessFlushItems items have been counted,
+    writing at most that many items each time with one update per item. A count is only dropped once it has been written, so counts that could
+    not be written are tried again by the next flush. The counts are only approximate,
+    as counts not yet written are lost if the container is recycled, but they are all the
+    cache sweeper (sweep_cache.py) needs to tell the popular items from the cold ones. When item_ttl is set, items are given an expires_at
+    attribute for DynamoDB's time to live, which is pushed back every time the item is
+    used, apart from items pinned by the sweeper which never expire (their expires_at is
+    set to the pinned flag, which is not a number, so time to live ignores it). Translations made by
+    a fallback engine are only kept for fallback_ttl seconds and are never pushed back,
+    as they are only stored until the API can translate the phrase again.
+    
+    While the circuit breaker given for DynamoDB is open, lookups return UNAVAILABLE
+    rather than a miss, so that a phrase is not translated again (using up the API's
+    limit, which cannot be checked either) just because the table cannot be read, and
+    writes and deletes fail straight away (queued writes are kept for the next flush)
+    rather than waiting for DynamoDB to time out.
+"""
+class TranslationStore(object):
+    
+    KEY_NAME = 'OriginalPhraseandLanguage';
+    # DynamoDB limits for the number of keys in a single BatchGetItem request
+    BATCH_GET_LIMIT = 100;
+    BATCH_GET_RETRIES = 5;
+    # Sentinel returned by get when the table could not be read, which is not a miss
+    UNAVAILABLE = object();
+    # Start of the keys of the items used internally, e.g. the rate limiter's bucket
+    INTERNAL_PREFIX = '__';
+    
+    def __init__(self, dynamodb_resource, dynamodb_table, cache, write_behind=False, hot_phrases=None,
+                 item_ttl=None, track_accesses=True, breaker=None, fallback_ttl=3600):
+        # type: (ServiceResource, Table, TranslationCache, bool, HotPhraseSnapshot, float, bool, CircuitBreaker, float) -> None
+        self.dynamodb_resource = dynamodb_resource;
+        self.table = dynamodb_table;
+        self.cache = cache;
+        self.write_behind = write_behind;
+        self.hot_phrases = hot_phrases;
+        self.item_ttl = item_ttl;
+        self.fallback_ttl = fallback_ttl;
+        self.track_accesses = track_accesses;
+        self.breaker = breaker or CircuitBreaker('dynamodb', 0, 0, False);
+        self._pending = OrderedDict();
+        self._accesses = Counter();
+        self._accesses_flushed = time.time();
+        self._lock = threading.Lock();
+    
+    def _toItem(self, entry):
+        # type: (dict) -> TranslationItem
+        value = entry.get('value', {});
+        return TranslationItem(entry[TranslationStore.KEY_NAME], value.get('translation'), value.get('url'),
+                               bool(value.get('fallback', False)));
+    
+    def _toEntry(self, item):
+        # type: (TranslationItem) -> dict
+        now = int(time.time());
+        entry = {
+            TranslationStore.KEY_NAME: item.key,
+            'value': {
+                'translation': item.translation,
+                'url': item.url
+            },
+            'last_access': now
+        };
+        if item.fallback:
+            entry['value']['fallback'] = True;
+            entry['expires_at'] = now + int(self.fallback_ttl);
+        elif self.item_ttl:
+            entry['expires_at'] = now + int(self.item_ttl);
+        return entry;
+    
+    def _touch(self, items):
+        # type: (iterable) -> None
+        # Counts an access to each of the items, to be written by flushAccesses. Fallback
+        # translations are not counted, so that they are never kept for longer or pinned
+        if self.track_accesses:
+            with self._lock:
+                self._accesses.update(item.key for item in items if not item.fallback);
+    
+    def _fromSnapshot(self, key):
+        # type: (String) -> TranslationItem
+        # Looks the key up in the hot-phrase snapshot, adding it to the cache if found
+        if self.hot_phrases is None:
+            return None;
+        try:
+            found = self.hot_phrases.get(key);
+        except Exception as e:
+            logger.error(e);
+            return None;
+        if found is None:
+            return None;
+        item = TranslationItem(key, found[0], found[1]);
+        self.cache.put(key, item);
+        return item;
+    
+    def get(self, key):
+        # type: (String) -> TranslationItem
+        # Returns the translation for the key, None if it has not been translated, or
+        # UNAVAILABLE if the table could not be read, either because of an error, which
+        # is logged, or because the circuit is open
+        with stageMetrics.stage('cache_lookup'):
+            item = self.cache.get(key);
+            if item is TranslationCache.MISSING:
+                item = self._fromSnapshot(key) or TranslationCache.MISSING;
+        if item is not TranslationCache.MISSING:
+            if item is not None:
+                self._touch((item,));
+            return item;
+        
+        # Items queued in write-behind mode are not in the table yet
+        with self._lock:
+            item = self._pending.get(key);
+        if item is not None:
+            return item;
+        
+        if not self.breaker.allow():
+            return TranslationStore.UNAVAILABLE;
+        try:
+            with stageMetrics.stage('dynamodb_get'):
+                entry = self.table.get_item(Key={TranslationStore.KEY_NAME: key}).get('Item');
+            self.breaker.success();
+        except Exception as e:
+            logger.error(e);
+            self.breaker.failure();
+            return TranslationStore.UNAVAILABLE;
+        
+        item = self._toItem(entry) if entry is not None else None;
+        self.cache.put(key, item);
+        if item is not None:
+            self._touch((item,));
+        return item;
+    
+    def batch_get(self, keys):
+        # type: (list) -> dict
+        # Returns a dictionary of key to TranslationItem for every key that has been
+        # translated. Keys served from the cache are not requested from DynamoDB and
+        # the remaining keys are fetched in chunks of at most 100 keys
+        found = {};
+        remaining = [];
+        for key in OrderedDict.fromkeys(keys):
+            item = self.cache.get(key);
+            if item is TranslationCache.MISSING:
+                item = self._fromSnapshot(key);
+                if item is None:
+                    remaining.append(key);
+                else:
+                    found[key] = item;
+            elif item is not None:
+                found[key] = item;
+        
+        for start in range(0, len(remaining), TranslationStore.BATCH_GET_LIMIT):
+            if not self.breaker.allow():
+                break;
+            chunk = remaining[start:start + TranslationStore.BATCH_GET_LIMIT];
+            request = {self.table.name: {'Keys': [{TranslationStore.KEY_NAME: key} for key in chunk]}};
+            fetched = set();
+            try:
+                # Any keys DynamoDB could not process (e.g. due to throttling) are
+                # retried with a short exponential backoff
+                for attempt in range(TranslationStore.BATCH_GET_RETRIES):
+                    response = self.dynamodb_resource.batch_get_item(RequestItems=request);
+                    for entry in response.get('Responses', {}).get(self.table.name, []):
+                        item = self._toItem(entry);
+                        found[item.key] = item;
+                        fetched.add(item.key);
+                        self.cache.put(item.key, item);
+                    request = response.get('UnprocessedKeys') or {};
+                    if not request:
+                        break;
+                    time.sleep(0.05 * (2 ** attempt));
+                self.breaker.success();
+            except Exception as e:
+                logger.error(e);
+                self.breaker.failure();
+                continue;
+            
+            # Keys that were fully processed but not returned do not exist in the table
+            if not request:
+                for key in chunk:
+                    if key not in fetched:
+                        self.cache.put(key, None);
+        
+        self._touch(found.values());
+        return found;
+    
+    def put(self, item):
+        # type: (TranslationItem) -> bool
+        # The cache is always updated straight away so that the new translation can be
+        # served by this container even before a queued write has been flushed
+        self.cache.put(item.key, item);
+        if self.write_behind:
+            with self._lock:
+                self._pending[item.key] = item;
+            return True;
+        
+        if not self.breaker.allow():
+            self.cache.invalidate(item.key);
+            return False;
+        try:
+            with stageMetrics.stage('dynamodb_put'):
+                self.table.put_item(Item=self._toEntry(item));
+            self.breaker.success();
+            return True;
+        except Exception as e:
+            logger.error(e);
+            self.breaker.failure();
+            self.cache.invalidate(item.key);
+            return False;
+    
+    def delete(self, key):
+        # type: (String) -> bool
+        self.cache.invalidate(key);
+        with self._lock:
+            self._pending.pop(key, None);
+        if not self.breaker.allow():
+            return False;
+        try:
+            self.table.delete_item(Key={TranslationStore.KEY_NAME: key});
+            self.breaker.success();
+            return True;
+        except Exception as e:
+            logger.error(e);
+            self.breaker.failure();
+            return False;
+    
+    def batch_write(self, items):
+        # type: (list) -> bool
+        # Writes all the items using the table's batch writer, which groups them
+        # into BatchWriteItem requests and resends any unprocessed items
+        items = list(items);
+        if not items:
+            return True;
+        if not self.breaker.allow():
+            for item in items:
+                self.cache.invalidate(item.key);
+            return False;
+        try:
+            with self.table.batch_writer(overwrite_by_pkeys=[TranslationStore.KEY_NAME]) as batch:
+                for item in items:
+                    batch.put_item(Item=self._toEntry(item));
+            self.breaker.success();
+        except Exception as e:
+            logger.error(e);
+            self.breaker.failure();
+            for item in items:
+                self.cache.invalidate(item.key);
+            return False;
+        for item in items:
+            self.cache.put(item.key, item);
+        return True;
+    
+    def pending(self):
+        # type: () -> int
+        with self._lock:
+            return len(self._pending);
+    
+    def flush(self):
+        # type: () -> bool
+        # Writes any items queued in write-behind mode. While the circuit is open the items
+        # are left queued, and are still served from the cache in the meantime
+        with self._lock:
+            if not self._pending:
+                return True;
+        if not self.breaker.allow():
+            return False;
+        with self._lock:
+            items = list(self._pending.values());
+            self._pending.clear();
+        if len(items) == 1:
+            try:
+                with stageMetrics.stage('dynamodb_put'):
+                    self.table.put_item(Item=self._toEntry(items[0]));
+                self.breaker.success();
+                return True;
+            except Exception as e:
+                logger.error(e);
+                self.breaker.failure();
+                self.cache.invalidate(items[0].key);
+                return False;
+        with stageMetrics.stage('dynamodb_put'):
+            return self.batch_write(items);
+    
+    def scan(self):
+        # type: () -> generator
+        # Goes through every translation in the table as it is stored, using the paginated
+        # scan, skipping the items used internally. This is only used by the maintenance
+        # scripts, so it does not go through the cache or the circuit breaker.
+        kwargs = {};
+        while True:
+            page = self.table.scan(**kwargs);
+            for entry in page.get('Items', []):
+                if not entry[TranslationStore.KEY_NAME].startswith(TranslationStore.INTERNAL_PREFIX):
+                    yield entry;
+            if 'LastEvaluatedKey' not in page:
+                return;
+            kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey'];
+    
+    def accessesDue(self, interval, threshold):
+        # type: (float, int) -> bool
+        # Returns True if there are counts to write and either interval seconds have passed
+        # since they were last written or at least threshold items have been counted
+        with self._lock:
+            if not self._accesses:
+                return False;
+            return len(self._accesses) >= threshold or time.time() - self._accesses_flushed >= interval;
+    
+    def _writeAccess(self, key, count, now):
+        # type: (String, int, int) -> bool
+        # Adds the count to one item in the table with a single update, returning False if
+        # the item no longer exists (e.g. evicted by the sweeper), in which case it is not
+        # created again. Any other error is raised.
+        update = 'ADD access_count :count SET last_access = :now';
+        values = {':count': count, ':now': now};
+        if self.item_ttl:
+            # The time to live is pushed back, unless the item has been pinned, in which
+            # case expires_at is set to the pinned flag so that it never expires
+            update += ', expires_at = if_not_exists(pinned, :expires)';
+            values[':expires'] = now + int(self.item_ttl);
+        try:
+            self.table.update_item(
+                Key={TranslationStore.KEY_NAME: key},
+                UpdateExpression=update,
+                ConditionExpression='attribute_exists(#key)',
+                ExpressionAttributeNames={'#key': TranslationStore.KEY_NAME},
+                ExpressionAttributeValues=values
+            );
+            return True;
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+                raise;
+            return False;
+    
+    def flushAccesses(self, max_items=None):
+        # type: (int) -> int
+        # Adds the counted accesses to the items in the table, the most used items first
+        # and at most max_items of them, returning the number of items updated. Each count
+        # is only removed once it has been written, keeping any accesses counted since, and
+        # the flush stops at the first error. Everything is kept while the circuit is open.
+        if not self.breaker.allow():
+            return 0;
+        with self._lock:
+            accesses = self._accesses.most_common(max_items);
+            self._accesses_flushed = time.time();
+        now = int(time.time());
+        written = 0;
+        updated = 0;
+        for key, count in accesses:
+            try:
+                if self._writeAccess(key, count, now):
+                    updated += 1;
+            except Exception as e:
+                logger.error(e);
+                self.breaker.failure();
+                break;
+            written += 1;
+            with self._lock:
+                self._accesses[key] -= count;
+                if self._accesses[key] <= 0:
+                    del self._accesses[key];
+        if written:
+            self.breaker.success();
+        logger.info("Recorded accesses to %d items", updated);
+        return updated;
+
+# Cache of the S3 object keys of audio files known to exist in the bucket
+audioCache = TranslationCache(int(os.environ.get('ftAudioCacheMaxEntries', '1024')),
+                              float(os.environ.get('ftCacheTTL', '3600')), 0);
+
+# The hot-phrase snapshot is either bundled with the deployment package (by default as
+# hot_phrases.snap next to this file, or wherever ftSnapshotPath points) or downloaded
+# once per container from the S3 object named by ftSnapshotS3Key. Snapshots older than
+# ftSnapshotMaxAge seconds (7 days by default) are ignored as being stale.
+SNAPSHOT_DOWNLOAD_PATH = '/tmp/hot_phrases.snap';
+
+""" Function used to open the hot-phrase snapshot, downloading it from S3 first if needed.
+    An empty snapshot is returned if there is none, so lookups go straight to DynamoDB.
+"""
+def loadHotPhraseSnapshot():
+    # type: () -> HotPhraseSnapshot
+    path = os.environ.get('ftSnapshotPath', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hot_phrases.snap'));
+    s3_key = os.environ.get('ftSnapshotS3Key');
+    if s3_key:
+        try:
+            s3.download_file(bucketName, s3_key, SNAPSHOT_DOWNLOAD_PATH);
+            path = SNAPSHOT_DOWNLOAD_PATH;
+        except Exception as e:
+            logger.error(e);
+    if not os.path.exists(path):
+        return snapshot.HotPhraseSnapshot();
+    return snapshot.HotPhraseSnapshot(path, float(os.environ.get('ftSnapshotMaxAge', str(7 * 24 * 3600))));
+
+hotPhrases = LazySingleton('snapshot', loadHotPhraseSnapshot);
+
+# The store used by all of the handlers and utility functions. Write-behind can be
+# turned on with the optional ftWriteBehind environment variable
+# Items expire after ftItemTTLDays days without being used (0 for never), which needs
+# time to live to be turned on for the expires_at attribute of the table, translations
+# from a fallback engine expire ftFallbackTTLMinutes minutes after being made, and accesses are
+# written every ftAccessFlushSeconds or once ftAccessFlushItems items have been counted,
+# unless ftAccessTracking is set to "false". The response waits at most ftAccessFlushWaitMs
+# for the counts to be written.
+accessFlushSeconds = float(os.environ.get('ftAccessFlushSeconds', '60'));
+accessFlushItems = int(os.environ.get('ftAccessFlushItems', '10'));
+accessFlushWaitMs = int(os.environ.get('ftAccessFlushWaitMs', '200'));
+translationStore = TranslationStore(dynamoDB, table, translationCache,
+                                    os.environ.get('ftWriteBehind', 'false').lower() == 'true',
+                                    hotPhrases,
+                                    float(os.environ.get('ftItemTTLDays', '90')) * 24 * 3600,
+                                    os.environ.get('ftAccessTracking', 'true').lower() == 'true',
+                                    dynamodbBreaker,
+                                    float(os.environ.get('ftFallbackTTLMinutes', '60')) * 60);
+
+# Shared thread pool used to run the S3 upload and the DynamoDB write of a new
+# translation at the same time. The pool is created once per container and reused by
+# every invocation. Concurrent uploads are enabled with the optional ftConcurrentUploads
+# environment variable, and ftUploadTimeout is the number of seconds to wait for both.
+concurrentUploads = os.environ.get('ftConcurrentUploads', 'false').lower() == 'true';
+uploadTimeout = float(os.environ.get('ftUploadTimeout', '5'));
+uploadPool = ThreadPoolExecutor(max_workers=int(os.environ.get('ftUploadWorkers', '4')));
+
+# Separate pool used to translate the segments of an utterance at the same time. It is
+# kept apart from the upload pool as each segment can itself use the upload pool.
+segmentPool = ThreadPoolExecutor(max_workers=int(os.environ.get('ftSegmentWorkers', '4')));
+
+
+""" Token bucket rate limiter for the Fun Translations API, which only allows 5 calls
+    an hour. The bucket is stored as an item in the DynamoDB table so that it is shared
+    by every container, and tokens are taken from it with conditional updates so that
+    two containers can never both take the last token. Tokens are refilled continuously,
+    at capacity tokens per period.
+    
+    Each container also keeps the last state of the bucket it has seen. As the number of
+    tokens can only have gone down since then (through other containers taking them),
+    a request that would be refused based on this state is refused straight away, without
+    reading the bucket from DynamoDB or calling the API. If DynamoDB cannot be reached (or
+    its circuit is open), the limiter lets the request through so that the API itself decides.
+"""
+class TokenBucketRateLimiter(object):
+    
+    KEY_NAME = 'OriginalPhraseandLanguage';
+    MAX_ATTEMPTS = 5;
+    
+    def __init__(self, dynamodb_table, bucket_key, capacity, period, breaker=None):
+        # type: (Table, String, float, float, CircuitBreaker) -> None
+        self.table = dynamodb_table;
+        self.breaker = breaker or CircuitBreaker('dynamodb', 0, 0, False);
+        self.bucket_key = bucket_key;
+        self.capacity = float(capacity);
+        self.rate = float(capacity) / float(period);
+        # Last state of the bucket seen by this container as (tokens, updated time)
+        self._state = None;
+        self._lock = threading.Lock();
+    
+    def _refill(self, tokens, updated, now):
+        # type: (float, float, float) -> float
+        return min(self.capacity, tokens + max(0.0, now - updated) * self.rate);
+    
+    def _remember(self, tokens, updated):
+        # type: (float, float) -> None
+        with self._lock:
+            self._state = (tokens, updated);
+    
+    def _read(self):
+        # type: () -> tuple
+        # Returns the (tokens, updated time) stored in DynamoDB, or None if the bucket
+        # has not been created yet
+        entry = self.table.get_item(Key={TokenBucketRateLimiter.KEY_NAME: self.bucket_key},
+                                    ConsistentRead=True).get('Item');
+        if entry is None:
+            return None;
+        return (float(entry['tokens']), float(entry['updated']));
+    
+    def _write(self, tokens, now, previous):
+        # type: (float, float, tuple) -> bool
+        # Stores the new state of the bucket as long as nobody else has changed it since
+        # it was read. Returns False if the condition failed so the caller can retry.
+        if previous is None:
+            condition = 'attribute_not_exists(#key)';
+            values = {};
+        else:
+            condition = '#updated = :previous';
+            values = {':previous': Decimal(repr(previous[1]))};
+        values[':tokens'] = Decimal(repr(round(tokens, 6)));
+        values[':now'] = Decimal(repr(now));
+        try:
+            self.table.update_item(
+                Key={TokenBucketRateLimiter.KEY_NAME: self.bucket_key},
+                UpdateExpression='SET tokens = :tokens, #updated = :now',
+                ConditionExpression=condition,
+                ExpressionAttributeNames=dict([('#updated', 'updated')] + ([('#key', TokenBucketRateLimiter.KEY_NAME)] if previous is None else [])),
+                ExpressionAttributeValues=values
+            );
+            return True;
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+                return False;
+            raise;
+    
+    def acquire(self):
+        # type: () -> bool
+        # Takes a token from the bucket, returning False if there are none left
+        now = time.time();
+        with self._lock:
+            state = self._state;
+        if state is not None and self._refill(state[0], state[1], now) < 1:
+            logger.info("Translation refused locally by the rate limiter");
+            return False;
+        
+        if not self.breaker.allow():
+            return True;
+        try:
+            for attempt in range(TokenBucketRateLimiter.MAX_ATTEMPTS):
+                now = time.time();
+                previous = self._read();
+                tokens = self.capacity if previous is None else self._refill(previous[0], previous[1], now);
+                if tokens < 1:
+                    self._remember(tokens, now);
+                    self.breaker.success();
+                    return False;
+                if self._write(tokens - 1, now, previous):
+                    self._remember(tokens - 1, now);
+                    self.breaker.success();
+                    return True;
+        except Exception as e:
+            logger.error(e);
+            self.breaker.failure();
+            return True;
+        self.breaker.success();
+        
+        # The bucket kept being changed by other containers while this one was trying
+        # to take a token, so it is treated as being empty
+        return False;
+    
+    def drain(self):
+        # type: () -> None
+        # Empties the bucket, used when the API reports that the limit has been reached
+        # even though the bucket still had tokens
+        now = time.time();
+        self._remember(0.0, now);
+        try:
+            self._write(0.0, now, self._read());
+        except Exception as e:
+            logger.error(e);
+    
+    def status(self):
+        # type: () -> dict
+        # Returns the remaining number of calls, and the number of seconds until the next
+        # call can be made and until the bucket is full again, based on the last state
+        # seen by this container. Call refresh first for an up to date view.
+        now = time.time();
+        with self._lock:
+            state = self._state;
+        tokens = self.capacity if state is None else self._refill(state[0], state[1], now);
+        return {
+            'capacity': self.capacity,
+            'remaining': int(tokens),
+            'tokens': round(tokens, 3),
+            'next_call_in_seconds': 0.0 if tokens >= 1 else round((1 - tokens) / self.rate, 1),
+            'reset_in_seconds': round((self.capacity - tokens) / self.rate, 1),
+            'reset_at': now + (self.capacity - tokens) / self.rate
+        };
+    
+    def refresh(self):
+        # type: () -> dict
+        # Reloads the state of the bucket from DynamoDB and returns the status
+        try:
+            state = self._read();
+            if state is not None:
+                self._remember(state[0], state[1]);
+        except Exception as e:
+            logger.error(e);
+        return self.status();
+
+# The API's limit of 5 calls an hour is enforced with a bucket stored in the translation
+# table. The limiter can be turned off by setting the optional ftRateLimit environment
+# variable to "false", and the limit changed with ftRateLimitCapacity and ftRateLimitPeriod.
+rateLimitEnabled = os.environ.get('ftRateLimit', 'true').lower() == 'true';
+rateLimiter = TokenBucketRateLimiter(table, '__ratelimit__:funtranslations',
+                                     float(os.environ.get('ftRateLimitCapacity', '5')),
+                                     float(os.environ.get('ftRateLimitPeriod', '3600')),
+                                     dynamodbBreaker);
+
+# Base URL of the Fun Translations API, the language is added as the path of the request.
+# It can be pointed somewhere else, e.g. the benchmark's local server, with ftTranslationApiUrl
+TRANSLATION_API_URL = os.environ.get('ftTranslationApiUrl', 'https://api.funtranslations.com/translate/{}.json');
+
+# Timeouts for the API call are worked out from the time left before Alexa stops waiting
+# for the response. ftResponseDeadlineMs is how long Alexa waits (about 8 seconds),
+# ftDeadlineReserveMs is the time kept back for synthesising and uploading the audio
+# after the translation, and ftApiTimeout is used when the Lambda context is not known.
+# A hedged request is sent if the first has not answered after ftHedgeAfterMs, which
+# is 0 (disabled) by default as the second request also counts against the API's limit.
+responseDeadlineMs = int(os.environ.get('ftResponseDeadlineMs', '8000'));
+deadlineReserveMs = int(os.environ.get('ftDeadlineReserveMs', '3000'));
+minimumApiTimeout = 0.5;
+defaultApiTimeout = float(os.environ.get('ftApiTimeout', '5'));
+hedgeAfterMs = int(os.environ.get('ftHedgeAfterMs', '0'));
+hedgePool = ThreadPoolExecutor(max_workers=2);
+
+""" Base class of the backends that phrases can be translated with. A backend declares
+    whether it runs locally, whether it is only a fallback (used once every other backend
+    has failed, however fast it is) and its quota. The latency and error rate of the
+    backend are kept as exponentially weighted moving averages of its calls in this
+    container, which the router uses to put the fastest healthy backend first. A backend
+    whose error rate is over max_error_rate is unhealthy until retry_after seconds after
+    its last failure.
+"""
+class TranslationBackend(object):
+    
+    local = False;
+    fallback = False;
+    
+    def __init__(self, name, expected_latency, alpha=0.2, max_error_rate=0.5, retry_after=30.0):
+        # type: (String, float, float, float, float) -> None
+        self.name = name;
+        self.alpha = alpha;
+        self.max_error_rate = max_error_rate;
+        self.retry_after = retry_after;
+        # The expected latency is used until the first call has been timed
+        self.latency = expected_latency;
+        self.error_rate = 0.0;
+        self.calls = 0;
+        self.failures = 0;
+        self.last_failure = 0.0;
+        self._lock = threading.Lock();
+    
+    @property
+    def quota(self):
+        # type: () -> dict
+        # The number of calls allowed per period in seconds, or None if unlimited
+        return None;
+    
+    def supports(self, language):
+        # type: (String) -> bool
+        return True;
+    
+    def healthy(self, now=None):
+        # type: (float) -> bool
+        with self._lock:
+            return self.error_rate < self.max_error_rate or (now or time.time()) - self.last_failure > self.retry_after;
+    
+    def record(self, seconds, succeeded):
+        # type: (float, bool) -> None
+        # Calls refused by the quota without being made are recorded with no latency
+        with self._lock:
+            self.calls += 1;
+            if seconds is not None:
+                self.latency = self.alpha * seconds + (1 - self.alpha) * self.latency;
+            self.error_rate = self.alpha * (0.0 if succeeded else 1.0) + (1 - self.alpha) * self.error_rate;
+            if not succeeded:
+                self.failures += 1;
+                self.last_failure = time.time();
+    
+    def translate(self, input_phrase, language, timeout):
+        # type: (String, String, float) -> tuple
+        # Returns the translation and its state, "Translated", "Limit Exceeded",
+        # "Timed Out", "Unauthorized" or "Unavailable", and records how the call went
+        start = time.perf_counter();
+        try:
+            translation, state, called = self._translate(input_phrase, language, timeout);
+        except Exception as e:
+            logger.error("{} failed: {}".format(self.name, e));
+            translation, state, called = "", "Unauthorized", True;
+        seconds = time.perf_counter() - start;
+        self.record(seconds if called else None, state == "Translated");
+        if called:
+            stageMetrics.record('backend_' + self.name, seconds);
+        return translation, state;
+    
+    def _translate(self, input_phrase, language, timeout):
+        # type: (String, String, float) -> tuple
+        # Returns the translation, its state and whether a call was actually made
+        raise NotImplementedError;
+    
+    def stats(self):
+        # type: () -> dict
+        with self._lock:
+            return {
+                'latency_ms': round(self.latency * 1000.0, 1),
+                'error_rate': round(self.error_rate, 3),
+                'calls': self.calls,
+                'failures': self.failures,
+                'quota': self.quota
+            };
+
+""" Backend that translates in-process with one of the engines of a dictionary of
+    language to translation function, e.g. localEngines or fallbackEngines. The dictionary
+    is looked up on every call, so engines added to it later are used straight away.
+"""
+class LocalEngineBackend(TranslationBackend):
+    
+    local = True;
+    
+    def __init__(self, name, engines, fallback=False, **kwargs):
+        # type: (String, dict, bool, ...) -> None
+        TranslationBackend.__init__(self, name, 0.001, **kwargs);
+        self.engines = engines;
+        self.fallback = fallback;
+    
+    def supports(self, language):
+        # type: (String) -> bool
+        return language in self.engines;
+    
+    def _translate(self, input_phrase, language, timeout):
+        # type: (String, String, float) -> tuple
+        return self.engines[language](input_phrase), "Translated", True;
+
+""" Backend for the Fun Translations API, or another endpoint with the same interface
+    (e.g. a mirror or a paid plan, with its secret sent in the headers). The reply is parsed
+    as JSON. Calls are counted against the rate limiter given for the endpoint, if any,
+    which is emptied when the API says the limit has been reached.
+"""
+class FunTranslationsBackend(TranslationBackend):
+    
+    def __init__(self, name, url, rate_limiter=None, headers=None, breaker=None, **kwargs):
+        # type: (String, String, TokenBucketRateLimiter, dict, CircuitBreaker, ...) -> None
+        TranslationBackend.__init__(self, name, 1.0, **kwargs);
+        self.url = url;
+        self.rate_limiter = rate_limiter;
+        self.headers = headers;
+        self.breaker = breaker or CircuitBreaker(name, 0, 0, False);
+    
+    @property
+    def quota(self):
+        # type: () -> dict
+        if self.rate_limiter is None:
+            return None;
+        return {'calls': self.rate_limiter.capacity, 'period': round(self.rate_limiter.capacity / self.rate_limiter.rate)};
+    
+    def healthy(self, now=None):
+        # type: (float) -> bool
+        # A backend with no calls left is treated as unhealthy, based on the last state of
+        # the rate limiter seen by this container so that no request is made to check, as
+        # is a backend whose circuit is open
+        if self.rate_limiter is not None and self.rate_limiter.status()['remaining'] < 1:
+            return False;
+        if self.breaker.isOpen():
+            return False;
+        return TranslationBackend.healthy(self, now);
+    
+    def _translate(self, input_phrase, language, timeout):
+        # type: (String, String, float) -> tuple
+        
+        # No call is made while the circuit is open, and the rate limiter is checked
+        # before calling the API, so that requests over the API's call limit are refused
+        # without making the call
+        if not self.breaker.allow():
+            return "", "Unavailable", False;
+        if self.rate_limiter is not None and not self.rate_limiter.acquire():
+            return "", "Limit Exceeded", False;
+        
+        # Errors, timeouts and answers other than 200 and 429 count as failures of the API.
+        # A call that is not answered in time is told apart from other errors, so that the
+        # translation can be handed over to an invocation that has the time to wait for it
+        try:
+            response = callTranslationApi(language, input_phrase, timeout, self.url, self.headers, self.rate_limiter);
+        except Exception as e:
+            self.breaker.failure();
+            if isinstance(e, urllib3.exceptions.TimeoutError) or isinstance(getattr(e, 'reason', None), urllib3.exceptions.TimeoutError):
+                logger.error("{} did not answer within {} seconds".format(self.name, timeout));
+                return "", "Timed Out", True;
+            raise;
+        if response.status in (200, 429):
+            self.breaker.success();
+        else:
+            self.breaker.failure();
+        
+        # If the status code is 429, the API's call limit has been exceeded as it is only
+        # possible to call the API 5 times in the space of an hour. If the status code is
+        # 401 (or any other error), then there was an error whilst accessing the API.
+        # Otherwise the translation is taken from the contents of the JSON reply.
+        if response.status == 429:
+            if self.rate_limiter is not None:
+                self.rate_limiter.drain();
+            return "", "Limit Exceeded", True;
+        if response.status != 200:
+            logger.error("{} answered with status {}".format(self.name, response.status));
+            return "", "Unauthorized", True;
+        translation = json.loads(response.data.decode('utf-8'))['contents']['translated'];
+        if not isinstance(translation, str) or not translation.strip():
+            logger.error("{} did not return a translation".format(self.name));
+            return "", "Unauthorized", True;
+        return translation, "Translated", True;
+
+""" Router that translates a phrase with the chain of backends for its language. The
+    backends that are not fallbacks are tried healthy ones first, fastest first, and the
+    fallbacks are tried last in the order they were registered. Languages with a local
+    engine that is not a fallback are only ever translated locally, so they are never
+    sent to an API or counted against its limit. Every backend after the first only gets
+    the time that is left of the timeout. So that a backend that has become faster is
+    noticed, the second fastest healthy backend is tried first on explore_rate of the calls.
+    A translation made by a fallback is given back with the state "Fallback", so that it
+    is only stored until the other backends can translate the phrase again.
+"""
+class TranslationRouter(object):
+    
+    def __init__(self, backends, explore_rate=0.0):
+        # type: (list, float) -> None
+        self.backends = list(backends);
+        self.explore_rate = explore_rate;
+    
+    def register(self, backend):
+        # type: (TranslationBackend) -> None
+        self.backends.append(backend);
+    
+    def chain(self, language):
+        # type: (String) -> list
+        candidates = [backend for backend in self.backends if backend.supports(language)];
+        fallbacks = [backend for backend in candidates if backend.fallback];
+        primary = [backend for backend in candidates if not backend.fallback];
+        if any(backend.local for backend in primary):
+            primary = [backend for backend in primary if backend.local];
+        now = time.time();
+        ranked = sorted(primary, key=lambda backend: (not backend.healthy(now), backend.latency));
+        if len(ranked) > 1 and ranked[1].healthy(now) and random.random() < self.explore_rate:
+            ranked[0], ranked[1] = ranked[1], ranked[0];
+        return ranked + fallbacks;
+    
+    def quotaBound(self, language):
+        # type: (String) -> bool
+        # Returns True if every call made to translate the language counts against a
+        # quota, i.e. it has no local primary backend and its remote ones have a quota
+        primary = [backend for backend in self.backends if backend.supports(language) and not backend.fallback];
+        if any(backend.local for backend in primary):
+            return False;
+        return any(backend.quota is not None for backend in primary);
+    
+    def available(self, language):
+        # type: (String) -> bool
+        # Returns True if any backend that is not a fallback looks able to translate the
+        # language, i.e. it is healthy and, for the API, has calls left
+        now = time.time();
+        return any(backend.healthy(now) for backend in self.backends if backend.supports(language) and not backend.fallback);
+    
+    def translate(self, input_phrase, language, timeout):
+        # type: (String, String, float) -> tuple
+        deadline = time.time() + timeout;
+        states = set();
+        for backend in self.chain(language):
+            remaining = deadline - time.time();
+            if not backend.local and remaining < minimumApiTimeout:
+                states.add("Timed Out");
+                continue;
+            if backend.fallback:
+                logger.info("Using local fallback engine for %s", language);
+            translation, backend_state = backend.translate(input_phrase, language, max(remaining, minimumApiTimeout));
+            if backend_state == "Translated":
+                return translation, "Fallback" if backend.fallback else backend_state;
+            states.add(backend_state);
+        
+        # If no backend manages to translate the phrase, the user is told about the limit
+        # being exceeded first, then that there was no time to wait for an answer, then
+        # about any error, and that the service is unavailable only if every backend was
+        # skipped because its circuit is open
+        for state in ("Limit Exceeded", "Timed Out", "Unauthorized", "Unavailable"):
+            if state in states:
+                return "", state;
+        return "", "Unauthorized";
+    
+    def stats(self):
+        # type: () -> dict
+        return dict((backend.name, backend.stats()) for backend in self.backends);
+
+# The chain of backends is the local engines, the Fun Translations API, an optional
+# alternate endpoint with the same interface set with ftAlternateApiUrl (with its own
+# optional secret and limit, ftAlternateApiSecret and ftAlternateRateLimitCapacity per
+# ftAlternateRateLimitPeriod) and then the fallback engines. A secret for the main API can
+# be set with ftTranslationApiSecret. The moving averages are weighted by ftRoutingAlpha,
+# and a backend with an error rate over ftRoutingMaxErrorRate is tried last until
+# ftRoutingRetrySeconds after its last failure. ftRoutingExploreRate is the share of calls
+# that try the second fastest backend first.
+API_SECRET_HEADER = 'X-Funtranslations-Api-Secret';
+routingSettings = {
+    'alpha': float(os.environ.get('ftRoutingAlpha', '0.2')),
+    'max_error_rate': float(os.environ.get('ftRoutingMaxErrorRate', '0.5')),
+    'retry_after': float(os.environ.get('ftRoutingRetrySeconds', '30'))
+};
+translationRouter = TranslationRouter([
+    LocalEngineBackend('local', localEngines, **routingSettings),
+    FunTranslationsBackend('funtranslations', TRANSLATION_API_URL, rateLimiter if rateLimitEnabled else None,
+                           {API_SECRET_HEADER: os.environ['ftTranslationApiSecret']} if os.environ.get('ftTranslationApiSecret') else None,
+                           circuitBreaker('funtranslations'), **routingSettings)
+], float(os.environ.get('ftRoutingExploreRate', '0.05')));
+if os.environ.get('ftAlternateApiUrl'):
+    translationRouter.register(FunTranslationsBackend(
+        'alternate', os.environ['ftAlternateApiUrl'],
+        TokenBucketRateLimiter(table, '__ratelimit__:alternate',
+                               float(os.environ['ftAlternateRateLimitCapacity']),
+                               float(os.environ.get('ftAlternateRateLimitPeriod', '3600')),
+                               dynamodbBreaker)
+        if os.environ.get('ftAlternateRateLimitCapacity') else None,
+        {API_SECRET_HEADER: os.environ['ftAlternateApiSecret']} if os.environ.get('ftAlternateApiSecret') else None,
+        circuitBreaker('alternate'), **routingSettings));
+translationRouter.register(LocalEngineBackend('fallback', fallbackEngines, fallback=True, **routingSettings));
+
+
+# A lease held on a phrase by the invocation that is translating it. remote is False if
+# the lease could not be written to DynamoDB and is only held within this container.
+TranslationLease = namedtuple('TranslationLease', ['key', 'owner', 'remote']);
+
+""" Single-flight coordination for translating new phrases. When a popular phrase is
+    asked for by many users at once, every invocation would otherwise miss the table at
+    the same time and each would call the rate limited API, synthesise the audio and
+    upload the same file. Instead, only the invocation that takes the lease on the phrase
+    translates it, and the others wait for its result to appear in the table.
+    
+    Within a container, invocations of the same phrase wait on an Event. Across containers
+    the lease is an item in the DynamoDB table, written with a conditional put that only
+    succeeds if there is no lease on the phrase or the existing lease has expired (e.g.
+    because the invocation holding it timed out). Invocations that do not get the lease
+    poll the table for up to wait_seconds. If the translation still is not there, they
+    take the lease over if it has expired, or otherwise give up so the user can ask again.
+"""
+class SingleFlight(object):
+    
+    KEY_NAME = 'OriginalPhraseandLanguage';
+    LEASE_PREFIX = '__lease__|';
+    
+    def __init__(self, dynamodb_table, store, lease_seconds, wait_seconds, poll_interval, breaker=None):
+        # type: (Table, TranslationStore, float, float, float, CircuitBreaker) -> None
+        self.table = dynamodb_table;
+        self.breaker = breaker or CircuitBreaker('dynamodb', 0, 0, False);
+        self.store = store;
+        self.lease_seconds = lease_seconds;
+        self.wait_seconds = wait_seconds;
+        self.poll_interval = poll_interval;
+        self._flights = {};
+        self._lock = threading.Lock();
+    
+    def _acquireLease(self, key, owner):
+        # type: (String, String) -> bool
+        # Raises an exception if DynamoDB cannot be reached or its circuit is open
+        if not self.breaker.allow():
+            raise Exception("Circuit for DynamoDB is open, not taking a lease on {}".format(key));
+        now = time.time();
+        try:
+            self.table.put_item(
+                Item={
+                    SingleFlight.KEY_NAME: SingleFlight.LEASE_PREFIX + key,
+                    'owner': owner,
+                    'expires': int(now + self.lease_seconds),
+                    # Leases left behind by invocations that timed out are removed by
+                    # the table's time to live
+                    'expires_at': int(now + self.lease_seconds) + 3600
+                },
+                ConditionExpression='attribute_not_exists(#key) OR expires < :now',
+                ExpressionAttributeNames={'#key': SingleFlight.KEY_NAME},
+                ExpressionAttributeValues={':now': int(now)}
+            );
+            self.breaker.success();
+            return True;
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+                self.breaker.success();
+                return False;
+            self.breaker.failure();
+            raise;
+    
+    def _dropMiss(self, key):
+        # type: (String) -> None
+        # Removes a miss cached for the key. A translation in the cache is kept, as it may
+        # have just been put there by the owner in this container and, with write-behind,
+        # not be in the table yet
+        if self.store.cache.get(key) is None:
+            self.store.cache.invalidate(key);
+    
+    def _refresh(self, key):
+        # type: (String) -> TranslationItem
+        # Reads the key again, skipping any miss that has been cached for it. A table that
+        # cannot be read is treated as the translation not being there yet
+        self._dropMiss(key);
+        item = self.store.get(key);
+        return None if item is TranslationStore.UNAVAILABLE else item;
+    
+    def _finishLocal(self, key):
+        # type: (String) -> None
+        with self._lock:
+            event = self._flights.pop(key, None);
+        if event is not None:
+            event.set();
+    
+    def join(self, key):
+        # type: (String) -> tuple
+        # Returns (lease, item). If lease is not None, then the caller must translate the
+        # phrase and call release once it is done. Otherwise item is the translation made
+        # by another invocation, or None if it did not finish in time.
+        with self._lock:
+            event = self._flights.get(key);
+            if event is None:
+                self._flights[key] = threading.Event();
+        if event is not None:
+            logger.info("Waiting for translation of %s in this container", key);
+            event.wait(self.wait_seconds);
+            return None, self._refresh(key);
+        
+        owner = str(uuid.uuid4());
+        try:
+            if self._acquireLease(key, owner):
+                return TranslationLease(key, owner, True), None;
+        except Exception as e:
+            # If DynamoDB cannot be reached, the phrase is translated without a lease
+            # rather than not at all
+            logger.error(e);
+            return TranslationLease(key, owner, False), None;
+        
+        logger.info("Waiting for translation of %s by another container", key);
+        deadline = time.time() + self.wait_seconds;
+        while time.time() < deadline:
+            time.sleep(self.poll_interval);
+            item = self._refresh(key);
+            if item is not None:
+                self._finishLocal(key);
+                return None, item;
+        
+        try:
+            if self._acquireLease(key, owner):
+                return TranslationLease(key, owner, True), None;
+        except Exception as e:
+            logger.error(e);
+        self._finishLocal(key);
+        self._dropMiss(key);
+        return None, None;
+    
+    def release(self, lease):
+        # type: (TranslationLease) -> None
+        # Removes the lease, as long as it has not been taken over by someone else
+        if lease.remote and self.breaker.allow():
+            try:
+                self.table.delete_item(
+                    Key={SingleFlight.KEY_NAME: SingleFlight.LEASE_PREFIX + lease.key},
+                    ConditionExpression='#owner = :owner',
+                    ExpressionAttributeNames={'#owner': 'owner'},
+                    ExpressionAttributeValues={':owner': lease.owner}
+                );
+                self.breaker.success();
+            except Exception as e:
+                if getattr(e, 'response', {}).get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+                    logger.error(e);
+                    self.breaker.failure();
+        self._finishLocal(lease.key);
+    
+    def handOff(self, lease):
+        # type: (TranslationLease) -> None
+        # Wakes the invocations waiting in this container without removing the lease, when
+        # the translation is being finished by another invocation that will release it
+        self._finishLocal(lease.key);
+
+# Single-flight translation is on by default and can be turned off by setting the optional
+# ftSingleFlight environment variable to "false". ftLeaseSeconds should be longer than a
+# translation normally takes, and ftLeaseWait is how long other invocations wait for it.
+singleFlightEnabled = os.environ.get('ftSingleFlight', 'true').lower() == 'true';
+translationFlights = SingleFlight(table, translationStore,
+                                  float(os.environ.get('ftLeaseSeconds', '15')),
+                                  float(os.environ.get('ftLeaseWait', '3')),
+                                  float(os.environ.get('ftLeasePollInterval', '0.25')),
+                                  dynamodbBreaker);
+
+# When a new phrase would not be translated and stored before Alexa stops waiting, the rest
+# of the work is finished by invoking this function again asynchronously with the event
+# below, and the user is asked to say repeat in a moment. This is on by default and can be
+# turned off by setting the optional ftAsyncCompletion environment variable to "false".
+# ftTranslateBudgetMs is the time needed to call the API and ftStoreBudgetMs the time
+# needed to synthesise, upload and store the audio once the phrase has been translated.
+asyncCompletion = os.environ.get('ftAsyncCompletion', 'true').lower() == 'true';
+translateBudgetMs = int(os.environ.get('ftTranslateBudgetMs', '2000'));
+storeBudgetMs = int(os.environ.get('ftStoreBudgetMs', '2500'));
+DEFERRED_EVENT_KEY = 'ftDeferredTranslation';
+
+# Number of translations kept in the session's history for repeat and replay, and the
+# rough limit on the size of the history in characters, set with the optional
+# ftHistoryLength and ftHistoryMaxChars environment variables
+historyLength = int(os.environ.get('ftHistoryLength', '5'));
+historyMaxChars = int(os.environ.get('ftHistoryMaxChars', '6000'));
+DEGRADED_AUDIO_SPEECH = "Sorry, I can't make the audio for translations right now. Please try again in a few minutes.";
+UNAVAILABLE_SPEECH = "Sorry, I can't reach the translation service right now. Please try again in a few minutes.";
+DEFERRED_SPEECH = ("I'm still working on that translation. Say repeat in a moment to hear it, "
+                   "or ask me to translate something else.");
+
+
 
 """ Handler used to launch skill and reply to initial skill prompt and reset the
     session attributed every time a new session is started
@@ -89,8 +1864,10 @@ class SessionEndedRequestHandler(AbstractRequestHandler):
     def handle(self, handler_input):
         # type: (HandlerInput) -> Response
         logger.info("In SessionEndedRequestHandler");
-        print("Session ended with reason: {}".format(
-            handler_input.request_envelope));
+        # Only the reason and any error are logged, rather than the whole request envelope
+        request = handler_input.request_envelope.request;
+        logger.debug("Session ended with reason: %s, error: %s",
+                     getattr(request, 'reason', None), getattr(request, 'error', None));
         return handler_input.response_builder.response;
 
 """ Handler used when user asks for help, to provide user with information about 
@@ -229,113 +2006,168 @@ class FunTranslateIntentHandler(AbstractRequestHandler):
         # Initialising the necessary session attributes from previous requests that will
         # need to be utilised for the translation, in particular the sentence that needs 
         # to be translated and the language that has been set previously by the user
-        # A String variable "key" is created by combining the sentence (stripped of whitespace)
+        # A String variable "key" is created by combining the canonical form of the sentence
         # and the selected language - this key is used as the key input for the DynamoDB table and
         # in the file path of the S3 object under which the audio file is saved.
         # A hash is also made of the key to be utilised later in the filepath of the S3 object
         logger.info("In FunTranslateIntentHandler");
+        
+        # The time the response has to be sent by is worked out first, as waiting for the
+        # table or for another invocation's translation also uses up the time Alexa waits
+        deadline = invocationDeadline(handler_input)
         attr = handler_input.attributes_manager.session_attributes;
         selected_language = attr.get("language").lower().replace(" ", "");
         sentence = handler_input.request_envelope.request.intent.slots["sentence"].value;
-        key = sentence.replace(" ","")+selected_language;
+        key = canonicalKey(sentence, selected_language);
         md5 = (hashlib.md5(key.encode('utf-8'))).hexdigest();
+        
+        # Asking for a new phrase moves the replay position back to the newest translation,
+        # even if the phrase then fails, so that repeat never plays an older phrase
         attr["last file key"] = key;
+        attr["history position"] = 0;
+        
+        # The in-process cache and then the dynamoDB are checked to see if they contain
+        # the translation for the phrase that has been spoken and the target translation
+        # language. This is handled within the translation store
+        tableEntry = translationStore.get(key)
+        
+        # If the table cannot be read, then it is not known whether the phrase has been
+        # translated and the API's limit cannot be checked either, so the user is told
+        # straight away rather than the phrase being sent to the API. Phrases that are
+        # translated locally are still translated, as they do not use up any calls.
+        if tableEntry is TranslationStore.UNAVAILABLE:
+            if translationRouter.quotaBound(selected_language):
+                stageMetrics.tag(Language=selected_language, Cache='unavailable');
+                return handler_input.response_builder.speak(UNAVAILABLE_SPEECH).set_should_end_session(False).response;
+            tableEntry = None
         
-        # The dynamoDB is checked first to see if it contains the translation for the 
-        # phrase that has been spoken and the target translation language. This is handled within
-        # the queryDynamoDB function below
-        table_query_bool = queryDynamoDB(key)
+        # A translation made by a fallback engine is only used until the API can translate
+        # the phrase again, so the phrase is translated from the start once it has calls left
+        if tableEntry is not None and tableEntry.fallback and translationRouter.available(selected_language):
+            logger.info("Translating %s again, as it was translated by a fallback engine", key);
+            tableEntry = None
+        stageMetrics.tag(Language=selected_language, Cache='hit' if tableEntry is not None else 'miss');
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Translation cache stats: %s", translationCache.stats())
         
-        # Checking whether the table has entries and whether the required translation has been found
-        if table != {} and table_query_bool:
+        # If the phrase has not been translated yet, then single-flight is used to make sure
+        # only one invocation translates it. Either this invocation gets the lease and goes
+        # on to translate the phrase, or it gets back the translation made by another one.
+        lease = None
+        if tableEntry is None and singleFlightEnabled:
+            lease, tableEntry = translationFlights.join(key)
+        
+        # Everything after the lease is taken is wrapped in a try-finally block, so that the
+        # lease is released even if the translation fails with an unexpected error
+        try:
+            # Checking whether the required translation has been found
+            if tableEntry is not None:
             
-            # The table entry is then retrieved, as it contains the URL of the S3 bucket where the 
-            # translation is stored and the audio is played back to the user from the S3 bucket's
-            # URL. The entire process is wrapped in a try-catch block to avoid any errors that arise from
-            # trying to access the methods from the boto3 resource used for DynamoDB
-            try:
-                tableEntry = table.get_item(
-                        Key={
-                            'OriginalPhraseandLanguage': key
-                        }
-                    );
-                # As the "sentence" variable is formatted to match the dictionary entry,
-                # the value for pig latin is formatted to include a whitespace so 
-                # it can be replayed back to the user accurately.
-                if selected_language == "piglatin":
-                    selected_language = "pig latin"
-                output = handler_input.response_builder.speak('The translation of the phrase {} in {} is: '.format(sentence, selected_language) + tableEntry['Item']['value']['url'] +
-                                                                ' You can ask me to repeat the sentence by saying repeat, or ask me to translate something else. Remember, you can only translate 5 sentences in the space of an hour' ).set_should_end_session(False);
-            except Exception as e:
+                # The table entry contains the URL of the S3 bucket where the translation
+                # is stored and the audio is played back to the user from the S3 bucket's
+                # URL. The entire process is wrapped in a try-catch block to avoid any errors
+                # that arise from entries that are not in the expected format
+                try:
+                    # As the "sentence" variable is formatted to match the dictionary entry,
+                    # the value for pig latin is formatted to include a whitespace so 
+                    # it can be replayed back to the user accurately.
+                    rememberTranslation(attr, key, tableEntry.translation, tableEntry.url)
+                    if selected_language == "piglatin":
+                        selected_language = "pig latin"
+                    output = handler_input.response_builder.speak('The translation of the phrase {} in {} is: '.format(sentence, selected_language) + tableEntry.url +
+                                                                    ' You can ask me to repeat the sentence by saying repeat, or ask me to translate something else. Remember, you can only translate 5 sentences in the space of an hour' ).set_should_end_session(False);
+                except Exception as e:
                 
-                # Any exceptions are caught and relayed back to the user as an error
-                logger.info("Could not access DynamoDB entry properly");
-                output = handler_input.response_builder.speak("I am sorry, there was an error during translation");
+                    # Any exceptions are caught and relayed back to the user as an error
+                    logger.info("Could not access DynamoDB entry properly");
+                    output = handler_input.response_builder.speak("I am sorry, there was an error during translation");
         
-        # If no entry is found in the DynamoDB table, then the phrase is translated from the start
-        else:
+            # If another invocation is still translating the phrase, the user is asked to
+            # repeat it in a moment rather than translating it a second time
+            elif singleFlightEnabled and lease is None:
+                output = handler_input.response_builder.speak("I'm still working on that translation. Please say repeat in a moment to hear it.").set_should_end_session(False);
+        
+            # If no entry is found in the DynamoDB table, then the phrase is translated from the start
+            else:
             
-            # The translateToTarget utility function is used to retrieve the translation of the input phrase
-            translation = translateToTarget(sentence, selected_language, handler_input)
-            logger.info(translation)
+                # The translation is made in stages (translating the phrase, then synthesising,
+                # uploading and storing the audio) and the time left before Alexa stops waiting
+                # is checked before each one. If a stage would not finish in time, then the rest
+                # of the work is handed over to an asynchronous invocation of this function and
+                # the user is asked to say repeat in a moment, once it has been stored.
+                job = {'key': key, 'md5': md5, 'sentence': sentence, 'language': selected_language}
             
-            # If any errors occured while getting the translation back from the API
-            # then an error phrase is played back to the user or if the API limit 
-            # is exceeded then the session is immediately ended as no further 
-            # translations would be possible anyway
-            if attr["translation_state"] == "Unauthorized":
-                output = handler_input.response_builder.speak("I'm sorry, the sentence could not be translated. Please try saying something else")
-            elif attr["translation_state"] == "Limit Exceeded":
-                output = handler_input.response_builder.speak("I'm sorry, you can only translate 5 sentences or phrases in the space of an hour.".set_should_end_session(True))
-            else:
-                
-                logger.info(selected_language)
+                if (selected_language not in localEngines and not hasTimeFor(deadline, translateBudgetMs)
+                        and deferTranslation(handler_input, job, lease)):
+                    output = handler_input.response_builder.speak(DEFERRED_SPEECH).set_should_end_session(False);
+                    lease = None
+                else:
                 
-                # The translated phrase is converted to speech using Amazon Polly and
-                # the voice dictionary entry corresponding to the set language
-                response = synthesizeSpeech(translation, voices[selected_language]);
+                    # Utterances of more than one sentence or clause are split into segments
+                    # that are looked up, translated and stored separately by the
+                    # translateSegments utility function, which also stores the whole
+                    # utterance. Otherwise the translateToTarget utility function is used to
+                    # retrieve the translation of the input phrase
+                    segments = splitSegments(sentence) if segmentationEnabled else [sentence]
+                    url = None
+                    error = None
+                    if len(segments) > 1:
+                        translation, url, attr["translation_state"], error = translateSegments(key, segments, selected_language, getApiTimeout(handler_input))
+                    else:
+                        translation = translateToTarget(sentence, selected_language, handler_input)
+                        logger.debug("Translation: %s", translation)
                 
-                # A check is done to ensure that the audio file has been generated properly
-                if (response != {}):
-                    logger.info("Uploading Audio File to S3");
+                    # If any errors occured while getting the translation back from the API
+                    # then an error phrase is played back to the user or if the API limit 
+                    # is exceeded then the session is immediately ended as no further 
+                    # translations would be possible anyway. If the API did not answer
+                    # before the reply had to be sent, the translation is handed over to
+                    # an asynchronous invocation that can wait longer for it instead
+                    if attr["translation_state"] == "Timed Out" and deferTranslation(handler_input, job, lease):
+                        output = handler_input.response_builder.speak(DEFERRED_SPEECH).set_should_end_session(False);
+                        lease = None
+                    elif attr["translation_state"] in ("Unauthorized", "Timed Out"):
+                        output = handler_input.response_builder.speak("I'm sorry, the sentence could not be translated. Please try saying something else")
+                    elif attr["translation_state"] == "Unavailable":
+                        # Every way of translating the phrase is known to be down, so the user
+                        # is told straight away rather than after the API times out
+                        output = handler_input.response_builder.speak(UNAVAILABLE_SPEECH).set_should_end_session(False)
+                    elif attr["translation_state"] == "Limit Exceeded":
+                        # The user is told roughly how long they have to wait before they can
+                        # translate again, based on the shared rate limiter
+                        wait_minutes = int(rateLimiter.status()['next_call_in_seconds'] // 60) + 1
+                        output = handler_input.response_builder.speak("I'm sorry, you can only translate 5 sentences or phrases in the space of an hour. "
+                                                                      "You can translate again in about {} minute{}.".format(wait_minutes, "" if wait_minutes == 1 else "s")).set_should_end_session(True)
+                    elif (url is None and error is None and not hasTimeFor(deadline, storeBudgetMs)
+                            and deferTranslation(handler_input, dict(job, translation=translation, fallback=attr["translation_state"] == "Fallback"), lease)):
+                        output = handler_input.response_builder.speak(DEFERRED_SPEECH).set_should_end_session(False);
+                        lease = None
+                    else:
                     
-                    # The audio file is then uploaded to the S3 bucket using the
-                    # utility function putFileIntoS3Bucket, and the key, md5 hash
-                    # and Audio Stream are used as parameters. Since the audio file 
-                    # is received as a StreamingBody object, the read method is used
-                    # so that the stream can be inputted as bytes and uploaded 
-                    # properly to the S3 bucket.
-                    file_upload_bool = putFileIntoS3Bucket(key, md5, response['AudioStream'].read());
+                        # The translation is turned into speech and stored using the
+                        # storeTranslation utility function below, which gives back the SSML
+                        # to play or the error to tell the user about
+                        if url is None and error is None:
+                            url, error = storeTranslation(key, md5, translation, selected_language, attr["translation_state"] == "Fallback")
+                        if url is not None:
                         
-                    # Check to see if the file has been uploaded to the S3 bucket properly or not.
-                    # If it has not been, the user is alerted about the error.
-                    if file_upload_bool == True:
+                            # The translation is added to the session's history so that it
+                            # can be repeated without looking it up again
+                            rememberTranslation(attr, key, translation, url)
                         
-                        # The url for the audio file is formatted in SSML according
-                        # to the format of the S3 bucket's url so that it can be 
-                        # embedded into Alexa's response and accessed  directly 
-                        # during the speech response itself.
-                        url = ' <audio src= "https://{}.s3.amazonaws.com/{}/{}/translated.mp3?region=eu-west-1"/> '.format(bucketName, md5, key);
-                        logger.info(url)
-                        
-                        # As above, if the selected language is pig latin, then
-                        # it is formatted so that it is spoken properly
-                        if selected_language == "piglatin":
-                            selected_language = "pig latin"
-                        output = handler_input.response_builder.speak('The translation of the phrase {} in {} is: '.format(sentence, selected_language) + url +
-                                                                        ' You can ask me to repeat the sentence by saying repeat, or ask me to translate something else. Remember, you can only translate 5 sentences in the space of an hour' ).set_should_end_session(False);
-                        
-                        # Once all the necessary translation steps are taken, then
-                        # the key, translation and url are uploaded to the DynamoDB table
-                        # using the utility function below.
-                        uploadDetailsToDynamoDB(key, translation, url);
-                            
-                    else:
-                            
-                        output = handler_input.response_builder.speak("Sorry there was an issue uploading the file to the S3 bucket");
-                else:
-                            
-                        output = handler_input.response_builder.speak("Uh-oh, the night is dark and full of errors");
+                            # As above, if the selected language is pig latin, then
+                            # it is formatted so that it is spoken properly
+                            if selected_language == "piglatin":
+                                selected_language = "pig latin"
+                            output = handler_input.response_builder.speak('The translation of the phrase {} in {} is: '.format(sentence, selected_language) + url +
+                                                                            ' You can ask me to repeat the sentence by saying repeat, or ask me to translate something else. Remember, you can only translate 5 sentences in the space of an hour' ).set_should_end_session(False);
+                        else:
+                            output = handler_input.response_builder.speak(error);
+        finally:
+
+            # The lease is released once the translation has finished, successfully or not
+            if lease is not None:
+                translationFlights.release(lease)
                 
         return output.response;
         
@@ -369,7 +2201,8 @@ class NoTargetLanguageIntentHandler(AbstractRequestHandler):
 
 """ Handler used to repeat the translated phrase back to the user, when they wish to hear
     it again. The handler uses the last file key session attribute logged when the phrase 
-    is initially translated 
+    is initially translated. For audio profiles that make the slow repeat lazily, the
+    slow repeat is played instead.
 """    
 class RepeatIntentHandler(AbstractRequestHandler):
     
@@ -390,36 +2223,50 @@ class RepeatIntentHandler(AbstractRequestHandler):
         # something has been translated previously
         attr = handler_input.attributes_manager.session_attributes;
         
-        # Checks if whether any session attributes have been set or if specifically
-        # the last file key session attribute has been set as this is what drives the
-        # repitition of the phrase.
-        if attr == {}:
+        # Checks if the last file key session attribute has been set as this is what
+        # drives the repitition of the phrase. It is missing until a phrase has been
+        # translated, e.g. when only the language has been set so far.
+        if attr.get("last file key") is None:
             
             outputSpeech = ('Sorry, it seems as though you have not said anything before for me to repeat. '
                             'Please firstly say a phrase for me to translate.');
-                            
-        elif attr["last file key"] is None:
+        
+        # The translation being listened to is usually in the session's history, in which
+        # case it is played straight from there without any calls to AWS. This is the last
+        # translation, or an earlier one if the user has asked for the one before.
+        elif historyEntry(attr) is not None:
             
-            outputSpeech = ('Sorry, it seems as though you have not said anything before for me to repeat. '
-                            'Please firstly say a phrase for me to translate.');
+            # The slow repeat is kept in the history entry once it has been made, so that
+            # it is only looked for once
+            entry = historyEntry(attr);
+            slow = entry.get("slow ssml") or slowRepeatSsml(entry["key"], entry["translation"], invocationDeadline(handler_input));
+            if slow:
+                entry["slow ssml"] = slow;
+            outputSpeech = slow or entry["ssml"];
         else:
             
             # Try-catch block catches any exceptions caused due to accessing the 
             # boto3 resource.
             try:
                 # Based on the last key entered into the session attributes,
-                # the previous entry is retrieved from the DynamoDB table and
-                # the url of the received table entry is extracted so that the 
+                # the previous entry is retrieved from the cache or the DynamoDB table
+                # and the url of the received table entry is extracted so that the 
                 # translated phrase alone can be repeated back to the user
-                tableEntry = table.get_item(
-                    Key={
-                        'OriginalPhraseandLanguage': attr["last file key"]
-                    }
-                );
-                logger.info(tableEntry)
+                tableEntry = translationStore.get(attr["last file key"])
                 
-                # The URL is retrieved from the table entry dictionary
-                outputSpeech = tableEntry['Item']['value']['url'] 
+                # If the translation is still being finished asynchronously, then the
+                # user is asked to try again, and the miss is not kept in the cache so
+                # that the next repeat reads the table again
+                if tableEntry is TranslationStore.UNAVAILABLE:
+                    outputSpeech = UNAVAILABLE_SPEECH
+                elif tableEntry is None:
+                    translationStore.cache.invalidate(attr["last file key"]);
+                    outputSpeech = DEFERRED_SPEECH
+                else:
+                    # The URL is retrieved from the table entry, and the translation is
+                    # added to the history so the next repeat is played from there
+                    outputSpeech = slowRepeatSsml(tableEntry.key, tableEntry.translation, invocationDeadline(handler_input)) or tableEntry.url 
+                    rememberTranslation(attr, tableEntry.key, tableEntry.translation, tableEntry.url)
                 
                 
             except Exception as e:
@@ -428,129 +2275,585 @@ class RepeatIntentHandler(AbstractRequestHandler):
             
         # The phrase to repeat is played back to the user
         return handler_input.response_builder.speak(outputSpeech).set_should_end_session(False).response;
+
+""" Handler used to play back the translation from before the one the user last heard,
+    e.g. "replay the one before". Asking again goes further back through the session's
+    history, and saying repeat afterwards repeats the translation that was replayed.
+    Everything is played from the history, so no calls to AWS are made.
+"""
+class ReplayPreviousIntentHandler(AbstractRequestHandler):
+    
+    def can_handle(self, handler_input):
+        # type: (HandlerInput) -> bool
+        return is_intent_name("ReplayPreviousIntent")(handler_input);
+    
+    def handle(self, handler_input):
+        # type: (HandlerInput) -> Response
+        
+        logger.info("In ReplayPreviousIntentHandler");
+        attr = handler_input.attributes_manager.session_attributes;
+        position = attr.get("history position", 0) + 1;
+        entry = historyEntry(attr, position);
+        
+        if entry is None:
+            outputSpeech = ("Sorry, there is nothing before that for me to replay. "
+                            "You can ask me to translate something else.");
+        else:
+            attr["history position"] = position;
+            outputSpeech = "Before that, you translated {}: ".format(entry["key"].split(KEY_DELIMITER)[0]) + entry["ssml"];
+        
+        return handler_input.response_builder.speak(outputSpeech).set_should_end_session(False).response;
         
 # Utility functions
+""" Function used to add a translation to the history of the session, kept in the
+    session attributes as a list of the key, translation and SSML of the last few
+    translations, newest last. The history is bounded to historyLength entries and to
+    about historyMaxChars characters in total, dropping the oldest entries first, so that
+    the session attributes sent back and forth with every request stay small. The
+    translation text is left out of entries that would not fit otherwise. Making a new
+    translation also moves the replay position back to the newest one, as does asking for
+    a new phrase in the translate handler.
+"""
+def rememberTranslation(attr, key, translation, ssml):
+    # type: (dict, String, String, String) -> None
+    if historyLength <= 0 or not ssml:
+        return;
+    history = [entry for entry in attr.get("history") or [] if entry.get("key") != key];
+    entry = {"key": key, "translation": translation, "ssml": ssml};
+    if len(json.dumps(entry)) > historyMaxChars:
+        entry["translation"] = None;
+    history.append(entry);
+    history = history[-historyLength:];
+    while len(history) > 1 and len(json.dumps(history)) > historyMaxChars:
+        history.pop(0);
+    attr["history"] = history;
+    attr["history position"] = 0;
+
+""" Function used to get an entry of the session's history, position entries back from
+    the newest one, or from the replay position by default. None is returned if there
+    is no such entry, or if the newest entry is not the last phrase the user asked for
+    (e.g. because it is still being translated asynchronously).
+"""
+def historyEntry(attr, position=None):
+    # type: (dict, int) -> dict
+    history = attr.get("history") or [];
+    if position is None:
+        position = attr.get("history position", 0);
+    if not history or position < 0 or position >= len(history):
+        return None;
+    if position == 0 and history[-1].get("key") != attr.get("last file key"):
+        return None;
+    return history[-1 - position];
+
+""" Function used to turn a translation into speech and store it, once it has been
+    translated. In SSML response mode the translation is spoken by Alexa directly with the
+    SSML voice tag, otherwise the audio file is synthesised by Polly and uploaded to the S3
+    bucket. In both cases the translation is then stored in the DynamoDB table, as a
+    fallback translation if it was made by a fallback engine. Returns the SSML to play
+    back to the user, or None and the error to tell the user about instead.
+"""
+def storeTranslation(key, md5, translation, language, fallback=False):
+    # type: (String, String, String, String, bool) -> tuple
+    
+    if responseMode == 'ssml' and voices[language] in ALEXA_SSML_VOICES:
+        
+        # In SSML response mode the translation is spoken by Alexa directly in the
+        # Polly voice for the language, using the SSML voice tag, so there is no
+        # audio file to synthesise, upload or download. The SSML is stored in the
+        # DynamoDB table in place of the audio tag so it can be repeated later.
+        url = inlineVoiceSsml(translation, voices[language], audioProfile(language).slow_repeat == 'inline');
+        uploadDetailsToDynamoDB(key, translation, url, fallback);
+        return url, None;
+    
+    # While the circuit for Polly or S3 is open the audio file cannot be made, so the
+    # translation is spoken by Alexa directly if it supports the voice. This is not stored,
+    # so that the audio file is made next time once they are back. Otherwise the user is
+    # told straight away, rather than after waiting for Polly or S3 to time out.
+    if pollyBreaker.isOpen() or s3Breaker.isOpen():
+        if voices[language] in ALEXA_SSML_VOICES:
+            return inlineVoiceSsml(translation, voices[language]), None;
+        return None, DEGRADED_AUDIO_SPEECH;
+    
+    logger.debug("Storing translation of %s in %s", key, language)
+    profile = audioProfile(language);
+    
+    # When audio is content addressed, the audio file is stored under a hash
+    # of the translated text, the voice and the audio profile rather than under
+    # the phrase, so that every phrase with the same translation shares one audio
+    # file. If that file is known to exist already, then nothing needs to be
+    # synthesised or uploaded and only the DynamoDB entry for this phrase is written.
+    if contentAddressedAudio:
+        object_key = sharedAudioKey(translation, voices[language], profile);
+        shared_audio_bool = audioCache.get(object_key) is True or (audioExistsCheck and audioExists(object_key));
+    else:
+        object_key = audioObjectKey(key, md5, profile);
+        shared_audio_bool = False;
+    
+    # The translated phrase is converted to speech using Amazon Polly and
+    # the voice dictionary entry corresponding to the set language, encoded
+    # as set by the audio profile for the language
+    if shared_audio_bool:
+        logger.info("Reusing existing audio file %s", object_key);
+        response = None;
+    else:
+        response = synthesizeSpeech(translation, voices[language], profile);
+    
+    # A check is done to ensure that the audio file has been generated properly
+    if response == {}:
+        return None, "Uh-oh, the night is dark and full of errors";
+    
+    # The url for the audio file is formatted in SSML according
+    # to the format of the S3 bucket's url so that it can be 
+    # embedded into Alexa's response and accessed  directly 
+    # during the speech response itself. It only depends on the
+    # bucket and object key so it is known before the file is uploaded.
+    url = audioUrl(object_key);
+    logger.debug("Audio url: %s", url)
+    
+    # The audio file is then uploaded to the S3 bucket using the
+    # utility function putFileIntoS3Bucket, and the key, md5 hash
+    # and Audio Stream are used as parameters. The audio file is
+    # received as a StreamingBody object, which is read and closed
+    # by putFileIntoS3Bucket.
+    if shared_audio_bool:
+        file_upload_bool = True;
+    elif concurrentUploads:
+        # The upload to S3 and the write to DynamoDB are independent,
+        # so they are run at the same time on the shared thread pool.
+        # If the upload fails, then the DynamoDB entry is removed again
+        # so that it does not point to a file that does not exist.
+        results = runConcurrently({
+                    'S3 upload': (putFileIntoS3Bucket, (key, md5, response['AudioStream'], object_key)),
+                    'DynamoDB write': (uploadDetailsToDynamoDB, (key, translation, url, fallback))
+                  }, uploadTimeout);
+        file_upload_bool = results['S3 upload'] == True;
+        if not file_upload_bool and results['DynamoDB write']:
+            translationStore.delete(key);
+    else:
+        logger.info("Uploading Audio File to S3");
+        file_upload_bool = putFileIntoS3Bucket(key, md5, response['AudioStream'], object_key);
+    
+    # Check to see if the file has been uploaded to the S3 bucket properly or not.
+    # If it has not been, the user is alerted about the error.
+    if file_upload_bool != True:
+        return None, "Sorry there was an issue uploading the file to the S3 bucket";
+    
+    # Once all the necessary translation steps are taken, then
+    # the key, translation and url are uploaded to the DynamoDB table
+    # using the utility function below, unless this has already been
+    # done alongside the upload.
+    if shared_audio_bool or not concurrentUploads:
+        uploadDetailsToDynamoDB(key, translation, url, fallback);
+    return url, None;
+
+""" Function used to get the slow repeat of a translation, for audio profiles that make it
+    lazily. The slow repeat is synthesised and uploaded next to the audio file of the
+    translation the first time it is asked for, and played from there afterwards (or
+    spoken by Alexa directly in SSML response mode). It is only looked for and made if
+    there are at least ftStoreBudgetMs left before the deadline, unless this container
+    already knows it exists. Returns the SSML to play, or None if the profile of the
+    language has no separate slow repeat or it could not be made in time, in which case
+    the translation is repeated at normal speed instead.
+"""
+def slowRepeatSsml(key, translation, deadline=None):
+    # type: (String, String, float) -> String
+    language = key.rpartition(KEY_DELIMITER)[2];
+    if not translation or language not in voices:
+        return None;
+    profile = audioProfile(language);
+    if profile.slow_repeat != 'lazy':
+        return None;
+    
+    voice = voices[language];
+    if responseMode == 'ssml' and voice in ALEXA_SSML_VOICES:
+        return inlineVoiceSsml(translation, voice, slow=True, normal=False);
+    
+    md5 = hashlib.md5(key.encode('utf-8')).hexdigest();
+    object_key = slowAudioKey(sharedAudioKey(translation, voice, profile) if contentAddressedAudio
+                              else audioObjectKey(key, md5, profile));
+    if audioCache.get(object_key) is True:
+        return audioUrl(object_key);
+    if not hasTimeFor(deadline, storeBudgetMs):
+        logger.info("No time to make slow repeat %s, repeating at normal speed", object_key);
+        return None;
+    if audioExists(object_key):
+        return audioUrl(object_key);
+    
+    logger.info("Synthesising slow repeat %s", object_key);
+    response = synthesizeSpeech(translation, voice, profile, slow_only=True);
+    if response == {} or not putFileIntoS3Bucket(key, md5, response['AudioStream'], object_key):
+        return None;
+    return audioUrl(object_key);
+
+""" Function used to translate a segment of an utterance and store it under its own key,
+    for translateSegments. Returns the translation, the SSML to play, the translation
+    state and the error to tell the user about if it could not be stored.
+"""
+def translateSegment(key, segment, language, timeout):
+    # type: (String, String, String, float) -> tuple
+    translation, state = translatePhrase(segment, language, timeout);
+    if state not in ("Translated", "Fallback"):
+        return translation, None, state, None;
+    url, error = storeTranslation(key, hashlib.md5(key.encode('utf-8')).hexdigest(), translation, language, state == "Fallback");
+    return translation, url, state, error;
+
+""" Function used to translate an utterance made up of more than one segment. The
+    segments are looked up in a single batch, the ones that have not been translated
+    before are translated, synthesised and stored at the same time on the segment pool,
+    and the SSML of the segments is then joined together in order. The whole utterance
+    is stored under its own key as well, so that it can be repeated and is found straight
+    away next time. Returns the translation, the SSML, the translation state, which is the
+    first state other than "Translated" or "Fallback" of any segment, and the error to
+    tell the user about if any segment could not be stored. If any segment was translated
+    by a fallback engine, the state is "Fallback" and the utterance is stored as a
+    fallback translation.
+    
+    Every segment translated takes a call from the quota of languages translated by the
+    API, so for those the segments are only translated separately if at most one of them
+    is missing. Otherwise the whole utterance is translated in one call and stored as a
+    single translation, so that an utterance never uses more than one call and no calls
+    are spent on segments of an utterance that then runs out of quota.
+"""
+def translateSegments(key, segments, language, timeout):
+    # type: (String, list, String, float) -> tuple
+    
+    keys = [canonicalKey(segment, language) for segment in segments];
+    found = translationStore.batch_get(keys);
+    results = dict((segment_key, (item.translation, item.url, "Translated", None)) for segment_key, item in found.items());
+    
+    tasks = OrderedDict();
+    for segment_key, segment in zip(keys, segments):
+        if segment_key not in results and segment_key not in tasks:
+            tasks[segment_key] = (translateSegment, (segment_key, segment, language, timeout));
+    if len(tasks) > 1 and translationRouter.quotaBound(language):
+        logger.info("Translating all %d segments in one call, as %d are missing", len(segments), len(tasks));
+        return translateSegment(key, ' '.join(segments), language, timeout);
+    logger.info("Translating %d of %d segments", len(tasks), len(segments));
+    if tasks:
+        for segment_key, result in runConcurrently(tasks, timeout + uploadTimeout, segmentPool).items():
+            results[segment_key] = result if result != False else ("", None, "Unauthorized", None);
+    
+    for segment_key in keys:
+        translation, url, state, error = results[segment_key];
+        if state not in ("Translated", "Fallback"):
+            return None, None, state, None;
+        if url is None:
+            return None, None, state, error or "Uh-oh, the night is dark and full of errors";
+    
+    translation = ' '.join(results[segment_key][0] for segment_key in keys);
+    url = ''.join(results[segment_key][1] for segment_key in keys);
+    fallback = any(results[segment_key][2] == "Fallback" for segment_key in keys);
+    uploadDetailsToDynamoDB(key, translation, url, fallback);
+    return translation, url, "Fallback" if fallback else "Translated", None;
+
 """ Function used to make API call to translate the input phrase from English into
     set target language. Based on the language that has been set as the language option,
     the function will call the relevant API path and translate the phrase into the 
-    target language. 
+    target language. Languages that have an engine in localEngines are translated
+    locally instead, and those with an engine in fallbackEngines are translated
+    locally whenever the API call does not succeed.
 """
 def translateToTarget(input_phrase, language, handler_input):
     # type: (String, String, HandlerInput) -> String
     
-    # The return variable is initialized and session attributes are received
-    translation = "";
+    # The session attributes are received so that the translation state can be set for
+    # the fun translate handler, and the time the API has to answer in is worked out from
+    # the time left in the invocation
     attr = handler_input.attributes_manager.session_attributes;
+    with stageMetrics.stage('translate'):
+        translation, attr["translation_state"] = translatePhrase(input_phrase, language, getApiTimeout(handler_input));
+    return translation;
+
+""" Function used to translate the input phrase into the target language, used both by
+    translateToTarget and when a translation is completed asynchronously. The phrase is
+    translated by the first backend in the language's chain that manages to, see
+    TranslationRouter. Returns the translation and its state: "Translated", "Fallback",
+    "Limit Exceeded", "Timed Out", "Unauthorized" or "Unavailable".
+"""
+def translatePhrase(input_phrase, language, timeout):
+    # type: (String, String, float) -> tuple
+    return translationRouter.translate(input_phrase, language, timeout);
+
+""" Function used to work out how long the API call can take, in seconds. The Lambda
+    context tells us how much time is left in the invocation, which is capped at the time
+    Alexa waits for a response, and the time needed for the rest of the translation is
+    kept back from it. This margin is never given to the API, so that there is always time
+    left to hand the translation over and reply if the API does not answer in time.
+"""
+def getApiTimeout(handler_input):
+    # type: (HandlerInput) -> float
     
-    # The URL of the API is formatted to match the request format required to 
-    # obtain the translated response from the API
-    url = ('https://api.funtranslations.com/translate/'+
-                language + 
-                '.json?text=' + 
-                input_phrase
-                );
+    context = getattr(handler_input, 'context', None);
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return defaultApiTimeout;
+    remaining_ms = min(context.get_remaining_time_in_millis(), responseDeadlineMs);
+    return max(0.0, (remaining_ms - deadlineReserveMs) / 1000.0);
+
+""" Function used to work out when the response has to be sent by, as an epoch time in
+    seconds. This is the earlier of the end of the invocation and the time Alexa stops
+    waiting for the response, or None if the Lambda context is not known.
+"""
+def invocationDeadline(handler_input):
+    # type: (HandlerInput) -> float
+    
+    context = getattr(handler_input, 'context', None);
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return None;
+    return time.time() + min(context.get_remaining_time_in_millis(), responseDeadlineMs) / 1000.0;
+
+""" Function used to check whether there is at least budget_ms left before the deadline.
+    There is always time when the deadline is not known.
+"""
+def hasTimeFor(deadline, budget_ms):
+    # type: (float, int) -> bool
+    return deadline is None or (deadline - time.time()) * 1000.0 >= budget_ms;
+
+""" Function used to hand the rest of a translation over to an asynchronous invocation of
+    this function, when it would not finish before Alexa stops waiting. The job holds the
+    key, hash, sentence and language, and the translation if there is one already (with
+    whether it was made by a fallback engine). The lease on the phrase is passed on with
+    it, so that other invocations keep waiting for the result until the asynchronous
+    invocation releases it. Returns False if the invocation could not be made, in which
+    case the translation is carried on inline.
+"""
+def deferTranslation(handler_input, job, lease):
+    # type: (HandlerInput, dict, TranslationLease) -> bool
     
-    # The process of obtaining the response from the API is wrapped in a try-catch
-    # block to avoid any errors occuring while trying to obtain the reponse through
-    # the requests.get method
+    if not asyncCompletion:
+        return False;
+    context = getattr(handler_input, 'context', None);
+    function_name = getattr(context, 'invoked_function_arn', None) or os.environ.get('AWS_LAMBDA_FUNCTION_NAME');
+    if not function_name:
+        return False;
+    
+    job = dict(job);
+    if lease is not None and lease.remote:
+        job['lease_owner'] = lease.owner;
     try:
-        # Using the get method from the Python requests library to access the URL
-        # The timeout limit for the get request is increased to 50 seconds as the 
-        # default timeout limit is only 3 seconds
-        translation_response = requests.get(url, timeout=50)
-        
-        # Response is checked to see if an error is received instead of the 
-        # required translation response. The translation state attribute is set 
-        # based on the exact status code. If the status code is 429, the API's call
-        # limit has been exceeded as it is only possible to call the API 5 times in
-        # the space of an hour. If the status code is 401, then there was an error
-        # whilst accessing the API. Otherwise the required translation is extracted
-        # from the dictionary that is received as a reponse from the API
-        if translation_response.status_code == 429:
-            attr["translation_state"] = "Limit Exceeded"
-        elif translation_response.status_code == 401:
-            attr["translation_state"] = "Unauthorized"
-        else:
-            
-            # The String of the translated response is then extracted into a variable
-            # The String is then manipulated to remove any extra information that 
-            # is included within the response text itself, so that only the translated
-            # text is left. Then the manipulated text is set as the return value.
-            # Finally the translation state is set to translated so that it can be 
-            # used in the fun translate handler
-            txt = translation_response.text;
-            x = txt.find("translated");
-            y = txt.find("text");
-            txt = txt[x:y];
-            x = txt.find(":");
-            y = txt.rfind(",");
-            txt = txt[x+3:y-1];
-            translation = txt;
-            attr["translation_state"] = "Translated";
-    
-    # If any errors occur, then the error is simply logged into CloudWatch
+        lambdaClient.invoke(FunctionName=function_name, InvocationType='Event',
+                            Payload=json.dumps({DEFERRED_EVENT_KEY: job}).encode('utf-8'));
     except Exception as e:
         logger.error(e);
+        return False;
+    logger.info("Deferred translation of %s at the %s stage", job['key'], 'store' if 'translation' in job else 'translate');
     
-    # The translated phrase is finally returned
-    return translation;
+    # Any miss cached for the key is dropped so that repeating the phrase reads the table
+    translationStore.cache.invalidate(job['key']);
+    if lease is not None:
+        translationFlights.handOff(lease);
+    return True;
+
+""" Function used by the asynchronous invocation to finish a deferred translation. The
+    phrase is translated first if that has not been done yet, then it is synthesised and
+    stored as usual, and finally the lease passed on with the job is released.
+"""
+def completeDeferredTranslation(job, context):
+    # type: (dict, LambdaContext) -> dict
+    
+    key = job['key'];
+    logger.info("Completing deferred translation of %s", key);
+    stageMetrics.begin('DeferredTranslation');
+    stageMetrics.tag(Language=job['language']);
+    url = None;
+    error = None;
+    try:
+        translation = job.get('translation');
+        fallback = job.get('fallback', False);
+        segments = splitSegments(job['sentence']) if segmentationEnabled and translation is None else [job['sentence']];
+        if len(segments) > 1:
+            timeout = defaultApiTimeout;
+            if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+                timeout = max(minimumApiTimeout, (context.get_remaining_time_in_millis() - storeBudgetMs) / 1000.0);
+            translation, url, state, error = translateSegments(key, segments, job['language'], timeout);
+            if state not in ("Translated", "Fallback"):
+                error = state;
+        elif translation is None:
+            # Alexa is no longer waiting, so the API can take as long as the invocation
+            # allows while leaving time to store the audio afterwards
+            timeout = defaultApiTimeout;
+            if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+                timeout = max(minimumApiTimeout, (context.get_remaining_time_in_millis() - storeBudgetMs) / 1000.0);
+            with stageMetrics.stage('translate'):
+                translation, state = translatePhrase(job['sentence'], job['language'], timeout);
+            if state not in ("Translated", "Fallback"):
+                error = state;
+            fallback = state == "Fallback";
+        if error is None and url is None:
+            url, error = storeTranslation(key, job['md5'], translation, job['language'], fallback);
+        translationStore.flush();
+    except Exception as e:
+        logger.error(e);
+        error = str(e);
+    finally:
+        if job.get('lease_owner'):
+            translationFlights.release(TranslationLease(key, job['lease_owner'], True));
+        stageMetrics.emit();
+    return {'key': key, 'url': url, 'error': error};
+
+""" Function used to make the GET request to the Fun Translations API, or another
+    endpoint given by its URL, using the pooled HTTP connection. If hedging is enabled and
+    the first request has not been answered after hedgeAfterMs, then a second identical
+    request is sent (as long as the endpoint's rate limiter allows it) and whichever
+    response comes back first is used.
+"""
+def callTranslationApi(language, input_phrase, timeout, url=TRANSLATION_API_URL, headers=None, rate_limiter=None):
+    # type: (String, String, float, String, dict, TokenBucketRateLimiter) -> HTTPResponse
+    
+    url = url.format(language);
+    request = lambda: httpPool.request('GET', url, fields={'text': input_phrase}, headers=headers,
+                                       timeout=urllib3.Timeout(total=timeout));
+    
+    if hedgeAfterMs <= 0 or hedgeAfterMs / 1000.0 >= timeout:
+        return request();
+    
+    deadline = time.time() + timeout;
+    futures = [hedgePool.submit(request)];
+    done, not_done = wait(futures, timeout=hedgeAfterMs / 1000.0);
+    if not done and (rate_limiter is None or rate_limiter.acquire()):
+        logger.info("Sending hedged request to the translation API");
+        futures.append(hedgePool.submit(request));
+    
+    # The first successful response is used, or the last error if both requests fail
+    error = None;
+    pending = set(futures);
+    while pending:
+        done, pending = wait(pending, timeout=max(0.0, deadline - time.time()), return_when=FIRST_COMPLETED);
+        if not done:
+            break;
+        for future in done:
+            if future.exception() is None:
+                return future.result();
+            error = future.exception();
+    raise error if error is not None else urllib3.exceptions.TimeoutError("Translation API did not respond within {} seconds".format(timeout));
+
+""" Function used to build the SSML that has Alexa speak the translated text in the given
+    Polly voice, as an alternative to synthesising an audio file. Like the audio file, the
+    text is spoken once and then again more slowly. Alexa does not support the drc effect
+    used in the audio file so it is left out here.
+"""
+def inlineVoiceSsml(translated_text, voice, slow=True, normal=True):
+    # type: (String, String, bool, bool) -> String
+    text = escape(translated_text);
+    return (' <voice name="{0}">' + ('{1}' if normal else '') +
+            ('<prosody rate="slow"><p>{1}</p></prosody>' if slow else '') + '</voice> '
+            ).format(voice, text);
 
 """ Function used to convert the translated text into an audio file using functionality
     in AWS Polly. The out-of-the-box Polly function "synthesize_speech" is used to convert
     the SSML text into the required audio file with the  Polly voice defined for the language
-    within the voices dictionary above
+    within the voices dictionary above, encoded as set by the audio profile
 """
-def synthesizeSpeech(translated_text, voice):
-    # type: (String, String) -> dict
+def synthesizeSpeech(translated_text, voice, profile=None, slow_only=False):
+    # type: (String, String, AudioProfile, bool) -> dict
     
-    logger.info("In Synthesize Speech Method")
+    logger.debug("In Synthesize Speech Method")
+    profile = profile or defaultAudioProfile;
     # The response return value is initialized as an empty dictionary as the synthesize
     # speech method in Amazon Polly returns a dictionary containing the converted
     # audio file.
     response = {};
     
     # The translated text is embedded into an SSML format so that it can be spoken
-    # properly by Alexa, with the correct effects. It is repeated twice, with a slower 
-    # speaking voice the second time to allow the user to hear the translated text 
-    # again.
-    SSML = ('<speak><amazon:effect name="drc">'+
-            translated_text + '</amazon:effect><prosody rate= "slow">' +
+    # properly by Alexa, with the correct effects. With the inline slow repeat it is
+    # repeated twice, with a slower speaking voice the second time to allow the user
+    # to hear the translated text again. The slow repeat can also be made on its own.
+    normal = '<amazon:effect name="drc">' + translated_text + '</amazon:effect>';
+    slow = ('<prosody rate= "slow">' +
             '<amazon:effect name="drc"><p>' + translated_text +
-            '</p></amazon:effect></prosody></speak>'
+            '</p></amazon:effect></prosody>'
             );
+    if slow_only:
+        SSML = '<speak>' + slow + '</speak>';
+    elif profile.slow_repeat == 'inline':
+        SSML = '<speak>' + normal + slow + '</speak>';
+    else:
+        SSML = '<speak>' + normal + '</speak>';
+    
+    # Nothing is sent to Polly while its circuit is open
+    if not pollyBreaker.allow():
+        logger.info("Circuit for Polly is open, not synthesising speech");
+        return response;
     
     # This process of speech synthesis is wrapped in a try-catch block to catch
     # any client errors that may be caused by the Polly client.
     try:
         # The synthesize speech method from the Polly client is used to get back
         # the converted speech file. The input parameters indicate that the output
-        # file should be in mp3 format, the audio fequency should be 22050Hz, the 
+        # file should be in the format and audio frequency of the profile, the 
         # input text is in SSML format and the Polly voice to use should be the one
         # provided when the method is called.
-        response = polly.synthesize_speech(OutputFormat = 'mp3',
-                                SampleRate='22050',
-                                Text = SSML,
-                                TextType = 'ssml',
-                                VoiceId = voice
-                                );
+        with stageMetrics.stage('synthesize_speech'):
+            response = polly.synthesize_speech(OutputFormat = profile.format,
+                                    SampleRate=profile.sample_rate,
+                                    Text = SSML,
+                                    TextType = 'ssml',
+                                    VoiceId = voice
+                                    );
+        pollyBreaker.success();
     except Exception as e:
         logger.error(e);
+        pollyBreaker.failure();
     
     # The response dictionary is finally returned, and is used in the fun translate
     # handler
     return response;
 
+""" Function used to check whether an audio file is already stored in the S3 bucket.
+    Files known to exist are remembered by the container so that head_object is only
+    called once per file. Any errors are treated as the file not existing, so that it
+    is synthesised again rather than a broken link being played.
+"""
+def audioExists(object_key):
+    # type: (String) -> bool
+    if audioCache.get(object_key) is True:
+        return True;
+    if not s3Breaker.allow():
+        return False;
+    try:
+        s3.head_object(Bucket=bucketName, Key=object_key);
+    except Exception as e:
+        if getattr(e, 'response', {}).get('Error', {}).get('Code') not in ('404', 'NoSuchKey', 'NotFound'):
+            logger.error(e);
+            s3Breaker.failure();
+        else:
+            s3Breaker.success();
+        return False;
+    s3Breaker.success();
+    audioCache.put(object_key, True);
+    return True;
+
 """ Function used to upload the audio file into the S3 bucket for storage. It takes 
     in the String key which will be the combination of sentence to be translated and the 
     target language, as well as the md5 hashed value of the key to place the audio file 
-    into the S3 bucket for easy access.
+    into the S3 bucket for easy access. The audio can either be given as bytes or as
+    a stream, such as the StreamingBody returned by Polly, which is read in full and
+    closed. Polly's audio is small (under about 1 MB even for the longest text it takes,
+    and usually tens of KB), so it is uploaded with a single put_object.
+    An object key can be given to store the file somewhere other than under the phrase,
+    e.g. the shared, content addressed key of the audio.
 """
-def putFileIntoS3Bucket(key, hash_val, audio_stream):
-    # type: (String, String) -> bool
+def putFileIntoS3Bucket(key, hash_val, audio_stream, object_key=None):
+    # type: (String, String, object, String) -> bool
     
     # The object key for the audio file so that it can be uniquely identified 
     # when the audio file is being retrieved.
-    keyVal = "{}/{}/translated.mp3".format(hash_val, key)
+    keyVal = object_key or audioObjectKey(key, hash_val)
+    
+    # The stream is read to the end, which for Polly's StreamingBody also checks that
+    # all of it was received, and is closed whether or not that succeeds so that the
+    # connection to Polly is released
+    if hasattr(audio_stream, 'read'):
+        try:
+            with closing(audio_stream):
+                audio_stream = audio_stream.read();
+        except Exception as e:
+            logger.error(e);
+            return False;
+    
+    # Nothing is uploaded while the circuit for S3 is open
+    if not s3Breaker.allow():
+        logger.info("Circuit for S3 is open, not uploading %s", keyVal);
+        return False;
     
     # Try-catch put in for same reason as above
     try:
@@ -561,7 +2864,10 @@ def putFileIntoS3Bucket(key, hash_val, audio_stream):
         # as the audio stream that is passed to the method as a parameter, while the 
         # bucket is specified as the bucket instantiated in the environment
         # variables. The key is as formatted above.
-        s3.put_object(ACL='public-read', Body= audio_stream, Bucket=bucketName, Key=keyVal);
+        with stageMetrics.stage('s3_put'):
+            s3.put_object(ACL='public-read', Body= audio_stream, Bucket=bucketName, Key=keyVal);
+        s3Breaker.success();
+        audioCache.put(keyVal, True);
         # The method returns true once the object is placed into the bucket.
         return True;
         
@@ -569,65 +2875,144 @@ def putFileIntoS3Bucket(key, hash_val, audio_stream):
         # Any exceptions are caught and logged and the method returns false if 
         # there are any issues.
         logger.error(e);
+        s3Breaker.failure();
         return False;
 
 """ Function used to upload the specified item into the DynamoDB table so that it
-    can be accessed again if it has been previously translated. 
+    can be accessed again if it has been previously translated. The write is made
+    through the translation store, so it is deferred until after the response has
+    been built when write-behind is enabled.
 """
-def uploadDetailsToDynamoDB(key, translation, url):
-    # type: (String, String, String) -> no return value
+def uploadDetailsToDynamoDB(key, translation, url, fallback=False):
+    # type: (String, String, String, bool) -> bool
     
-    # Surrounded by try-catch block to catch any errors caused by the DynamoDB resource
-    try:
-        
-        # The item is put into the DynamoDB table with the combined sentence and
-        # selected language as the key for the entry. These are mapped to the 
-        # translation and the url for the audio file
-        table.put_item(
-            Item={
-                'OriginalPhraseandLanguage': key,
-                'value': {
-                    'translation': translation,
-                    'url': url
-                }
-            }
-            
-        )
-        
-    # Any caught exceptions are logged into CloudWatch 
-    except Exception as e:
-        logger.error(e);
+    # The item is put into the DynamoDB table with the combined sentence and
+    # selected language as the key for the entry. These are mapped to the 
+    # translation and the url for the audio file. Any errors are logged by the store
+    # and False is returned.
+    return translationStore.put(TranslationItem(key, translation, url, fallback));
+
+""" Function used to run independent functions at the same time on the shared upload
+    thread pool, or the pool given, waiting at most timeout seconds for all of them to finish. The tasks
+    are given as a dictionary of name to (function, arguments). A dictionary of name to
+    result is returned, with False as the result of any task that raised an exception
+    or did not finish in time. The errors from all of the tasks are logged together.
+"""
+def runConcurrently(tasks, timeout, pool=None):
+    # type: (dict, float, ThreadPoolExecutor) -> dict
+    
+    # Each task is run in a copy of the caller's context, so that the stages it times
+    # are added to the caller's stage metrics
+    pool = pool or uploadPool;
+    futures = dict((name, pool.submit(contextvars.copy_context().run, function, *args))
+                   for name, (function, args) in tasks.items());
+    done, not_done = wait(list(futures.values()), timeout=timeout);
+    
+    results = {};
+    errors = [];
+    for name, future in futures.items():
+        if future in not_done:
+            errors.append("{} did not finish within {} seconds".format(name, timeout));
+            results[name] = False;
+        elif future.exception() is not None:
+            errors.append("{} failed: {}".format(name, future.exception()));
+            results[name] = False;
+        else:
+            results[name] = future.result();
+            if results[name] == False:
+                errors.append("{} failed".format(name));
+    
+    if errors:
+        logger.error("; ".join(errors));
+    return results;
 
 """ Function used to check if dynamoDB has an entry for the sentence and target 
-    language requested by the user in the current session. The function uses the 
-    boto3 DynamoDB resource "query" function to check first if there are any 
-    primary keys that match the required key. If there are any entries that match,
-    then the function returns True as the phrase has been previously translated to 
-    target language. Otherwise, the function returns False, if no match is found.
+    language requested by the user in the current session. The function returns True
+    if the phrase has been previously translated to the target language. Otherwise,
+    the function returns False, if no match is found. Callers that need the entry
+    itself should use translationStore.get directly so that it is only fetched once.
 """
 def queryDynamoDB(key):
     # type: (String) -> bool
+    tableEntry = translationStore.get(key)
+    return tableEntry is not None and tableEntry is not TranslationStore.UNAVAILABLE
+
+""" Response interceptor used to write any translations queued by the translation
+    store in write-behind mode, once the handler has finished building the response
+    (but before it is returned to Alexa).
+"""
+class TranslationStoreFlushInterceptor(AbstractResponseInterceptor):
     
-    # Surrounded by try-catch to avoid any errors that be caused by the boto3 resource
-    try:
-        
-        # table is queried and produces a subtable containing all the matching keys
-        # of the queried keys. This should only contain one entry as the table will not contain duplicate keys
-        subtable = table.query(
-                                KeyConditionExpression=Key('OriginalPhraseandLanguage').eq(key)
-                             )
-        logger.info(subtable)
-        
-        # If the entry required is found by the query function, then the Count will be 1
-        # So the 'Count' entry in the subtable dictionary is checked to ensure whether
-        # or not the entry has been found. The function then returns True as the translation has been found
-        if subtable['Count'] != 0:
-            return True
-    except Exception as e:
-        logger.error(e);
+    def process(self, handler_input, response):
+        # type: (HandlerInput, Response) -> None
+        if translationStore.pending() > 0:
+            logger.info("Flushing queued DynamoDB writes");
+            translationStore.flush();
+
+""" Request interceptor used to write the access counts of the translation store when
+    they are due. The write is started on the upload pool at the start of an invocation,
+    so that it runs while the request is handled, and AccessCountJoinInterceptor waits
+    for it before the response is returned, as the container is frozen once it has been
+    and work left running would only carry on during a later invocation. At most
+    ftAccessFlushItems items are written, and a new write is only started once the last
+    one has finished, so that no count is written twice.
+"""
+class AccessCountFlushInterceptor(AbstractRequestInterceptor):
+    
+    def __init__(self):
+        # type: () -> None
+        self.future = None;
+    
+    def process(self, handler_input):
+        # type: (HandlerInput) -> None
+        if self.future is not None and not self.future.done():
+            return;
+        if translationStore.accessesDue(accessFlushSeconds, accessFlushItems):
+            self.future = uploadPool.submit(contextvars.copy_context().run, translationStore.flushAccesses, accessFlushItems);
+            handler_input.attributes_manager.request_attributes['access flush'] = self.future;
+
+""" Response interceptor used to wait for the access counts written by
+    AccessCountFlushInterceptor, for at most ftAccessFlushWaitMs. A write that takes
+    longer carries on in a later invocation.
+"""
+class AccessCountJoinInterceptor(AbstractResponseInterceptor):
     
-    # If the entry was not found or any other errors occured, then False is returned
-    return False
+    def process(self, handler_input, response):
+        # type: (HandlerInput, Response) -> None
+        future = handler_input.attributes_manager.request_attributes.get('access flush');
+        if future is not None:
+            done, not_done = wait([future], timeout=accessFlushWaitMs / 1000.0);
+            if not_done:
+                logger.info("Access counts are still being written");
+
+""" Request interceptor used to start the stage metrics of each sampled request, tagged
+    with the intent name or, for other requests, the request type.
+"""
+class StageMetricsRequestInterceptor(AbstractRequestInterceptor):
+    
+    def process(self, handler_input):
+        # type: (HandlerInput) -> None
+        request = handler_input.request_envelope.request;
+        intent = getattr(request, 'intent', None);
+        stageMetrics.begin(intent.name if intent is not None else request.object_type);
+
+""" Response interceptor used to emit the stage metrics of the request once the response
+    has been built and any queued writes have been flushed.
+"""
+class StageMetricsResponseInterceptor(AbstractResponseInterceptor):
+    
+    def process(self, handler_input, response):
+        # type: (HandlerInput, Response) -> None
+        stageMetrics.emit();
+
+""" Response interceptor used to log the cold start report once the first response of
+    the container has been built, when ftColdStartReport is enabled.
+"""
+class ColdStartReportInterceptor(AbstractResponseInterceptor):
+    
+    def process(self, handler_input, response):
+        # type: (HandlerInput, Response) -> None
+        coldStartReport.report();
 
 # The handler for each Intent are added to the Skill Builder
 sb.add_request_handler(LaunchRequestHandler());
@@ -636,9 +3021,31 @@ sb.add_request_handler(AskSetLanguageIntentHandler());
 sb.add_request_handler(FunTranslateIntentHandler());
 sb.add_request_handler(NoTargetLanguageIntentHandler());
 sb.add_request_handler(RepeatIntentHandler());
+sb.add_request_handler(ReplayPreviousIntentHandler());
 sb.add_request_handler(HelpIntentHandler());
 sb.add_request_handler(ExitIntentHandler());
 sb.add_request_handler(SessionEndedRequestHandler());
 
+# Interceptors run for every request
+if stageMetrics.enabled:
+    sb.add_global_request_interceptor(StageMetricsRequestInterceptor());
+sb.add_global_request_interceptor(AccessCountFlushInterceptor());
+sb.add_global_response_interceptor(TranslationStoreFlushInterceptor());
+sb.add_global_response_interceptor(AccessCountJoinInterceptor());
+if stageMetrics.enabled:
+    sb.add_global_response_interceptor(StageMetricsResponseInterceptor());
+if coldStartReport.enabled:
+    sb.add_global_response_interceptor(ColdStartReportInterceptor());
+
+skillHandler = sb.lambda_handler();
+
+""" Entry point of the Lambda function. Asynchronous invocations made by deferTranslation
+    finish the deferred translation, and every other event is an Alexa request handled by
+    the skill.
+"""
+def lambda_handler(event, context):
+    if isinstance(event, dict) and DEFERRED_EVENT_KEY in event:
+        return completeDeferredTranslation(event[DEFERRED_EVENT_KEY], context);
+    return skillHandler(event, context);
 
-lambda_handler = sb.lambda_handler();
+coldStartReport.module_ready = time.time();
@@ -0,0 +1,168 @@
+import argparse
+import json
+import logging
+import sys
+
+from lambda_function import KEY_DELIMITER, TranslationStore, canonicalKey, canonicalSentence, table, translationStore, voices
+
+"""
+One-off migration tool used to re-key the translations stored in the DynamoDB table
+from the old key format to the canonical key format used by the skill.
+
+Old keys were made by removing the spaces from the sentence and adding the language
+straight onto the end, e.g. "Hello, World" in pig latin was stored as
+"Hello,Worldpiglatin". New keys are the canonical sentence and the language separated
+by the key delimiter, e.g. "hello world|piglatin".
+
+As the spaces were removed from the old keys, the original sentence can only be fully
+recovered for single words. To re-key multi-word phrases, a list of the phrases users
+have asked for (one per line, or JSON lines with a "sentence" field) can be given with
+--phrases. Every phrase is turned into its old key for each language, and any old item
+found under one of those keys is copied to the phrase's canonical key. Old items that are
+not matched by the phrase list are only re-keyed as a single word if their stored
+translation is a single word too. The new key of these is a guess, so their old items are
+never deleted. Old items whose translation has more than one word are left alone and
+reported as unmatched, as the spaces of their sentence cannot be recovered; adding their
+phrases to --phrases and running the migration again re-keys them.
+
+Items are only written if no item exists under the new key yet, so entries that have
+already been translated with the new keys are never overwritten. The old items that were
+matched by the phrase list are kept unless --delete-legacy is given, and the S3 audio
+files are not moved, as the stored URL of the old file is copied into the new item. Run
+with --dry-run first to see the changes.
+
+Usage (with the same ftbucket and ftDB environment variables as the Lambda function):
+    python migrate_keys.py [--phrases phrases.txt] [--dry-run] [--delete-legacy]
+"""
+
+logger = logging.getLogger(__name__);
+
+KEY_NAME = TranslationStore.KEY_NAME;
+
+# Languages are matched against the end of old keys longest first
+LANGUAGES = sorted(voices.keys(), key=len, reverse=True);
+
+""" Function used to build the key a phrase would have been stored under before keys
+    were canonicalised.
+"""
+def legacyKey(sentence, language):
+    # type: (String, String) -> String
+    return sentence.replace(" ", "") + language;
+
+""" Function used to split an old key into the sentence (without spaces) and language.
+    Returns None for keys that are already canonical, keys used internally (such as the
+    rate limiter's bucket) and keys that do not end in a known language.
+"""
+def splitLegacyKey(key):
+    # type: (String) -> tuple
+    if KEY_DELIMITER in key or key.startswith('__'):
+        return None;
+    for language in LANGUAGES:
+        if key.endswith(language) and len(key) > len(language):
+            return key[:-len(language)], language;
+    return None;
+
+""" Function used to read the phrase list, which can either be plain text with one phrase
+    per line or JSON lines with the phrase in a "sentence" (or "text") field.
+"""
+def loadPhrases(path):
+    # type: (String) -> list
+    phrases = [];
+    with open(path) as phrase_file:
+        for line in phrase_file:
+            line = line.strip();
+            if not line:
+                continue;
+            if line.startswith('{'):
+                record = json.loads(line);
+                line = record.get('sentence') or record.get('text') or '';
+            if line:
+                phrases.append(line);
+    return phrases;
+
+""" Function used to count the words of the translation stored in an item.
+"""
+def translationWords(item):
+    # type: (dict) -> int
+    return len(canonicalSentence((item.get('value') or {}).get('translation') or '').split());
+
+""" Function used to work out the new key of every old item in the table. Returns a list
+    of (old key, new key, item, guessed) tuples, where guessed is True if the item was not
+    matched by the phrase list and was taken to be a single word, and the list of the old
+    keys of multi-word items that were not matched and are left alone.
+"""
+def planMigration(phrases):
+    # type: (list) -> tuple
+    known = {};
+    for phrase in phrases:
+        for language in voices:
+            known.setdefault(legacyKey(phrase, language), canonicalKey(phrase, language));
+
+    plan = [];
+    unmatched = [];
+    for item in translationStore.scan():
+        old_key = item[KEY_NAME];
+        parts = splitLegacyKey(old_key);
+        if parts is None:
+            continue;
+        new_key = known.get(old_key);
+        guessed = new_key is None;
+        if guessed:
+            if translationWords(item) > 1:
+                unmatched.append(old_key);
+                continue;
+            new_key = canonicalKey(parts[0], parts[1]);
+        if new_key != old_key:
+            plan.append((old_key, new_key, item, guessed));
+    return plan, unmatched;
+
+""" Function used to copy an item to its new key, as long as nothing is stored under the
+    new key yet. Returns True if the item was written.
+"""
+def copyItem(new_key, item):
+    # type: (String, dict) -> bool
+    new_item = dict(item);
+    new_item[KEY_NAME] = new_key;
+    try:
+        table.put_item(Item=new_item, ConditionExpression='attribute_not_exists(#key)',
+                       ExpressionAttributeNames={'#key': KEY_NAME});
+        return True;
+    except Exception as e:
+        if getattr(e, 'response', {}).get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+            return False;
+        raise;
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Re-key Fun Translate DynamoDB items to canonical keys');
+    parser.add_argument('--phrases', help='file of phrases used to recover the spacing of multi-word keys');
+    parser.add_argument('--dry-run', action='store_true', help='only print the changes that would be made');
+    parser.add_argument('--delete-legacy', action='store_true', help='delete the old items once they have been copied');
+    args = parser.parse_args(argv);
+
+    phrases = loadPhrases(args.phrases) if args.phrases else [];
+    plan, unmatched = planMigration(phrases);
+
+    copied = skipped = deleted = 0;
+    for old_key, new_key, item, guessed in plan:
+        if args.dry_run:
+            print("{} -> {}{}".format(old_key, new_key, " (guessed)" if guessed else ""));
+            continue;
+        if copyItem(new_key, item):
+            copied += 1;
+        else:
+            skipped += 1;
+        # Old items whose new key was guessed are kept, in case the guess is wrong
+        if args.delete_legacy and not guessed:
+            table.delete_item(Key={KEY_NAME: old_key});
+            deleted += 1;
+    for old_key in unmatched:
+        print("{} unmatched, add its phrase to --phrases".format(old_key));
+
+    print(json.dumps({'legacy_items': len(plan) + len(unmatched), 'copied': copied, 'already_present': skipped,
+                      'guessed': sum(1 for entry in plan if entry[3]), 'unmatched': len(unmatched),
+                      'deleted': deleted, 'dry_run': args.dry_run}));
+    return 0;
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO);
+    sys.exit(main());
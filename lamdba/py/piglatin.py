@@ -0,0 +1,91 @@
+import re
+
+from functools import lru_cache
+
+"""
+Local Pig Latin translation engine used by the Fun Translate skill instead of calling
+the Fun Translations API for the piglatin language. As Pig Latin is purely rule based,
+the translation can be done in-process without a network call and without counting
+against the API's hourly call limit.
+
+Rules applied to each word:
+    - Words beginning with a vowel have "way" added to the end: "apple" -> "appleway"
+    - Otherwise the leading consonant cluster is moved to the end followed by "ay":
+      "hello" -> "ellohay", "string" -> "ingstray"
+    - "qu" is kept together as part of the consonant cluster: "queen" -> "eenquay",
+      "square" -> "aresquay"
+    - "y" is treated as a consonant at the start of a word and as a vowel anywhere
+      else: "yellow" -> "ellowyay", "rhythm" -> "ythmrhay"
+    - Words without any vowels have "ay" added to the end
+    - Capitalisation of the original word is kept: "Hello" -> "Ellohay", "NASA" -> "ASANAY"
+    - Hyphenated words have each part translated separately, and punctuation, digits and
+      whitespace are left exactly where they were: "well-known, friend!" -> "ellway-ownknay, iendfray!"
+"""
+
+VOWELS = frozenset("aeiouAEIOU");
+
+# A word is a run of letters, optionally joined by apostrophes (e.g. "don't"), so that
+# hyphens, digits and all other punctuation separate words and are kept unchanged
+WORD_PATTERN = re.compile(r"[A-Za-z]+(?:'[A-Za-z]+)*");
+
+""" Function used to split a lower case word into its leading consonant cluster and
+    the remainder of the word starting from the first vowel.
+"""
+def _splitCluster(word):
+    # type: (String) -> tuple
+    i = 0;
+    length = len(word);
+    while i < length:
+        letter = word[i];
+        if letter in VOWELS:
+            # The "u" in "qu" belongs to the consonant cluster
+            if letter in "uU" and i > 0 and word[i - 1] in "qQ":
+                i += 1;
+                continue;
+            break;
+        # "y" acts as a vowel when it is not the first letter of the word
+        if letter in "yY" and i > 0:
+            break;
+        if letter == "'":
+            break;
+        i += 1;
+    return word[:i], word[i:];
+
+""" Function used to apply the original word's capitalisation to its translation.
+"""
+def _matchCase(original, translated):
+    # type: (String, String) -> String
+    letters = original.replace("'", "");
+    if len(letters) > 1 and letters.isupper():
+        return translated.upper();
+    if original[0].isupper():
+        return translated[0].upper() + translated[1:].lower();
+    return translated.lower();
+
+""" Function used to translate a single word into Pig Latin. Results are memoised as
+    the same words come up again and again in the phrases users ask to translate.
+"""
+@lru_cache(maxsize=4096)
+def translateWord(word):
+    # type: (String) -> String
+    if not word:
+        return word;
+    lower = word.lower();
+    cluster, rest = _splitCluster(lower);
+    if not cluster:
+        translated = lower + "way";
+    elif not rest:
+        translated = lower + "ay";
+    else:
+        translated = rest + cluster + "ay";
+    return _matchCase(word, translated);
+
+def _replaceWord(match):
+    return translateWord(match.group(0));
+
+""" Function used to translate a whole phrase into Pig Latin, leaving everything between
+    the words untouched.
+"""
+def translate(text):
+    # type: (String) -> String
+    return WORD_PATTERN.sub(_replaceWord, text);
@@ -0,0 +1,310 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import lambda_function
+from lambda_function import (TranslationStore, canonicalKey, defaultApiTimeout, localEngines, rateLimitEnabled,
+                             rateLimiter, segmentationEnabled, splitSegments, storeTranslation, translatePhrase,
+                             translateSegments, translationRouter, translationStore, voices)
+
+"""
+Pre-warm job that translates, synthesises and stores a list of phrases in every language
+ahead of a launch or a campaign, so that users get the translation straight away from the
+first time they ask for it rather than waiting behind the API's call limit.
+
+Phrases are read from a text file (one phrase per line, blank lines and lines starting
+with # are skipped) or a JSON lines file ({"phrase": ..., "languages": [...]} per line,
+the languages being optional). Every phrase is prepared in each of the languages given
+with --languages, or in all of the skill's languages by default. Phrases go through the
+same functions as in the skill (translatePhrase or translateSegments, then
+storeTranslation), so the entries and audio files are exactly the ones the skill would
+have made.
+
+    - Keys that are already in the table are skipped, checked with batched reads of up to
+      100 keys at a time.
+    - Phrases are processed on a bounded pool of --workers threads. Languages translated
+      by the API only go out while the shared rate limiter has more than --reserve calls
+      left, so that live users are never refused because of the pre-warm, and the job
+      waits for the bucket to refill otherwise. --max-api-calls stops the run after that
+      many calls, leaving the rest for a later run.
+    - Every phrase that is done is appended to the --state file, so an interrupted run
+      (or one stopped by --max-api-calls) picks up where it left off when run again.
+      Phrases that failed are retried.
+    - Translations from a fallback engine are not stored unless --allow-fallback is
+      given, and are then only kept until the API can translate the phrase again, like
+      the fallback translations stored by the skill. Phrases that only have a fallback
+      translation in the table are translated again.
+
+Progress is logged as the job goes, and a summary with the throughput is printed at the end.
+
+Usage (with the same ftbucket and ftDB environment variables as the Lambda function):
+    python prewarm.py phrases.txt [--languages dothraki,piglatin] [--workers 4] [--reserve 2]
+"""
+
+logger = logging.getLogger(__name__);
+
+DEFAULT_STATE_PATH = 'prewarm.state';
+DONE_STATUSES = ('stored', 'exists');
+
+""" Function used to read the phrases to pre-warm. Returns a list of (phrase, languages)
+    tuples, with None as the languages when the phrase is to be prepared in every language.
+"""
+def loadPhrases(path, file_format='auto'):
+    # type: (String, String) -> list
+    phrases = [];
+    with open(path, encoding='utf-8') as phrase_file:
+        lines = [line.strip() for line in phrase_file];
+    if file_format == 'auto':
+        first = next((line for line in lines if line and not line.startswith('#')), '');
+        file_format = 'jsonl' if path.endswith(('.jsonl', '.json')) or first.startswith('{') else 'text';
+    for line in lines:
+        if not line or line.startswith('#'):
+            continue;
+        if file_format == 'jsonl':
+            record = json.loads(line);
+            phrases.append((record.get('phrase') or record.get('text'), record.get('languages')));
+        else:
+            phrases.append((line, None));
+    return [(phrase, languages) for phrase, languages in phrases if phrase];
+
+""" Function used to turn the phrases into the jobs to run, one per phrase and language,
+    leaving out repeated keys. Returns an ordered dictionary of key to (phrase, language).
+"""
+def planJobs(phrases, languages):
+    # type: (list, list) -> dict
+    jobs = {};
+    for phrase, phrase_languages in phrases:
+        for language in phrase_languages or languages:
+            language = language.lower().replace(" ", "");
+            if language not in voices:
+                logger.error("Skipping unknown language {} for {}".format(language, phrase));
+                continue;
+            jobs.setdefault(canonicalKey(phrase, language), (phrase, language));
+    return jobs;
+
+""" Function used to read the keys that are already done from the state file of an
+    earlier run.
+"""
+def loadState(path):
+    # type: (String) -> set
+    done = set();
+    if not os.path.exists(path):
+        return done;
+    with open(path, encoding='utf-8') as state_file:
+        for line in state_file:
+            line = line.strip();
+            if line:
+                record = json.loads(line);
+                if record.get('status') in DONE_STATUSES:
+                    done.add(record['key']);
+                else:
+                    done.discard(record['key']);
+    return done;
+
+""" Function used to find the keys that are already in the table, in batches. Keys that
+    only have a fallback translation are left out, so that they are translated again.
+"""
+def existingKeys(keys):
+    # type: (list) -> set
+    existing = set();
+    for start in range(0, len(keys), TranslationStore.BATCH_GET_LIMIT):
+        found = translationStore.batch_get(keys[start:start + TranslationStore.BATCH_GET_LIMIT]);
+        existing.update(key for key, item in found.items() if not item.fallback);
+    return existing;
+
+""" Function used to count the calls to the API a phrase needs at most. Languages that are
+    translated locally need none, and those with a quota need one, as their segments are
+    only translated separately when at most one of them is missing (see translateSegments).
+    Otherwise each segment is translated with its own call.
+"""
+def apiCalls(phrase, language):
+    # type: (String, String) -> int
+    if language in localEngines:
+        return 0;
+    if not segmentationEnabled or translationRouter.quotaBound(language):
+        return 1;
+    return len(splitSegments(phrase));
+
+""" Function used to translate, synthesise and store one phrase in one language, the same
+    way the skill does. Returns the translation state and the error if it could not be
+    stored.
+"""
+def prewarmPhrase(key, phrase, language, timeout):
+    # type: (String, String, String, float) -> tuple
+    
+    # While the circuit for Polly or S3 is open the skill would only speak the translation
+    # without storing it, so the phrase is failed straight away to be retried on a later run
+    if lambda_function.pollyBreaker.isOpen() or lambda_function.s3Breaker.isOpen():
+        return "Unavailable", lambda_function.DEGRADED_AUDIO_SPEECH;
+    segments = splitSegments(phrase) if segmentationEnabled else [phrase];
+    if len(segments) > 1:
+        translation, url, state, error = translateSegments(key, segments, language, timeout);
+        return state, error;
+    translation, state = translatePhrase(phrase, language, timeout);
+    if state not in ("Translated", "Fallback"):
+        return state, None;
+    url, error = storeTranslation(key, hashlib.md5(key.encode('utf-8')).hexdigest(), translation, language, state == "Fallback");
+    return state, error;
+
+""" Function used to work out how many API calls can be made now without taking the
+    rate limiter below the reserve, and how many seconds to wait until the number of
+    calls needed can be made if there are fewer.
+"""
+def availableCalls(reserve, needed=1):
+    # type: (int, int) -> tuple
+    if not rateLimitEnabled:
+        return float('inf'), 0.0;
+    tokens = rateLimiter.refresh()['tokens'];
+    calls = max(0, int(tokens - reserve));
+    if calls >= needed:
+        return calls, 0.0;
+    return calls, (reserve + needed - tokens) / rateLimiter.rate;
+
+""" Function used to run the pre-warm. Returns a summary of what was done and the
+    throughput.
+"""
+def prewarm(phrases, languages, workers=4, reserve=2, max_api_calls=None, state_path=DEFAULT_STATE_PATH,
+            timeout=defaultApiTimeout, retry_wait=60.0, report_every=50):
+    # type: (list, list, int, int, int, String, float, float, int) -> dict
+    started = time.time();
+    # At least one call has to be left for the pre-warm, otherwise it would wait for ever
+    reserve = max(0, min(reserve, int(rateLimiter.capacity) - 1));
+    jobs = planJobs(phrases, languages);
+    done = loadState(state_path) if state_path else set();
+    keys = [key for key in jobs if key not in done];
+    existing = existingKeys(keys);
+    summary = {'phrases': len(phrases), 'jobs': len(jobs), 'resumed': len(jobs) - len(keys),
+               'exists': len(existing), 'stored': 0, 'failed': 0, 'limited': 0, 'api_calls': 0,
+               'remaining': 0, 'interrupted': False};
+
+    state_file = open(state_path, 'a', encoding='utf-8') if state_path else None;
+
+    def record(key, status, error=None):
+        if state_file is not None:
+            state_file.write(json.dumps({'key': key, 'status': status, 'error': error}) + '\n');
+            state_file.flush();
+
+    for key in existing:
+        record(key, 'exists');
+    local = deque(key for key in keys if key not in existing and apiCalls(*jobs[key]) == 0);
+    remote = deque(key for key in keys if key not in existing and apiCalls(*jobs[key]) > 0);
+    logger.info("Pre-warming {} phrases ({} local, {} through the API), {} already done".format(
+        len(local) + len(remote), len(local), len(remote), summary['resumed'] + summary['exists']));
+
+    pool = ThreadPoolExecutor(max_workers=workers);
+    in_flight = {};
+    calls_left = 0;
+    wait_until = 0.0;
+    completed = 0;
+    left_over = 0;
+    try:
+        while local or remote or in_flight:
+            # Free workers are given the local phrases first, then the phrases that need
+            # the API as long as the rate limiter has calls to spare
+            while len(in_flight) < workers and local:
+                key = local.popleft();
+                in_flight[pool.submit(prewarmPhrase, key, jobs[key][0], jobs[key][1], timeout)] = key;
+            if remote and max_api_calls is not None and summary['api_calls'] >= max_api_calls:
+                left_over += len(remote);
+                remote.clear();
+            if remote and len(in_flight) < workers and time.time() >= wait_until:
+                # A phrase with more segments than the limiter can ever have calls to spare
+                # for is sent once there are as many as it can have, and put back if the API
+                # refuses a segment
+                needed = min(apiCalls(*jobs[remote[0]]), int(rateLimiter.capacity) - reserve);
+                if calls_left < needed:
+                    calls_left, delay = availableCalls(reserve, needed);
+                    wait_until = time.time() + delay;
+                while len(in_flight) < workers and remote and calls_left >= needed:
+                    if max_api_calls is not None and summary['api_calls'] >= max_api_calls:
+                        break;
+                    key = remote.popleft();
+                    calls_left -= apiCalls(*jobs[key]);
+                    summary['api_calls'] += apiCalls(*jobs[key]);
+                    in_flight[pool.submit(prewarmPhrase, key, jobs[key][0], jobs[key][1], timeout)] = key;
+                    if remote:
+                        needed = min(apiCalls(*jobs[remote[0]]), int(rateLimiter.capacity) - reserve);
+                if remote and not in_flight and wait_until > time.time():
+                    logger.info("Waiting {:.0f} seconds for the API's call limit, {} phrases left".format(
+                        wait_until - time.time(), len(remote)));
+
+            if not in_flight:
+                if remote:
+                    time.sleep(max(0.0, min(wait_until - time.time(), retry_wait)) or 0.1);
+                continue;
+
+            finished, not_finished = wait(list(in_flight), timeout=1.0, return_when=FIRST_COMPLETED);
+            for future in finished:
+                key = in_flight.pop(future);
+                try:
+                    state, error = future.result();
+                except Exception as e:
+                    logger.error(e);
+                    state, error = "Unauthorized", str(e);
+                if state == "Limit Exceeded":
+                    # The API refused the call even though the limiter allowed it, so the
+                    # phrase is put back and the job waits before trying again
+                    summary['limited'] += 1;
+                    remote.appendleft(key);
+                    calls_left = 0;
+                    wait_until = time.time() + retry_wait;
+                elif state in ("Translated", "Fallback") and error is None:
+                    summary['stored'] += 1;
+                    record(key, 'stored');
+                else:
+                    summary['failed'] += 1;
+                    record(key, 'failed', error or state);
+                completed += 1;
+                if report_every and completed % report_every == 0:
+                    logger.info("{} phrases done, {:.2f} a second".format(completed, completed / (time.time() - started)));
+            translationStore.flush();
+    except KeyboardInterrupt:
+        # Phrases that are being processed are finished but not recorded, they are found
+        # in the table by the next run, and the rest are left for it
+        summary['interrupted'] = True;
+        left_over += len(in_flight);
+    finally:
+        pool.shutdown(wait=True);
+        translationStore.flush();
+        if state_file is not None:
+            state_file.close();
+
+    elapsed = time.time() - started;
+    summary['remaining'] = len(local) + len(remote) + left_over;
+    summary['elapsed_seconds'] = round(elapsed, 2);
+    summary['stored_per_second'] = round(summary['stored'] / elapsed, 3) if elapsed else None;
+    summary['checked_per_second'] = round((summary['stored'] + summary['failed'] + summary['exists']) / elapsed, 3) if elapsed else None;
+    return summary;
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Translate and store a list of phrases ahead of time');
+    parser.add_argument('phrases', help='text file with one phrase per line, or a JSON lines file');
+    parser.add_argument('--format', choices=('auto', 'text', 'jsonl'), default='auto', help='format of the phrase file');
+    parser.add_argument('--languages', help='comma separated languages to prepare (all of them by default)');
+    parser.add_argument('--workers', type=int, default=4, help='number of phrases processed at the same time');
+    parser.add_argument('--reserve', type=int, default=2, help='API calls left in the rate limiter for live users');
+    parser.add_argument('--max-api-calls', type=int, help='stop after making this many API calls');
+    parser.add_argument('--state', default=DEFAULT_STATE_PATH, help='file recording the phrases done, to resume from');
+    parser.add_argument('--api-timeout', type=float, default=defaultApiTimeout, help='seconds to wait for the API');
+    parser.add_argument('--retry-wait', type=float, default=60, help='seconds to wait after the API refuses a call');
+    parser.add_argument('--allow-fallback', action='store_true', help='also store translations from a fallback engine, until the API can translate them');
+    args = parser.parse_args(argv);
+
+    if not args.allow_fallback:
+        lambda_function.fallbackEngines.clear();
+    languages = [language.strip() for language in args.languages.split(',')] if args.languages else sorted(voices);
+    summary = prewarm(loadPhrases(args.phrases, args.format), languages, args.workers, args.reserve,
+                      args.max_api_calls, args.state, args.api_timeout, args.retry_wait);
+    print(json.dumps(summary));
+    return 0 if summary['failed'] == 0 else 1;
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO);
+    sys.exit(main());
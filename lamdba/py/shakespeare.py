@@ -0,0 +1,122 @@
+import json
+import os
+import re
+
+"""
+Local Shakespeare translation engine used by the Fun Translate skill, either instead of
+the Fun Translations API or as a fallback for when the API cannot be used (for example
+once its hourly call limit has been reached).
+
+The engine rewrites modern English phrases into Early Modern English using the lexicon
+bundled in shakespeare_lexicon.json. The lexicon maps phrases of one or more words to
+their replacements, e.g. "are you" -> "art thou" and "hello" -> "good morrow". It is
+compiled once, when the module is imported, into a word-level trie so that a sentence
+is rewritten in a single left-to-right pass: at each word the longest phrase in the
+lexicon starting at that word is replaced, and matching then carries on after it. As the
+longest phrase in the lexicon is only a few words long, the pass is linear in the length
+of the sentence regardless of how many phrases the lexicon contains.
+"""
+
+LEXICON_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shakespeare_lexicon.json');
+
+# Words are runs of letters, optionally joined by apostrophes so that contractions such
+# as "you're" are matched as a single word. Curly apostrophes are accepted as well.
+WORD_PATTERN = re.compile(u"[A-Za-z]+(?:['’][A-Za-z]+)*");
+
+# Key used in the trie nodes for the replacement of the phrase ending at that node.
+# It cannot clash with a word as words never contain spaces.
+_TERMINAL = ' ';
+
+""" Multi-pattern matcher compiled from the phrase lexicon. Each node of the trie is a
+    dictionary mapping the next (lower case) word to the child node, with the replacement
+    stored under the _TERMINAL key on nodes where a phrase ends.
+"""
+class PhraseMatcher(object):
+
+    def __init__(self, phrases):
+        # type: (dict) -> None
+        self.root = {};
+        self.size = 0;
+        for phrase, replacement in phrases.items():
+            words = phrase.lower().split();
+            if not words:
+                continue;
+            node = self.root;
+            for word in words:
+                node = node.setdefault(word, {});
+            node[_TERMINAL] = replacement;
+            self.size += 1;
+
+    def rewrite(self, text):
+        # type: (String) -> String
+        words = [(match.start(), match.end(), match.group(0).lower().replace(u'’', "'"))
+                 for match in WORD_PATTERN.finditer(text)];
+        count = len(words);
+        output = [];
+        position = 0;
+        i = 0;
+        while i < count:
+            # Follow the trie from this word for as long as the following words match,
+            # remembering the longest phrase found. Phrases can only span words that
+            # are separated by whitespace, not by punctuation.
+            node = self.root;
+            best = None;
+            j = i;
+            while j < count:
+                if j > i and not text[words[j - 1][1]:words[j][0]].isspace():
+                    break;
+                node = node.get(words[j][2]);
+                if node is None:
+                    break;
+                if _TERMINAL in node:
+                    best = (j, node[_TERMINAL]);
+                j += 1;
+
+            if best is None:
+                i += 1;
+                continue;
+
+            last, replacement = best;
+            start = words[i][0];
+            end = words[last][1];
+            output.append(text[position:start]);
+            output.append(_matchCase(text[start:end], replacement));
+            position = end;
+            i = last + 1;
+
+        output.append(text[position:]);
+        return ''.join(output);
+
+""" Function used to apply the capitalisation of the matched text to its replacement.
+    Replacements are only ever capitalised, never lower cased, so that words such as "I"
+    in the lexicon keep their case.
+"""
+def _matchCase(original, replacement):
+    # type: (String, String) -> String
+    letters = [c for c in original if c.isalpha()];
+    if len(letters) > 1 and all(c.isupper() for c in letters):
+        return replacement.upper();
+    if original[:1].isupper():
+        # Replacements such as "'tis" start with an apostrophe, so the first letter is
+        # capitalised rather than the first character
+        for index, character in enumerate(replacement):
+            if character.isalpha():
+                return replacement[:index] + character.upper() + replacement[index + 1:];
+    return replacement;
+
+""" Function used to load the bundled lexicon and compile it into a PhraseMatcher.
+"""
+def loadMatcher(path=LEXICON_PATH):
+    # type: (String) -> PhraseMatcher
+    with open(path) as lexicon_file:
+        lexicon = json.load(lexicon_file);
+    return PhraseMatcher(lexicon['phrases']);
+
+# The lexicon is compiled once per container, when the module is first imported
+matcher = loadMatcher();
+
+""" Function used to translate a whole phrase into Shakespearean English.
+"""
+def translate(text):
+    # type: (String) -> String
+    return matcher.rewrite(text);
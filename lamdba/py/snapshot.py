@@ -0,0 +1,181 @@
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import time
+
+"""
+Read-only snapshot of the most requested translations, used so that a freshly started
+container can answer popular phrases from memory without querying DynamoDB.
+
+The snapshot is a single binary file, written by export_snapshot.py and either bundled
+with the deployment package or downloaded from S3 once per container. It is memory-mapped
+rather than read, so opening it costs next to nothing and only the pages that are
+actually used are loaded.
+
+File layout (all integers little-endian):
+    header   magic "FTSNAP", format version (uint16), generation (uint64),
+             created time in epoch seconds (uint64), number of entries (uint32)
+    index    one (key hash (uint64), record offset (uint32)) pair per entry, sorted by hash
+    records  for each entry, the lengths of the key, translation and url (3 x uint32)
+             followed by the UTF-8 encoded key, translation and url
+
+Lookups hash the key and binary search the index, then compare the key stored in the
+record in case two keys share a hash. The generation is increased by every export so that
+stale snapshots can be detected, and snapshots older than a maximum age can be ignored.
+"""
+
+logger = logging.getLogger(__name__);
+
+MAGIC = b'FTSNAP';
+FORMAT_VERSION = 1;
+HEADER = struct.Struct('<6sHQQI');
+INDEX_ENTRY = struct.Struct('<QI');
+RECORD_HEADER = struct.Struct('<III');
+
+""" Function used to hash a key to the 64 bit value used in the index.
+"""
+def keyHash(key):
+    # type: (String) -> int
+    return struct.unpack('<Q', hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest())[0];
+
+""" Function used to write a snapshot file from a list of (key, translation, url) entries.
+    The file is written to a temporary name and then renamed, so a reader never sees a
+    partly written snapshot.
+"""
+def writeSnapshot(path, entries, generation, created=None):
+    # type: (String, list, int, float) -> int
+    created = int(created if created is not None else time.time());
+    records = [];
+    index = [];
+    offset = HEADER.size + INDEX_ENTRY.size * len(entries);
+    for key, translation, url in entries:
+        parts = [value.encode('utf-8') for value in (key, translation or '', url or '')];
+        record = RECORD_HEADER.pack(*[len(part) for part in parts]) + b''.join(parts);
+        index.append((keyHash(key), offset));
+        records.append(record);
+        offset += len(record);
+    index.sort();
+
+    temporary = path + '.tmp';
+    with open(temporary, 'wb') as snapshot_file:
+        snapshot_file.write(HEADER.pack(MAGIC, FORMAT_VERSION, generation, created, len(entries)));
+        for entry in index:
+            snapshot_file.write(INDEX_ENTRY.pack(*entry));
+        for record in records:
+            snapshot_file.write(record);
+    os.replace(temporary, path);
+    return offset;
+
+""" Memory-mapped reader for a snapshot file. A snapshot that could not be opened, is in
+    an unknown format or is older than max_age seconds is treated as empty, so lookups
+    simply fall through to DynamoDB.
+"""
+class HotPhraseSnapshot(object):
+
+    def __init__(self, path=None, max_age=None):
+        # type: (String, float) -> None
+        self.path = path;
+        self.generation = None;
+        self.created = None;
+        self.count = 0;
+        self.hits = 0;
+        self.misses = 0;
+        self._map = None;
+        if path:
+            self._open(path, max_age);
+
+    def _open(self, path, max_age):
+        # type: (String, float) -> None
+        try:
+            with open(path, 'rb') as snapshot_file:
+                snapshot_map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ);
+        except (IOError, OSError, ValueError) as e:
+            logger.error("Could not open snapshot {}: {}".format(path, e));
+            return;
+
+        if len(snapshot_map) < HEADER.size:
+            logger.error("Snapshot {} is truncated".format(path));
+            snapshot_map.close();
+            return;
+        magic, version, generation, created, count = HEADER.unpack_from(snapshot_map, 0);
+        if magic != MAGIC or version != FORMAT_VERSION:
+            logger.error("Snapshot {} has an unsupported format".format(path));
+            snapshot_map.close();
+            return;
+        self.generation = generation;
+        self.created = created;
+        if max_age is not None and time.time() - created > max_age:
+            logger.info("Ignoring stale snapshot {} (generation {})".format(path, generation));
+            snapshot_map.close();
+            return;
+
+        self.count = count;
+        self._map = snapshot_map;
+        logger.info("Loaded snapshot {} (generation {}, {} entries)".format(path, generation, count));
+
+    def _indexEntry(self, position):
+        # type: (int) -> tuple
+        return INDEX_ENTRY.unpack_from(self._map, HEADER.size + position * INDEX_ENTRY.size);
+
+    def _record(self, offset):
+        # type: (int) -> tuple
+        key_length, translation_length, url_length = RECORD_HEADER.unpack_from(self._map, offset);
+        start = offset + RECORD_HEADER.size;
+        key = self._map[start:start + key_length].decode('utf-8');
+        start += key_length;
+        translation = self._map[start:start + translation_length].decode('utf-8');
+        start += translation_length;
+        url = self._map[start:start + url_length].decode('utf-8');
+        return key, translation, url;
+
+    def get(self, key):
+        # type: (String) -> tuple
+        # Returns the (translation, url) for the key, or None if it is not in the snapshot
+        if self._map is None:
+            return None;
+        target = keyHash(key);
+        low, high = 0, self.count;
+        while low < high:
+            middle = (low + high) // 2;
+            if self._indexEntry(middle)[0] < target:
+                low = middle + 1;
+            else:
+                high = middle;
+        # Every entry with the same hash is checked, as different keys can share a hash
+        while low < self.count:
+            entry_hash, offset = self._indexEntry(low);
+            if entry_hash != target:
+                break;
+            record_key, translation, url = self._record(offset);
+            if record_key == key:
+                self.hits += 1;
+                return translation, url;
+            low += 1;
+        self.misses += 1;
+        return None;
+
+    def entries(self):
+        # type: () -> generator
+        # Yields every (key, translation, url) in the snapshot
+        for position in range(self.count if self._map is not None else 0):
+            yield self._record(self._indexEntry(position)[1]);
+
+    def stats(self):
+        # type: () -> dict
+        return {
+            'path': self.path,
+            'generation': self.generation,
+            'created': self.created,
+            'entries': self.count,
+            'loaded': self._map is not None,
+            'hits': self.hits,
+            'misses': self.misses
+        };
+
+    def close(self):
+        # type: () -> None
+        if self._map is not None:
+            self._map.close();
+            self._map = None;
@@ -0,0 +1,245 @@
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import time
+
+from urllib.parse import unquote
+
+from lambda_function import TranslationStore, bucketName, s3, slowAudioKey, table, translationStore
+
+"""
+Sweeper that keeps the DynamoDB table and the audio files in the S3 bucket within a
+storage budget, by evicting the least frequently used translations.
+
+The skill counts how often every item is used in its access_count attribute and when it
+was last used in last_access (see TranslationStore.flushAccesses). The sweeper:
+    - pins the most used items (--pin-top, which should match the number of phrases
+      exported to the hot-phrase snapshot), marking them with the pinned attribute and
+      setting their expires_at attribute to it, which is not a number so that they never
+      expire (the skill does the same when it records accesses to them), and unpins the
+      items that have dropped out of the top
+    - gives items from before access tracking an expires_at attribute, so that DynamoDB's
+      time to live removes them if they are not used again
+    - deletes audio files that no item refers to any more (e.g. because the item expired)
+      once they are older than --orphan-grace-hours, which should be longer than the
+      time the skill caches which audio files exist for (ftCacheTTL)
+    - if the table and the audio files together are still over --budget-mb, evicts the
+      unpinned items with the fewest accesses first (the least recently used first among
+      equals), deleting each audio file once no remaining item refers to it. As audio is
+      content addressed, one file can be shared by several items. Audio files of items
+      used within the grace period are kept until a later sweep, as the item may still
+      be cached by a warm container. The slow repeat of an audio file, made lazily for
+      some audio profiles, is kept and deleted along with the file it repeats.
+
+Internal items such as the rate limiter's bucket and the single-flight leases are never
+touched, as TranslationStore.scan skips them, and translations made by a fallback engine
+are never pinned, as they are only kept until the API can translate the phrase again.
+Time to live has to be turned on for the expires_at attribute of the table, which can be
+done with --enable-ttl.
+
+The sweeper can be run from the command line, with --dry-run to only print what it would
+do, or on a schedule as a Lambda function through lambda_handler.
+
+Usage (with the same ftbucket and ftDB environment variables as the Lambda function):
+    python sweep_cache.py --budget-mb 500 [--pin-top 1000] [--dry-run] [--enable-ttl]
+"""
+
+logger = logging.getLogger(__name__);
+
+KEY_NAME = TranslationStore.KEY_NAME;
+TTL_ATTRIBUTE = 'expires_at';
+S3_DELETE_LIMIT = 1000;
+
+# Audio tags in the SSML stored as the url of an item, of which there can be several for
+# utterances made up of more than one segment
+AUDIO_SOURCE = re.compile(r'<audio src=\s*"https://[^/"]+/([^"?]+)');
+
+""" Function used to get the S3 object keys of the audio files played by an item's SSML.
+"""
+def audioKeys(url):
+    # type: (String) -> list
+    return [unquote(match) for match in AUDIO_SOURCE.findall(url or '')];
+
+""" Function used to get the S3 object keys of the audio files an item refers to, which
+    are the files played by its SSML and their slow repeats, as these are made lazily
+    under a key derived from the file they repeat rather than being stored in the item.
+"""
+def itemAudioKeys(item):
+    # type: (dict) -> list
+    keys = audioKeys((item.get('value') or {}).get('url'));
+    return keys + [slowAudioKey(object_key) for object_key in keys];
+
+""" Function used to list the audio files in the bucket. Returns a dictionary of object key
+    to (size in bytes, last modified time in epoch seconds).
+"""
+def listAudio():
+    # type: () -> dict
+    objects = {};
+    kwargs = {'Bucket': bucketName};
+    while True:
+        page = s3.list_objects_v2(**kwargs);
+        for entry in page.get('Contents', []):
+            if entry['Key'].endswith('.mp3'):
+                modified = entry.get('LastModified');
+                objects[entry['Key']] = (int(entry.get('Size', 0)),
+                                         modified.timestamp() if hasattr(modified, 'timestamp') else float(modified or 0));
+        if not page.get('IsTruncated'):
+            return objects;
+        kwargs['ContinuationToken'] = page['NextContinuationToken'];
+
+""" Function used to estimate the size of an item in the table, in bytes.
+"""
+def itemSize(item):
+    # type: (dict) -> int
+    return len(json.dumps(item, default=str).encode('utf-8'));
+
+""" Function used to work out what the sweep has to do. Returns a dictionary with the keys
+    of the items to pin, unpin, give an expiry time and evict, the object keys of the
+    audio files to delete, and the storage used before and after the sweep.
+"""
+def planSweep(budget_bytes, pin_top, item_ttl, orphan_grace, now=None):
+    # type: (int, int, float, float, float) -> dict
+    now = now or time.time();
+    items = dict((item[KEY_NAME], item) for item in translationStore.scan());
+    objects = listAudio();
+
+    references = dict((object_key, set()) for object_key in objects);
+    for key, item in items.items():
+        for object_key in itemAudioKeys(item):
+            references.setdefault(object_key, set()).add(key);
+
+    # Items are ranked by the number of accesses and then by how recently they were used
+    ranked = sorted(items, key=lambda key: (int(items[key].get('access_count', 0)),
+                                            int(items[key].get('last_access', 0))), reverse=True);
+    top = [key for key in ranked if not (items[key].get('value') or {}).get('fallback')][:pin_top];
+    pinned = set(top);
+    plan = {
+        'pin': [key for key in top if not items[key].get('pinned')],
+        'unpin': [key for key in ranked if key not in pinned and items[key].get('pinned')],
+        'expire': [key for key in ranked if key not in pinned and TTL_ATTRIBUTE not in items[key] and item_ttl],
+        'evict': [],
+        'delete_audio': []
+    };
+
+    used = sum(itemSize(item) for item in items.values()) + sum(size for size, modified in objects.values());
+    plan['bytes_before'] = used;
+
+    for object_key, (size, modified) in objects.items():
+        if not references[object_key] and now - modified > orphan_grace:
+            plan['delete_audio'].append(object_key);
+            used -= size;
+
+    for key in reversed(ranked):
+        if used <= budget_bytes:
+            break;
+        if key in pinned:
+            continue;
+        plan['evict'].append(key);
+        used -= itemSize(items[key]);
+        if now - int(items[key].get('last_access', 0)) <= orphan_grace:
+            continue;
+        for object_key in itemAudioKeys(items[key]):
+            holders = references.get(object_key);
+            if holders is None:
+                continue;
+            holders.discard(key);
+            if not holders and object_key in objects:
+                plan['delete_audio'].append(object_key);
+                used -= objects[object_key][0];
+
+    evicted = set(plan['evict']);
+    plan['unpin'] = [key for key in plan['unpin'] if key not in evicted];
+    plan['expire'] = [key for key in plan['expire'] if key not in evicted];
+    plan['bytes_after'] = used;
+    return plan;
+
+""" Function used to carry out a sweep planned by planSweep.
+"""
+def applySweep(plan, item_ttl, now=None):
+    # type: (dict, float, float) -> None
+    now = int(now or time.time());
+    for key in plan['pin']:
+        table.update_item(Key={KEY_NAME: key}, UpdateExpression='SET pinned = :pinned, expires_at = :pinned',
+                          ConditionExpression='attribute_exists(#key)',
+                          ExpressionAttributeNames={'#key': KEY_NAME},
+                          ExpressionAttributeValues={':pinned': True});
+    for key in plan['unpin'] + plan['expire']:
+        kwargs = {'Key': {KEY_NAME: key}, 'ConditionExpression': 'attribute_exists(#key)',
+                  'ExpressionAttributeNames': {'#key': KEY_NAME}};
+        actions = [];
+        if item_ttl:
+            actions.append('SET expires_at = :expires');
+            kwargs['ExpressionAttributeValues'] = {':expires': now + int(item_ttl)};
+        if key in plan['unpin']:
+            actions.append('REMOVE pinned');
+        table.update_item(UpdateExpression=' '.join(actions), **kwargs);
+    with table.batch_writer() as batch:
+        for key in plan['evict']:
+            batch.delete_item(Key={KEY_NAME: key});
+    audio = plan['delete_audio'];
+    for start in range(0, len(audio), S3_DELETE_LIMIT):
+        s3.delete_objects(Bucket=bucketName, Delete={
+            'Objects': [{'Key': object_key} for object_key in audio[start:start + S3_DELETE_LIMIT]],
+            'Quiet': True
+        });
+
+""" Function used to turn on time to live for the expires_at attribute of the table.
+"""
+def enableTimeToLive():
+    # type: () -> None
+    table.meta.client.update_time_to_live(TableName=table.name, TimeToLiveSpecification={
+        'Enabled': True, 'AttributeName': TTL_ATTRIBUTE
+    });
+
+""" Function used to plan and, unless it is a dry run, carry out a sweep. Returns a
+    summary of what was (or would have been) done.
+"""
+def sweep(budget_mb, pin_top, item_ttl_days, orphan_grace_hours, dry_run=False):
+    # type: (float, int, float, float, bool) -> dict
+    item_ttl = item_ttl_days * 24 * 3600;
+    plan = planSweep(int(budget_mb * 1024 * 1024), pin_top, item_ttl, orphan_grace_hours * 3600);
+    if not dry_run:
+        applySweep(plan, item_ttl);
+    summary = dict((name, len(plan[name])) for name in ('pin', 'unpin', 'expire', 'evict', 'delete_audio'));
+    summary.update({'bytes_before': plan['bytes_before'], 'bytes_after': plan['bytes_after'], 'dry_run': dry_run});
+    return summary, plan;
+
+""" Handler used when the sweep is run on a schedule as a Lambda function. The budget and
+    the other settings can be set with the ftStorageBudgetMB, ftPinTop, ftItemTTLDays and
+    ftOrphanGraceHours environment variables.
+"""
+def lambda_handler(event, context):
+    summary, plan = sweep(float(os.environ.get('ftStorageBudgetMB', '1024')),
+                          int(os.environ.get('ftPinTop', '1000')),
+                          float(os.environ.get('ftItemTTLDays', '90')),
+                          float(os.environ.get('ftOrphanGraceHours', '24')));
+    logger.info(json.dumps(summary));
+    return summary;
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Evict the least used Fun Translate phrases and audio files');
+    parser.add_argument('--budget-mb', type=float, default=1024, help='storage budget for the table and audio files together');
+    parser.add_argument('--pin-top', type=int, default=1000, help='number of most used phrases that are never evicted');
+    parser.add_argument('--ttl-days', type=float, default=float(os.environ.get('ftItemTTLDays', '90')),
+                        help='days an unused phrase is kept for (0 for ever)');
+    parser.add_argument('--orphan-grace-hours', type=float, default=24, help='age after which unused audio files are deleted');
+    parser.add_argument('--dry-run', action='store_true', help='only print what would be done');
+    parser.add_argument('--enable-ttl', action='store_true', help='turn on time to live for the expires_at attribute first');
+    args = parser.parse_args(argv);
+
+    if args.enable_ttl and not args.dry_run:
+        enableTimeToLive();
+    summary, plan = sweep(args.budget_mb, args.pin_top, args.ttl_days, args.orphan_grace_hours, args.dry_run);
+    if args.dry_run:
+        for name in ('pin', 'unpin', 'evict', 'delete_audio'):
+            for key in plan[name]:
+                print("{} {}".format(name, key));
+    print(json.dumps(summary));
+    return 0;
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO);
+    sys.exit(main());